@@ -1,19 +1,34 @@
+import array
+import gzip
+import json
+import sqlite3
 import unittest
 import os
+import shutil
 import tempfile
-from app import flask_app, init_db
+import threading
+import time
+from app import create_app, init_db, close_pool, close_write_queue, flush_writes, get_db, get_pool, get_writer
+from utils.ingest import UPDATE_COURSE_QUERY
+from utils.shards import SHARD_ID_BITS, ShardRouter
 
 
 class MyTestCase(unittest.TestCase):
+    config = {}
+
     def setUp(self):
-        self.db_fd, flask_app.config['DATABASE'] = tempfile.mkstemp()
-        flask_app.config['TESTING'] = True
-        self.test_app = flask_app.test_client()
-        init_db()
+        self.db_fd, database = tempfile.mkstemp()
+        self.app = create_app({'DATABASE': database, 'TESTING': True, **self.config})
+        self.test_app = self.app.test_client()
+        with self.app.app_context():
+            init_db()
 
     def tearDown(self):
+        with self.app.app_context():
+            close_write_queue()
+            close_pool()
         os.close(self.db_fd)
-        os.unlink(flask_app.config['DATABASE'])
+        os.unlink(self.app.config['DATABASE'])
 
     def test_success_add_course(self):
         # Given
@@ -75,6 +90,91 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(expected, rv.get_json())
         self.assertEqual(expected_code, rv.status_code)
 
+    def test_get_titles_courses_pages(self):
+        # Given
+        expected_first_page = {"titles": ["course1", "course2"], "next_after_id": 2}
+        expected_last_page = {"titles": ["course3"], "next_after_id": None}
+        # When
+        for title in ("course1", "course2", "course3"):
+            self.test_app.post('/add-course', json={"title": title, "start_date": "2018-09-11",
+                                                    "end_date": "2019-07-12", 'lectures': 17})
+        first_page = self.test_app.get('/get-titles-courses?limit=2')
+        last_page = self.test_app.get('/get-titles-courses?limit=2&after_id=2')
+        # Then
+        self.assertEqual(expected_first_page, first_page.get_json())
+        self.assertEqual(expected_last_page, last_page.get_json())
+
+    def test_wrong_limit_of_titles_courses(self):
+        # Given
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 17})
+        # When
+        answers = [self.test_app.get(f'/get-titles-courses?limit={limit}') for limit in ('abc', '0', '-1')]
+        # Then
+        self.assertEqual([400, 400, 400], [rv.status_code for rv in answers])
+
+    def test_stream_titles_courses(self):
+        # Given
+        expected_json = {"titles": ["course1", "course2", "course3"]}
+        expected_ndjson = '"course2"\n"course3"\n'
+        # When
+        for title in ("course1", "course2", "course3"):
+            self.test_app.post('/add-course', json={"title": title, "start_date": "2018-09-11",
+                                                    "end_date": "2019-07-12", 'lectures': 17})
+        json_stream = self.test_app.get('/get-titles-courses?stream=json')
+        ndjson_stream = self.test_app.get('/get-titles-courses?stream=ndjson&after_id=1')
+        empty_stream = self.test_app.get('/get-titles-courses?stream=json&after_id=3')
+        # Then
+        self.assertEqual(expected_json, json_stream.get_json())
+        self.assertEqual(expected_ndjson, ndjson_stream.get_data(as_text=True))
+        self.assertEqual({"titles": []}, empty_stream.get_json())
+
+    def test_not_modified_titles_courses(self):
+        # When
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 17})
+        first = self.test_app.get('/get-titles-courses')
+        unchanged = self.test_app.get('/get-titles-courses', headers={'If-None-Match': first.headers['ETag']})
+        other_page = self.test_app.get('/get-titles-courses?limit=1', headers={'If-None-Match': first.headers['ETag']})
+        self.test_app.post('/add-course', json={"title": "course2", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 17})
+        changed = self.test_app.get('/get-titles-courses', headers={'If-None-Match': first.headers['ETag']})
+        # Then
+        self.assertEqual(304, unchanged.status_code)
+        self.assertEqual(b'', unchanged.data)
+        self.assertEqual(200, other_page.status_code)
+        self.assertEqual(200, changed.status_code)
+        self.assertEqual({"titles": ["course1", "course2"]}, changed.get_json())
+
+    def test_not_modified_course(self):
+        # When
+        for title in ("course1", "course2"):
+            self.test_app.post('/add-course', json={"title": title, "start_date": "2018-09-11",
+                                                    "end_date": "2019-07-12", 'lectures': 17})
+        first = self.test_app.get('/get-course', json={"id": 1})
+        self.test_app.put('/change-attributes', json={"id": 2, "lectures": 3})
+        other_course_changed = self.test_app.get('/get-course', json={"id": 1},
+                                                 headers={'If-None-Match': first.headers['ETag']})
+        self.test_app.put('/change-attributes', json={"id": 1, "lectures": 3})
+        changed = self.test_app.get('/get-course', json={"id": 1}, headers={'If-None-Match': first.headers['ETag']})
+        # Then
+        self.assertEqual(304, other_course_changed.status_code)
+        self.assertEqual(200, changed.status_code)
+        self.assertEqual(3, changed.get_json()['lectures'])
+
+    def test_compressed_titles_courses(self):
+        # Given
+        body = ''.join('{"title": "course%d", "start_date": "2018-09-11", "end_date": "2019-07-12", '
+                       '"lectures": 1}\n' % i for i in range(200))
+        # When
+        self.test_app.post('/add-courses/bulk', data=body, content_type='application/x-ndjson')
+        compressed = self.test_app.get('/get-titles-courses', headers={'Accept-Encoding': 'gzip'})
+        plain = self.test_app.get('/get-titles-courses')
+        # Then
+        self.assertEqual('gzip', compressed.headers['Content-Encoding'])
+        self.assertEqual(plain.get_json(), json.loads(gzip.decompress(compressed.data)))
+        self.assertNotIn('Content-Encoding', plain.headers)
+
     def test_empty_get_courses_titles(self):
         # Given
         expected = {'titles': []}
@@ -120,6 +220,49 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(expected_message, rv.get_json())
         self.assertEqual(expected_code, rv.status_code)
 
+    def test_get_courses_by_ids(self):
+        # Given
+        query = {"ids": [1, 7], "ranges": [[3, 5]]}
+        expected_ids = {'1', '3', '4'}
+        expected_not_found = [5, 7]
+        # When
+        for title in ("course1", "course2", "course3", "course4"):
+            self.test_app.post('/add-course', json={"title": title, "start_date": "2018-09-11",
+                                                    "end_date": "2019-07-12", 'lectures': 17})
+        self.test_app.get('/get-course', json={"id": 3})
+        rv = self.test_app.get('/get-courses', json=query)
+        # Then
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(expected_ids, set(rv.get_json()['courses']))
+        self.assertEqual("course4", rv.get_json()['courses']['4']['title'])
+        self.assertEqual(expected_not_found, rv.get_json()['not_found'])
+
+    def test_get_courses_by_ids_in_chunks(self):
+        # Given
+        self.app.config['SQLITE_MAX_VARIABLES'] = 3
+        body = ''.join('{"title": "course%d", "start_date": "2018-09-11", "end_date": "2019-07-12", '
+                       '"lectures": 1}\n' % i for i in range(10))
+        # When
+        self.test_app.post('/add-courses/bulk', data=body, content_type='application/x-ndjson')
+        rv = self.test_app.get('/get-courses', json={"ranges": [[1, 12]]})
+        self.app.config['SQLITE_MAX_VARIABLES'] = 999
+        # Then
+        self.assertEqual(10, len(rv.get_json()['courses']))
+        self.assertEqual([11, 12], rv.get_json()['not_found'])
+
+    def test_get_courses_by_ids_too_many(self):
+        # When
+        rv = self.test_app.get('/get-courses', json={"ranges": [[1, 100000]]})
+        # Then
+        self.assertEqual(400, rv.status_code)
+
+    def test_get_courses_by_ids_not_lists(self):
+        # When
+        answers = [self.test_app.get('/get-courses', json=body)
+                   for body in ({"ids": "12"}, {"ranges": "12"}, {"ranges": ["12"]}, [1, 2])]
+        # Then
+        self.assertEqual([400] * 4, [rv.status_code for rv in answers])
+
     def test_get_filtered_courses(self):
         # Given
         expected = {"title": "course", "start_date": "2017-01-01", "end_date": "2020-01-01"}
@@ -145,6 +288,523 @@ class MyTestCase(unittest.TestCase):
         # Then
         self.assertEqual(expected_answer, rv.get_json())
 
+    def test_get_filtered_courses_by_window(self):
+        # Given
+        courses = [("course1", "2018-01-01", "2018-03-01"), ("course2", "2018-02-15", "2018-06-01"),
+                   ("course1", "2018-05-01", "2018-09-01"), ("course3", "2017-01-01", "2019-01-01")]
+        window = {"start_date": "2018-02-01", "end_date": "2018-04-01"}
+        # When
+        for title, start_date, end_date in courses:
+            self.test_app.post('/add-course', json={"title": title, "start_date": start_date,
+                                                    "end_date": end_date, 'lectures': 1})
+        overlap = self.test_app.get('/get-filtered-courses', json={**window, "mode": "overlap"})
+        overlap_title = self.test_app.get('/get-filtered-courses', json={**window, "mode": "overlap",
+                                                                         "title": "course1"})
+        contains = self.test_app.get('/get-filtered-courses', json={**window, "mode": "contains"})
+        inside = self.test_app.get('/get-filtered-courses', json={"start_date": "2018-01-01",
+                                                                  "end_date": "2018-06-01"})
+        on_day = self.test_app.get('/get-filtered-courses', json={"start_date": "2018-06-01",
+                                                                  "end_date": "2018-06-01", "mode": "overlap"})
+        self.test_app.put('/change-attributes', json={"id": 3, "start_date": "2018-03-01"})
+        changed = self.test_app.get('/get-filtered-courses', json={**window, "mode": "overlap"})
+        # Then
+        self.assertEqual(['1', '2', '4'], sorted(overlap.get_json()))
+        self.assertEqual(['1'], sorted(overlap_title.get_json()))
+        self.assertEqual(['4'], sorted(contains.get_json()))
+        self.assertEqual(['1', '2'], sorted(inside.get_json()))
+        self.assertEqual(['2', '3', '4'], sorted(on_day.get_json()))
+        self.assertEqual(['1', '2', '3', '4'], sorted(changed.get_json()))
+
+    def test_get_filtered_courses_wrong_mode(self):
+        # When
+        rv = self.test_app.get('/get-filtered-courses', json={"start_date": "2018-02-01",
+                                                              "end_date": "2018-04-01", "mode": "around"})
+        # Then
+        self.assertEqual(400, rv.status_code)
+
+    def test_init_db_keeps_existing_courses(self):
+        # Given
+        expected = {"titles": ["course1"]}
+        # When
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 17})
+        with self.app.app_context():
+            init_db()
+        rv = self.test_app.get('/get-titles-courses')
+        # Then
+        self.assertEqual(expected, rv.get_json())
+
+    def test_pooled_connection_is_reused(self):
+        # Given
+        expected_journal_mode = 'wal'
+        # When
+        with self.app.app_context():
+            first = get_db()
+        with self.app.app_context():
+            second = get_db()
+            journal_mode = second.execute('PRAGMA journal_mode').fetchone()['journal_mode']
+        # Then
+        self.assertIs(first, second)
+        self.assertEqual(expected_journal_mode, journal_mode)
+
+    def test_reads_use_read_only_connections(self):
+        # When
+        with self.app.app_context():
+            with self.assertRaises(sqlite3.OperationalError):
+                get_db().execute("INSERT INTO courses (title, start_date, end_date, lectures) "
+                                 "VALUES ('course1', '2018-09-11', '2019-07-12', 17)")
+        rv = self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                     "end_date": "2019-07-12", 'lectures': 17})
+        # Then
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual({"titles": ["course1"]}, self.test_app.get('/get-titles-courses').get_json())
+
+    def test_forked_worker_opens_its_own_connections(self):
+        # Given
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 17})
+        # When
+        pid = os.fork()
+        if pid == 0:
+            inherited = 'sqlite_pools' in self.app.extensions or 'sqlite_writers' in self.app.extensions
+            rv = self.test_app.get('/get-course', json={"id": 1})
+            os._exit(1 if inherited or rv.status_code != 200 else 0)
+        _, status = os.waitpid(pid, 0)
+        # Then
+        self.assertEqual(0, status)
+        self.assertIn('sqlite_writers', self.app.extensions)
+
+    def test_add_course_retried_with_idempotency_key(self):
+        # Given
+        course = {"title": "course1", "start_date": "2018-09-11", "end_date": "2019-07-12", 'lectures': 17}
+        # When
+        first = self.test_app.post('/add-course', json=course, headers={'Idempotency-Key': 'key-1'})
+        retry = self.test_app.post('/add-course', json=course, headers={'Idempotency-Key': 'key-1'})
+        other = self.test_app.post('/add-course', json={**course, 'lectures': 3}, headers={'Idempotency-Key': 'key-1'})
+        rv = self.test_app.get('/get-titles-courses')
+        # Then
+        self.assertEqual(first.get_json(), retry.get_json())
+        self.assertEqual('true', retry.headers['Idempotent-Replayed'])
+        self.assertEqual(422, other.status_code)
+        self.assertEqual({"titles": ["course1"]}, rv.get_json())
+
+    def test_expired_idempotency_key_is_forgotten(self):
+        # Given
+        course = {"title": "course1", "start_date": "2018-09-11", "end_date": "2019-07-12", 'lectures': 17}
+        self.app.config['IDEMPOTENCY_KEY_TTL'] = 0
+        # When
+        self.test_app.post('/add-course', json=course, headers={'Idempotency-Key': 'key-1'})
+        retry = self.test_app.post('/add-course', json=course, headers={'Idempotency-Key': 'key-1'})
+        rv = self.test_app.get('/get-titles-courses')
+        # Then
+        self.assertNotIn('Idempotent-Replayed', retry.headers)
+        self.assertEqual({"titles": ["course1", "course1"]}, rv.get_json())
+
+    def test_dedup_courses_command(self):
+        # Given
+        course = {"title": "course1", "start_date": "2018-09-11", "end_date": "2019-07-12", 'lectures': 17}
+        for lectures in (17, 5, 17):
+            self.test_app.post('/add-course', json={**course, 'lectures': lectures})
+        self.test_app.post('/add-course', json={**course, 'title': 'course2'})
+        # When
+        result = self.app.test_cli_runner().invoke(args=['dedup_courses', '--unique'])
+        with self.app.app_context():
+            init_db()
+        self.test_app.post('/add-course', json=course)
+        rv = self.test_app.get('/get-titles-courses')
+        course_rv = self.test_app.get('/get-course', json={"id": 1})
+        db = sqlite3.connect(self.app.config['DATABASE'])
+        indexes = {name for name, in db.execute("SELECT name FROM sqlite_master WHERE tbl_name = 'courses' "
+                                                "AND type = 'index'")}
+        db.close()
+        # Then
+        self.assertIn("Deleted 2 duplicate courses", result.output)
+        self.assertIn('courses_unique_idx', indexes)
+        self.assertNotIn('courses_title_dates_idx', indexes)
+        self.assertEqual({"titles": ["course1", "course2"]}, rv.get_json())
+        self.assertEqual(17, course_rv.get_json()['lectures'])
+
+    def test_change_into_a_duplicate_course_with_unique_index(self):
+        # Given
+        expected_message = "A course with the same title and dates already exists"
+        course = {"title": "A", "start_date": "2018-09-11", "end_date": "2019-07-12", 'lectures': 17}
+        self.test_app.post('/add-course', json=course)
+        self.test_app.post('/add-course', json={**course, 'title': 'B'})
+        self.app.test_cli_runner().invoke(args=['dedup_courses', '--unique'])
+        # When
+        changed = self.test_app.put('/change-attributes', json={"id": 2, "title": "A"})
+        bulk = self.test_app.put('/change-attributes/bulk', json={"courses": [{"id": 2, "title": "A"}]})
+        # Then
+        self.assertEqual(({"message": expected_message}, 400), (changed.get_json(), changed.status_code))
+        self.assertEqual({"errors": [{"index": 0, "message": expected_message}]}, bulk.get_json())
+
+    def test_bulk_add_courses_ndjson(self):
+        # Given
+        body = '\n'.join([
+            '{"title": "course1", "start_date": "2018-09-11", "end_date": "2019-07-12", "lectures": 17}',
+            '{"title": "course2", "start_date": "2019-11-11", "end_date": "2019-07-12", "lectures": 7}',
+            'not json',
+            '{"title": "course3", "start_date": "2019-02-21", "end_date": "2019-11-22", "lectures": 6}',
+        ])
+        expected_answer = {"inserted": 2, "errors": [
+            {"line": 2, "message": "The start_date is equal or greater than the end_date"},
+            {"line": 3, "message": "The course must be a JSON object"},
+        ]}
+        expected_titles = {"titles": ["course1", "course3"]}
+        # When
+        rv = self.test_app.post('/add-courses/bulk', data=body, content_type='application/x-ndjson')
+        titles = self.test_app.get('/get-titles-courses')
+        # Then
+        self.assertEqual(expected_answer, rv.get_json())
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(expected_titles, titles.get_json())
+
+    def test_bulk_add_courses_csv(self):
+        # Given
+        body = ("title,start_date,end_date,lectures\n"
+                "course1,2018-09-11,2019-07-12,17\n"
+                "course2,11-09-2011,2019-07-12,7\n")
+        expected_answer = {"inserted": 1, "errors": [
+            {"line": 3, "message": "This is the incorrect date string format. It should be YYYY-MM-DD"},
+        ]}
+        # When
+        rv = self.test_app.post('/add-courses/bulk', data=body, content_type='text/csv')
+        # Then
+        self.assertEqual(expected_answer, rv.get_json())
+
+    def test_bulk_add_courses_wrong_content_type(self):
+        # When
+        rv = self.test_app.post('/add-courses/bulk', data='title', content_type='text/plain')
+        # Then
+        self.assertEqual(415, rv.status_code)
+
+    def test_import_courses_command(self):
+        # Given
+        expected_titles = {"titles": ["course1", "course2"]}
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write("title,start_date,end_date,lectures\n"
+                    "course1,2018-09-11,2019-07-12,17\n"
+                    "course2,2015-01-17,2018-05-11,24\n")
+        # When
+        result = self.app.test_cli_runner().invoke(args=['import_courses', f.name])
+        os.unlink(f.name)
+        rv = self.test_app.get('/get-titles-courses')
+        # Then
+        self.assertIn("Imported 2 courses", result.output)
+        self.assertEqual(expected_titles, rv.get_json())
+
+    def test_cached_lookups_see_changes(self):
+        # Given
+        expected_course = {"id": 1, "title": "changed_title", "start_date": "2018-09-11",
+                           "end_date": "2019-07-12", 'lectures': 17}
+        expected_filtered = {'1': expected_course}
+        query = {"title": "changed_title", "start_date": "2018-01-01", "end_date": "2020-01-01"}
+        # When
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 17})
+        self.test_app.get('/get-course', json={"id": 1})
+        self.test_app.get('/get-filtered-courses', json=query)
+        self.test_app.put('/change-attributes', json={"id": 1, "title": "changed_title"})
+        course = self.test_app.get('/get-course', json={"id": 1})
+        filtered = self.test_app.get('/get-filtered-courses', json=query)
+        # Then
+        self.assertEqual(expected_course, course.get_json())
+        self.assertEqual(expected_filtered, filtered.get_json())
+
+    def test_cached_lookups_see_changes_of_other_workers(self):
+        # Given
+        other_worker = create_app({**self.app.config, 'CACHE_BACKEND': 'memory'})
+        query = {"start_date": "2018-01-01", "end_date": "2020-01-01"}
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 1})
+        cached = self.test_app.get('/get-course', json={"id": 1})
+        self.test_app.get('/get-filtered-courses', json=query)
+        # When
+        other_worker.test_client().put('/change-attributes', json={"id": 1, "lectures": 2})
+        course = self.test_app.get('/get-course', json={"id": 1})
+        filtered = self.test_app.get('/get-filtered-courses', json=query)
+        revalidated = self.test_app.get('/get-course', json={"id": 1}, headers={'If-None-Match': cached.headers['ETag']})
+        with other_worker.app_context():
+            close_write_queue()
+            close_pool()
+        # Then
+        self.assertEqual(2, course.get_json()['lectures'])
+        self.assertEqual(2, filtered.get_json()['1']['lectures'])
+        self.assertNotEqual(cached.headers['ETag'], course.headers['ETag'])
+        self.assertEqual(200, revalidated.status_code)
+
+    def test_concurrent_first_requests_share_the_writer_and_the_pool(self):
+        # Given
+        started = threading.Barrier(16)
+        created = []
+
+        def first_use():
+            with self.app.app_context():
+                started.wait()
+                created.append((get_writer(), get_pool()))
+        threads = [threading.Thread(target=first_use) for _ in range(16)]
+        # When
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Then
+        self.assertEqual(1, len({id(writer) for writer, _ in created}))
+        self.assertEqual(1, len({id(pool) for _, pool in created}))
+
+    def test_metrics(self):
+        # Given
+        self.app.extensions.pop('metrics', None)
+        # When
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 17})
+        self.test_app.get('/get-course', json={"id": 1})
+        rv = self.test_app.get('/metrics')
+        metrics = rv.get_data(as_text=True)
+        # Then
+        self.assertEqual(200, rv.status_code)
+        self.assertIn('course_catalog_request_duration_seconds_count{endpoint="addcourse"} 1', metrics)
+        self.assertIn('course_catalog_request_latency_seconds{endpoint="getcoursebyid",quantile="0.99"}', metrics)
+        self.assertIn('course_catalog_sql_statements_total{endpoint="getcoursebyid"} 2', metrics)
+        self.assertIn('course_catalog_rows_fetched_total{endpoint="getcoursebyid"} 2', metrics)
+
+    def test_course_stats(self):
+        # Given
+        expected = {
+            'total': {'courses': 3, 'lectures': 30, 'average_days': 20.0},
+            'titles': {'course1': {'courses': 2, 'lectures': 20, 'average_days': 15.0},
+                       'course2': {'courses': 1, 'lectures': 10, 'average_days': 30.0}},
+            'months': {'2018-01': 2, '2018-03': 1},
+        }
+        # When
+        for title, start_date, end_date in [("course1", "2018-01-01", "2018-01-11"),
+                                            ("course1", "2018-01-05", "2018-01-25"),
+                                            ("course2", "2018-03-01", "2018-03-31")]:
+            self.test_app.post('/add-course', json={"title": title, "start_date": start_date,
+                                                    "end_date": end_date, 'lectures': 10})
+        rv = self.test_app.get('/course-stats')
+        self.test_app.delete('/delete-course', json={"id": 3})
+        changed = self.test_app.get('/course-stats')
+        # Then
+        self.assertEqual(expected, rv.get_json())
+        self.assertEqual({'courses': 2, 'lectures': 20, 'average_days': 15.0}, changed.get_json()['total'])
+
+    def test_export_courses(self):
+        # Given
+        directory = tempfile.mkdtemp()
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "1970-01-02",
+                                                "end_date": "1970-02-01", 'lectures': 17})
+        self.test_app.post('/add-course', json={"title": "course2", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 7})
+        # When
+        result = self.app.test_cli_runner().invoke(args=['export_courses', directory])
+        with open(os.path.join(directory, 'catalog.json')) as f:
+            catalog = json.load(f)
+        columns = {}
+        for name in catalog['columns']:
+            with open(os.path.join(directory, f'{name}.npy'), 'rb') as f:
+                data = f.read()
+            header_size = 10 + int.from_bytes(data[8:10], 'little')
+            self.assertIn("'shape': (2,)", data[10:header_size].decode('latin1'))
+            columns[name] = array.array('q' if catalog['columns'][name] == '<i8' else 'i', data[header_size:])
+        shutil.rmtree(directory)
+        # Then
+        self.assertIn("Exported 2 courses", result.output)
+        self.assertEqual(['course1', 'course2'], catalog['titles'])
+        self.assertEqual([1, 2], list(columns['id']))
+        self.assertEqual([0, 1], list(columns['title']))
+        self.assertEqual([1, 17785], list(columns['start_day']))
+        self.assertEqual([31, 18089], list(columns['end_day']))
+        self.assertEqual([17, 7], list(columns['lectures']))
+
+    def test_changes_feed(self):
+        # Given
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 17})
+        self.test_app.put('/change-attributes', json={"id": 1, "lectures": 3})
+        self.test_app.put('/change-attributes', json={"id": 1, "lectures": 3})
+        self.test_app.delete('/delete-course', json={"id": 1})
+        # When
+        changes = self.test_app.get('/changes').get_json()
+        first = self.test_app.get('/changes?limit=1').get_json()
+        after_all = self.test_app.get(f"/changes?since={changes['next_since']}").get_json()
+        wrong_cursor = self.test_app.get('/changes?since=x')
+        wrong_limits = [self.test_app.get(f'/changes?limit={limit}') for limit in ('abc', '0')]
+        # Then
+        self.assertEqual([('insert', {"id": 1, "title": "course1", "start_date": "2018-09-11",
+                                      "end_date": "2019-07-12", "lectures": 17}),
+                          ('update', {"id": 1, "title": "course1", "start_date": "2018-09-11",
+                                      "end_date": "2019-07-12", "lectures": 3}),
+                          ('delete', {"id": 1})],
+                         [(event['operation'], event['course']) for event in changes['changes']])
+        self.assertEqual("3", changes['next_since'])
+        self.assertEqual({"changes": changes['changes'][:1], "next_since": "1"}, first)
+        self.assertEqual({"changes": [], "next_since": "3"}, after_all)
+        self.assertEqual(400, wrong_cursor.status_code)
+        self.assertEqual([400, 400], [rv.status_code for rv in wrong_limits])
+
+    def test_changes_long_poll(self):
+        # Given
+        def add_course():
+            time.sleep(0.1)
+            self.app.test_client().post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                             "end_date": "2019-07-12", 'lectures': 17})
+        writer = threading.Thread(target=add_course)
+        # When
+        started = time.monotonic()
+        writer.start()
+        rv = self.test_app.get('/changes?since=0&wait=5')
+        waited = time.monotonic() - started
+        writer.join()
+        # Then
+        self.assertEqual(['insert'], [event['operation'] for event in rv.get_json()['changes']])
+        self.assertLess(waited, 4)
+
+    def test_changes_server_sent_events(self):
+        # Given
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 17})
+        # When
+        rv = self.test_app.get('/changes?wait=0.1', headers={'Accept': 'text/event-stream'})
+        resumed = self.test_app.get('/changes?wait=0.1', headers={'Accept': 'text/event-stream', 'Last-Event-ID': '1'})
+        # Then
+        self.assertEqual('text/event-stream', rv.mimetype)
+        self.assertTrue(rv.get_data(as_text=True).startswith('id: 1\nevent: insert\ndata: {"seq": 1, '))
+        self.assertNotIn('event:', resumed.get_data(as_text=True))
+
+    def test_compact_changes_command(self):
+        # Given
+        self.app.config['CHANGES_RETENTION'] = -1
+        for title in ("course1", "course2"):
+            self.test_app.post('/add-course', json={"title": title, "start_date": "2018-09-11",
+                                                    "end_date": "2019-07-12", 'lectures': 17})
+        self.test_app.put('/change-attributes', json={"id": 1, "lectures": 3})
+        self.test_app.delete('/delete-course', json={"id": 2})
+        # When
+        result = self.app.test_cli_runner().invoke(args=['compact_changes'])
+        changes = self.test_app.get('/changes').get_json()
+        compacted = self.test_app.get('/changes?since=1')
+        # Then
+        self.assertIn("Deleted 3 changes", result.output)
+        self.assertEqual([(3, 'update', 1)], [(event['seq'], event['operation'], event['course']['id'])
+                                              for event in changes['changes']])
+        self.assertEqual(410, compacted.status_code)
+        self.assertEqual(200, self.test_app.get('/changes?since=4').status_code)
+
+    def test_profile_sampling(self):
+        # Given
+        profile_dir = tempfile.mkdtemp()
+        self.app.config.update(PROFILE_SAMPLE_RATE=1.0, PROFILE_DIR=profile_dir, PROFILE_KEEP=2)
+        self.app.extensions.pop('profiler', None)
+        # When
+        for _ in range(3):
+            self.test_app.get('/get-titles-courses')
+        self.app.config['PROFILE_SAMPLE_RATE'] = 0.0
+        self.app.extensions.pop('profiler', None)
+        profiles = os.listdir(profile_dir)
+        shutil.rmtree(profile_dir)
+        # Then
+        self.assertEqual(2, len(profiles))
+        self.assertTrue(all(name.startswith('courseslist-') for name in profiles))
+
+    def test_search_courses(self):
+        # Given
+        expected_prefix_titles = ["Python basics", "Advanced Python", "Python for data science"]
+        expected_token_titles = ["Python for data science"]
+        # When
+        for title, start_date in (("Python basics", "2018-09-11"), ("Java basics", "2018-09-11"),
+                                  ("Advanced Python", "2019-09-11"), ("Python for data science", "2020-09-11")):
+            self.test_app.post('/add-course', json={"title": title, "start_date": start_date,
+                                                    "end_date": "2021-07-12", 'lectures': 7})
+        prefix = self.test_app.get('/search-courses', json={"q": "pyth"})
+        tokens = self.test_app.get('/search-courses', json={"q": "python data", "prefix": False})
+        dates = self.test_app.get('/search-courses', json={"q": "python", "start_date": "2019-01-01",
+                                                           "end_date": "2022-01-01"})
+        page = self.test_app.get('/search-courses', json={"q": "python", "limit": 2})
+        # Then
+        self.assertEqual(sorted(expected_prefix_titles),
+                         sorted(course['title'] for course in prefix.get_json()['courses']))
+        self.assertEqual(expected_token_titles, [course['title'] for course in tokens.get_json()['courses']])
+        self.assertEqual(["Advanced Python", "Python for data science"],
+                         sorted(course['title'] for course in dates.get_json()['courses']))
+        self.assertEqual(2, page.get_json()['next_offset'])
+
+    def test_search_follows_changes(self):
+        # Given
+        expected = {'courses': [], 'next_offset': None}
+        # When
+        self.test_app.post('/add-course', json={"title": "Python basics", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 17})
+        self.test_app.put('/change-attributes', json={"id": 1, "title": "Java basics"})
+        renamed = self.test_app.get('/search-courses', json={"q": "python"})
+        self.test_app.delete('/delete-course', json={"id": 1})
+        deleted = self.test_app.get('/search-courses', json={"q": "java"})
+        # Then
+        self.assertEqual(expected, renamed.get_json())
+        self.assertEqual(expected, deleted.get_json())
+
+    def test_init_db_fills_search_index_of_existing_database(self):
+        # Given
+        with self.app.app_context():
+            close_pool()
+        db = sqlite3.connect(self.app.config['DATABASE'])
+        db.executescript("""
+            DROP TRIGGER courses_fts_insert;
+            DROP TABLE courses_fts;
+            INSERT INTO courses (title, start_date, end_date, lectures)
+            VALUES ('Python basics', '2018-09-11', '2019-07-12', 17);
+            """)
+        db.close()
+        # When
+        with self.app.app_context():
+            init_db()
+        rv = self.test_app.get('/search-courses', json={"q": "python"})
+        # Then
+        self.assertEqual(["Python basics"], [course['title'] for course in rv.get_json()['courses']])
+
+    def test_init_db_fills_date_index_of_existing_database(self):
+        # Given
+        with self.app.app_context():
+            close_pool()
+        db = sqlite3.connect(self.app.config['DATABASE'])
+        db.executescript("""
+            DROP TRIGGER courses_days_insert;
+            DROP TABLE courses_days;
+            INSERT INTO courses (title, start_date, end_date, lectures)
+            VALUES ('Python basics', '2018-09-11', '2019-07-12', 17);
+            """)
+        db.close()
+        # When
+        with self.app.app_context():
+            init_db()
+        rv = self.test_app.get('/get-filtered-courses', json={"start_date": "2019-01-01", "end_date": "2019-01-01",
+                                                              "mode": "overlap"})
+        # Then
+        self.assertEqual(['1'], list(rv.get_json()))
+
+    def test_update_touches_only_the_indexes_of_the_changed_columns(self):
+        # Given
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 17})
+        with self.app.app_context():
+            close_pool()
+        db = sqlite3.connect(self.app.config['DATABASE'])
+
+        def changed_rows(**changes):
+            before = db.total_changes
+            db.execute(UPDATE_COURSE_QUERY, {'id': 1, 'title': None, 'start_date': None, 'end_date': None,
+                                             'lectures': None, **changes}).fetchall()
+            return db.total_changes - before
+        # When
+        lectures = changed_rows(lectures=3)
+        title = changed_rows(title="course2")
+        dates = changed_rows(end_date="2019-07-13")
+        db.close()
+        # Then
+        # only a changed title writes to the search index and only changed dates to the date index
+        self.assertGreater(title, lectures)
+        self.assertGreater(dates, lectures)
+
     def test_change_attributes(self):
         # Given
         _id = 2
@@ -185,6 +845,61 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(expected_message, rv.get_json())
         self.assertEqual(expected_code, rv.status_code)
 
+    def test_wrong_change_end_date(self):
+        # Given
+        expected_message = {"message": "The end_date is equal or smaller than the start_date"}
+        # When
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 17})
+        rv = self.test_app.put('/change-attributes', json={'id': 1, 'end_date': '2018-09-11'})
+        course = self.test_app.get('/get-course', json={"id": 1})
+        # Then
+        self.assertEqual(expected_message, rv.get_json())
+        self.assertEqual(400, rv.status_code)
+        self.assertEqual('2019-07-12', course.get_json()['end_date'])
+
+    def test_bulk_change_attributes(self):
+        # Given
+        query = {"courses": [{"id": 1, "lectures": 3}, {"id": 2, "title": "changed_title", "start_date": "2015-01-01"}]}
+        expected_titles = {"titles": ["course1", "changed_title"]}
+        # When
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 17})
+        self.test_app.post('/add-course', json={"title": "course2", "start_date": "2018-01-17",
+                                                "end_date": "2018-05-11", 'lectures': 14})
+        self.test_app.get('/get-titles-courses')
+        rv = self.test_app.put('/change-attributes/bulk', json=query)
+        titles = self.test_app.get('/get-titles-courses')
+        course = self.test_app.get('/get-course', json={"id": 1})
+        # Then
+        self.assertEqual({"changed": 2}, rv.get_json())
+        self.assertEqual(expected_titles, titles.get_json())
+        self.assertEqual(3, course.get_json()['lectures'])
+
+    def test_bulk_change_attributes_not_an_object(self):
+        # When
+        answers = [self.test_app.put('/change-attributes/bulk', json=body) for body in ([{"id": 1}], 1, {"courses": 1})]
+        # Then
+        self.assertEqual([({"message": "The courses should be a list"}, 400)] * 3,
+                         [(rv.get_json(), rv.status_code) for rv in answers])
+
+    def test_wrong_bulk_change_attributes_changes_nothing(self):
+        # Given
+        query = {"courses": [{"id": 1, "lectures": 3}, {"id": 1, "start_date": "2020-01-01"}, {"id": 5, "lectures": 1}]}
+        expected_errors = {"errors": [
+            {"index": 1, "message": "The start_date is equal or greater than the end_date"},
+            {"index": 2, "message": "Course with this id was not found"},
+        ]}
+        # When
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 17})
+        rv = self.test_app.put('/change-attributes/bulk', json=query)
+        course = self.test_app.get('/get-course', json={"id": 1})
+        # Then
+        self.assertEqual(expected_errors, rv.get_json())
+        self.assertEqual(400, rv.status_code)
+        self.assertEqual(17, course.get_json()['lectures'])
+
     def test_empty_change_attributes(self):
         # Given
         _id = 2
@@ -226,6 +941,299 @@ class MyTestCase(unittest.TestCase):
         # Then
         self.assertEqual(expected_message, rv.get_json())
 
+    def test_failed_write_releases_the_database(self):
+        # Given
+        other = sqlite3.connect(self.app.config['DATABASE'], timeout=0)
+        # When
+        rv = self.test_app.delete('/delete-course', json={'id': 2})
+        other.execute("BEGIN IMMEDIATE")
+        other.rollback()
+        other.close()
+        # Then
+        self.assertEqual(404, rv.status_code)
+
+
+class RecordRowsTestCase(MyTestCase):
+    """The same scenarios with the compact Record rows instead of dictionaries."""
+
+    config = {'DB_ROW_FORMAT': 'record'}
+
+
+class WriteBehindTestCase(MyTestCase):
+    """The same scenarios with the mutations applied by the write-behind thread."""
+
+    config = {'WRITE_BEHIND': True, 'WRITE_BEHIND_DURABILITY': 'committed', 'WRITE_BEHIND_INTERVAL': 0.001}
+
+    def test_accepted_write_is_polled(self):
+        # Given
+        self.app.config['WRITE_BEHIND_DURABILITY'] = 'accepted'
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 7})
+        # When
+        accepted = self.test_app.put('/change-attributes', json={"id": 1, "lectures": 3})
+        with self.app.app_context():
+            flushed = flush_writes(timeout=5)
+        operation = self.test_app.get('/get-operation', json={"id": accepted.get_json()['id']})
+        unknown = self.test_app.get('/get-operation', json={"id": "0"})
+        # Then
+        self.assertEqual(202, accepted.status_code)
+        self.assertTrue(flushed)
+        self.assertEqual({'id': accepted.get_json()['id'], 'status': 'done', 'code': 200,
+                          'answer': {'message': "Course attributes changed successfully"}}, operation.get_json())
+        self.assertEqual(3, self.test_app.get('/get-course', json={"id": 1}).get_json()['lectures'])
+        self.assertEqual(404, unknown.status_code)
+
+    def test_queued_changes_of_a_course_are_coalesced(self):
+        # Given
+        self.app.config['WRITE_BEHIND_DURABILITY'] = 'accepted'
+        self.app.config['WRITE_BEHIND_INTERVAL'] = 0.2
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 7})
+        with self.app.app_context():
+            flush_writes()
+        # When
+        self.test_app.put('/change-attributes', json={"id": 1, "lectures": 3})
+        self.test_app.put('/change-attributes', json={"id": 1, "title": "course2"})
+        missing = self.test_app.delete('/delete-course', json={"id": 2})
+        with self.app.app_context():
+            flush_writes()
+        # Then
+        self.assertEqual('failed', self.test_app.get('/get-operation', json=missing.get_json()).get_json()['status'])
+        self.assertEqual({"id": 1, "title": "course2", "start_date": "2018-09-11", "end_date": "2019-07-12",
+                          "lectures": 3}, self.test_app.get('/get-course', json={"id": 1}).get_json())
+
+
+    def test_queued_changes_failing_only_together_are_not_coalesced(self):
+        # Given
+        self.app.config['WRITE_BEHIND_DURABILITY'] = 'accepted'
+        self.app.config['WRITE_BEHIND_INTERVAL'] = 0.2
+        self.test_app.post('/add-course', json={"title": "course1", "start_date": "2018-09-11",
+                                                "end_date": "2019-07-12", 'lectures': 7})
+        with self.app.app_context():
+            flush_writes()
+        # When
+        moved = self.test_app.put('/change-attributes', json={"id": 1, "start_date": "2019-08-01",
+                                                              "end_date": "2019-09-01"})
+        wrong_end = self.test_app.put('/change-attributes', json={"id": 1, "end_date": "2019-07-01"})
+        wrong_start = self.test_app.put('/change-attributes', json={"id": 1, "start_date": "2019-10-01"})
+        lectures = self.test_app.put('/change-attributes', json={"id": 1, "lectures": 3})
+        with self.app.app_context():
+            flush_writes()
+        # Then
+        self.assertEqual(['done', 'failed', 'failed', 'done'],
+                         [self.test_app.get('/get-operation', json=rv.get_json()).get_json()['status']
+                          for rv in (moved, wrong_end, wrong_start, lectures)])
+        self.assertEqual({"id": 1, "title": "course1", "start_date": "2019-08-01", "end_date": "2019-09-01",
+                          "lectures": 3}, self.test_app.get('/get-course', json={"id": 1}).get_json())
+
+
+
+class ShardedTestCase(unittest.TestCase):
+    """A catalog of three shards: "course1" is placed on the shard 2, "course2" on the shard 0."""
+
+    def setUp(self):
+        self.db_fd, database = tempfile.mkstemp()
+        self.app = create_app({'DATABASE': database, 'TESTING': True, 'DATABASE_SHARDS': 3})
+        self.test_app = self.app.test_client()
+        self.router = ShardRouter(database, 3)
+        with self.app.app_context():
+            init_db()
+
+    def tearDown(self):
+        with self.app.app_context():
+            close_pool()
+        os.close(self.db_fd)
+        for database in self.router.databases:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(database + suffix):
+                    os.unlink(database + suffix)
+
+    def add_course(self, title, start_date="2018-09-11", end_date="2019-07-12", lectures=17):
+        return self.test_app.post('/add-course', json={"title": title, "start_date": start_date,
+                                                       "end_date": end_date, 'lectures': lectures})
+
+    def shard_ids(self, shard):
+        db = sqlite3.connect(self.router.databases[shard])
+        ids = [_id for _id, in db.execute("SELECT id FROM courses ORDER BY id")]
+        db.close()
+        return ids
+
+    def test_courses_are_placed_by_title_with_ids_of_their_shard(self):
+        # Given
+        first_of_shard_2 = (2 << SHARD_ID_BITS) + 1
+        # When
+        for title in ("course1", "course2", "course1"):
+            self.add_course(title)
+        titles = self.test_app.get('/get-titles-courses')
+        page = self.test_app.get('/get-titles-courses?limit=2')
+        streamed = self.test_app.get('/get-titles-courses?stream=json')
+        course = self.test_app.get('/get-course', json={"id": first_of_shard_2})
+        courses = self.test_app.get('/get-courses', json={"ids": [1, first_of_shard_2, 2]})
+        # Then
+        self.assertEqual([1], self.shard_ids(0))
+        self.assertEqual([], self.shard_ids(1))
+        self.assertEqual([first_of_shard_2, first_of_shard_2 + 1], self.shard_ids(2))
+        self.assertEqual({"titles": ["course2", "course1", "course1"]}, titles.get_json())
+        self.assertEqual({"titles": ["course2", "course1"], "next_after_id": first_of_shard_2}, page.get_json())
+        self.assertEqual(titles.get_json(), streamed.get_json())
+        self.assertEqual("course1", course.get_json()['title'])
+        self.assertEqual([str(1), str(first_of_shard_2)], list(courses.get_json()['courses']))
+        self.assertEqual([2], courses.get_json()['not_found'])
+
+    def test_scatter_gather_queries(self):
+        # When
+        self.add_course("course1", "2018-01-01", "2018-01-11", 10)
+        self.add_course("course2", "2018-01-05", "2018-02-04", 10)
+        self.add_course("python course", "2018-03-01", "2018-03-21", 5)
+        filtered = self.test_app.get('/get-filtered-courses', json={"start_date": "2018-01-01",
+                                                                    "end_date": "2018-02-10", "mode": "overlap"})
+        stats = self.test_app.get('/course-stats')
+        found = self.test_app.get('/search-courses', json={"q": "course", "limit": 2})
+        # Then
+        self.assertEqual(["course1", "course2"], sorted(item['title'] for item in filtered.get_json().values()))
+        self.assertEqual({'courses': 3, 'lectures': 25, 'average_days': 20.0}, stats.get_json()['total'])
+        self.assertEqual({'2018-01': 2, '2018-03': 1}, stats.get_json()['months'])
+        self.assertEqual(2, len(found.get_json()['courses']))
+        self.assertEqual(2, found.get_json()['next_offset'])
+
+    def test_writes_find_the_shard_of_the_course(self):
+        # Given
+        self.add_course("course1")
+        course_id = (2 << SHARD_ID_BITS) + 1
+        # When
+        changed = self.test_app.put('/change-attributes', json={"id": course_id, "lectures": 3})
+        bulk = self.test_app.put('/change-attributes/bulk', json={"courses": [{"id": course_id, "lectures": 4},
+                                                                              {"id": 1, "lectures": 4}]})
+        deleted = self.test_app.delete('/delete-course', json={"id": course_id})
+        missing = self.test_app.delete('/delete-course', json={"id": course_id})
+        # Then
+        self.assertEqual(200, changed.status_code)
+        self.assertEqual([{"index": 1, "message": "Course with this id was not found"}], bulk.get_json()['errors'])
+        self.assertEqual(200, deleted.status_code)
+        self.assertEqual(404, missing.status_code)
+        self.assertEqual([], self.shard_ids(2))
+
+    def test_concurrent_bulk_changes_of_the_shards(self):
+        # Given
+        self.add_course("course1")
+        self.add_course("course2")
+        courses = [{"id": 1, "lectures": 3}, {"id": (2 << SHARD_ID_BITS) + 1, "lectures": 3}]
+        answers = []
+
+        def change(order):
+            for _ in range(20):
+                answers.append(self.app.test_client().put('/change-attributes/bulk',
+                                                          json={"courses": order}).status_code)
+        threads = [threading.Thread(target=change, args=(order,), daemon=True) for order in (courses, courses[::-1])]
+        # When
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        # Then
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertEqual([200] * 40, answers)
+
+    def test_idempotency_key_of_another_shard(self):
+        # Given
+        course = {"title": "alpha", "start_date": "2018-09-11", "end_date": "2019-07-12", 'lectures': 1}
+        headers = {'Idempotency-Key': 'k1'}
+        # When
+        added = self.test_app.post('/add-course', json=course, headers=headers)
+        replayed = self.test_app.post('/add-course', json=course, headers=headers)
+        other_shard = self.test_app.post('/add-course', json={**course, "title": "eps"}, headers=headers)
+        # Then
+        self.assertEqual(200, added.status_code)
+        self.assertEqual('true', replayed.headers['Idempotent-Replayed'])
+        self.assertEqual(422, other_shard.status_code)
+        self.assertEqual([(1 << SHARD_ID_BITS) + 1], self.shard_ids(1))
+        self.assertEqual([], self.shard_ids(2))
+
+    def test_bulk_add_courses_are_routed(self):
+        # Given
+        body = ''.join('{"title": "course%d", "start_date": "2018-09-11", "end_date": "2019-07-12", '
+                       '"lectures": 1}\n' % i for i in (1, 2, 5))
+        # When
+        rv = self.test_app.post('/add-courses/bulk', data=body, content_type='application/x-ndjson')
+        # Then
+        self.assertEqual(3, rv.get_json()['inserted'])
+        self.assertEqual([1], self.shard_ids(0))
+        self.assertEqual([(2 << SHARD_ID_BITS) + 1, (2 << SHARD_ID_BITS) + 2], self.shard_ids(2))
+
+    def test_rebalance_moves_courses_and_keeps_their_ids(self):
+        # Given
+        self.add_course("course1")
+        course_id = (2 << SHARD_ID_BITS) + 1
+        self.test_app.put('/change-attributes', json={"id": course_id, "title": "course2"})
+        # When
+        result = self.app.test_cli_runner().invoke(args=['rebalance_shards'])
+        moved = self.test_app.get('/get-course', json={"id": course_id})
+        self.add_course("course2")
+        # Then
+        self.assertIn("Moved 1 courses", result.output)
+        self.assertEqual("course2", moved.get_json()['title'])
+        self.assertEqual([1, course_id], self.shard_ids(0))
+        self.assertEqual([], self.shard_ids(2))
+        self.assertEqual(200, self.test_app.put('/change-attributes', json={"id": course_id, "lectures": 3}).status_code)
+
+    def test_changes_of_the_shards(self):
+        # Given
+        self.add_course("course1")
+        self.add_course("course2")
+        moved = (2 << SHARD_ID_BITS) + 1
+        self.test_app.put('/change-attributes', json={"id": moved, "title": "course2"})
+        # When
+        self.app.test_cli_runner().invoke(args=['rebalance_shards'])
+        changes = self.test_app.get('/changes').get_json()
+        after_all = self.test_app.get(f"/changes?since={changes['next_since']}").get_json()
+        # Then
+        # the course moved to the shard 0 is inserted there, its changes on the shard 2 are dropped
+        self.assertEqual([('insert', 1), ('insert', moved)],
+                         sorted((event['operation'], event['course']['id']) for event in changes['changes']))
+        self.assertEqual("2.0.0", changes['next_since'])
+        self.assertEqual([], after_all['changes'])
+
+    def test_compacted_changes_of_a_moved_and_deleted_course(self):
+        # Given
+        self.app.config['CHANGES_RETENTION'] = -1
+        self.add_course("course1")
+        moved = (2 << SHARD_ID_BITS) + 1
+        self.test_app.put('/change-attributes', json={"id": moved, "title": "course2"})
+        self.app.test_cli_runner().invoke(args=['rebalance_shards'])
+        self.test_app.delete('/delete-course', json={"id": moved})
+        # When
+        self.app.test_cli_runner().invoke(args=['compact_changes'])
+        course = self.test_app.get('/get-course', json={"id": moved})
+        changes = self.test_app.get('/changes').get_json()
+        # Then
+        self.assertEqual(404, course.status_code)
+        self.assertEqual([], changes['changes'])
+
+    def test_metrics_count_the_statements_of_all_the_shards(self):
+        # Given
+        self.app.extensions.pop('metrics', None)
+        self.add_course("course2")
+        # When
+        self.test_app.get('/get-course', json={"id": 1})
+        metrics = self.test_app.get('/metrics').get_data(as_text=True)
+        # Then
+        self.assertIn('course_catalog_sql_statements_total{endpoint="getcoursebyid"} 6', metrics)
+        self.assertIn('course_catalog_rows_fetched_total{endpoint="getcoursebyid"} 2', metrics)
+
+    def test_export_courses_merges_the_shards(self):
+        # Given
+        directory = tempfile.mkdtemp()
+        self.add_course("course1")
+        self.add_course("course2")
+        # When
+        result = self.app.test_cli_runner().invoke(args=['export_courses', directory])
+        with open(os.path.join(directory, 'id.npy'), 'rb') as f:
+            data = f.read()
+        shutil.rmtree(directory)
+        # Then
+        self.assertIn("Exported 2 courses", result.output)
+        self.assertEqual([1, (2 << SHARD_ID_BITS) + 1], list(array.array('q', data[128:])))
+
 
 if __name__ == '__main__':
     unittest.main()
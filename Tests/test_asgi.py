@@ -0,0 +1,74 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from app import create_app, init_db, close_pool
+from utils.asgi import AsgiApp
+
+
+def call(asgi_app, method, path, body=b'', query_string=b'', content_type=b'application/json', chunk_size=None):
+    """Run one request through the ASGI application, sending the body in chunks of `chunk_size` bytes."""
+    chunk_size = chunk_size or max(len(body), 1)
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] or [b'']
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                for i, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http', 'path': path,
+             'query_string': query_string, 'root_path': '', 'server': ('testserver', 80),
+             'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]}
+    asyncio.run(asgi_app(scope, receive, send))
+    return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+
+class AsgiTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db_fd, database = tempfile.mkstemp()
+        self.app = create_app({'DATABASE': database, 'TESTING': True})
+        self.asgi_app = AsgiApp(self.app.wsgi_app, threads=4)
+        with self.app.app_context():
+            init_db()
+
+    def tearDown(self):
+        self.asgi_app.executor.shutdown()
+        with self.app.app_context():
+            close_pool()
+        os.close(self.db_fd)
+        os.unlink(self.app.config['DATABASE'])
+
+    def test_add_and_get_course(self):
+        # Given
+        course = {"title": "course1", "start_date": "2018-09-11", "end_date": "2019-07-12", 'lectures': 17}
+        expected_course = {"id": 1, **course}
+        # When
+        add_status, _ = call(self.asgi_app, 'POST', '/add-course', json.dumps(course).encode())
+        get_status, body = call(self.asgi_app, 'GET', '/get-course', json.dumps({"id": 1}).encode())
+        # Then
+        self.assertEqual(200, add_status)
+        self.assertEqual(200, get_status)
+        self.assertEqual(expected_course, json.loads(body))
+
+    def test_streamed_request_and_response(self):
+        # Given
+        body = b''.join(b'{"title": "course%d", "start_date": "2018-09-11", "end_date": "2019-07-12", '
+                        b'"lectures": 1}\n' % i for i in range(50))
+        expected_titles = [f"course{i}" for i in range(50)]
+        # When
+        status, answer = call(self.asgi_app, 'POST', '/add-courses/bulk', body, content_type=b'application/x-ndjson',
+                              chunk_size=7)
+        _, titles = call(self.asgi_app, 'GET', '/get-titles-courses', query_string=b'stream=json')
+        # Then
+        self.assertEqual(200, status)
+        self.assertEqual({"inserted": 50, "errors": []}, json.loads(answer))
+        self.assertEqual(expected_titles, json.loads(titles)['titles'])
+
+
+if __name__ == '__main__':
+    unittest.main()
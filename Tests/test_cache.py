@@ -0,0 +1,63 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from utils.cache import LRUCache, SocketCache, make_cache_server
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        # Given
+        cache = LRUCache(maxsize=2)
+        # When
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        # Then
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.stats()['evictions'])
+
+    def test_expired_entry_is_a_miss(self):
+        # Given
+        cache = LRUCache(ttl=0.01)
+        # When
+        cache.set('a', 1)
+        time.sleep(0.02)
+        # Then
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual({"hits": 0, "misses": 1, "evictions": 0, "size": 0}, cache.stats())
+
+    def test_invalidate_removes_only_tagged_entries(self):
+        # Given
+        cache = LRUCache()
+        # When
+        cache.set('filter', 1, tags=[('title', 'course'), ('course', 1)])
+        cache.set('course', 2, tags=[('course', 2)])
+        cache.invalidate(('course', 1))
+        # Then
+        self.assertIsNone(cache.get('filter'))
+        self.assertEqual(2, cache.get('course'))
+
+
+class SocketCacheTestCase(unittest.TestCase):
+    def test_clients_share_entries(self):
+        # Given
+        address = os.path.join(tempfile.mkdtemp(), 'cache.sock')
+        server = make_cache_server(address, b'secret')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        first, second = SocketCache(address, b'secret'), SocketCache(address, b'secret')
+        # When
+        first.set(('course', 1), {'id': 1}, tags=[('course', 1)])
+        shared = second.get(('course', 1))
+        second.invalidate(('course', 1))
+        # Then
+        self.assertEqual({'id': 1}, shared)
+        self.assertIsNone(first.get(('course', 1)))
+        self.assertEqual(1, first.stats()['hits'])
+
+
+if __name__ == '__main__':
+    unittest.main()
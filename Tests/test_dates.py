@@ -0,0 +1,32 @@
+import unittest
+from datetime import datetime
+from utils.dates import parse_date
+
+
+class ParseDateTestCase(unittest.TestCase):
+    def test_parse_padded_date(self):
+        # When
+        parsed = parse_date("2018-09-11")
+        # Then
+        self.assertEqual(("2018-09-11", 17785), parsed)
+
+    def test_parse_unpadded_date_as_strptime(self):
+        # When
+        parsed = parse_date("2018-9-1")
+        # Then
+        self.assertEqual(("2018-09-01", (datetime(2018, 9, 1) - datetime(1970, 1, 1)).days), parsed)
+
+    def test_wrong_dates(self):
+        for text in ("2018-02-30", "11-09-2018", "2018/09/11", "20180911", "2018-09-1a", "+018-09-11",
+                     "2018-0９-11", ""):
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                parse_date(text)
+
+    def test_wrong_types(self):
+        for value in (20180911, None, ["2018-09-11"]):
+            with self.subTest(value=value), self.assertRaises(TypeError):
+                parse_date(value)
+
+
+if __name__ == '__main__':
+    unittest.main()
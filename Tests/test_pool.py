@@ -0,0 +1,104 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from utils.pool import ConnectionPool, GroupCommitWriter, connect
+
+
+class CountingConnection(sqlite3.Connection):
+    commits = 0
+
+    def commit(self):
+        CountingConnection.commits += 1
+        super().commit()
+
+
+class GroupCommitWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db_fd, self.database = tempfile.mkstemp()
+        CountingConnection.commits = 0
+        self.writer = GroupCommitWriter(connect(self.database, pragmas={'journal_mode': 'WAL'},
+                                                factory=CountingConnection), interval=0.05)
+        with self.writer.session() as db:
+            db.execute("CREATE TABLE items (value INTEGER)")
+        self.readers = ConnectionPool(self.database, read_only=True)
+
+    def tearDown(self):
+        self.readers.close()
+        self.writer.close()
+        os.close(self.db_fd)
+        os.unlink(self.database)
+
+    def count_items(self):
+        reader = self.readers.acquire()
+        try:
+            return reader.execute("SELECT count(*) FROM items").fetchone()[0]
+        finally:
+            self.readers.release(reader)
+
+    def test_concurrent_writes_share_a_commit(self):
+        # Given
+        commits_before = CountingConnection.commits
+
+        def write(value):
+            with self.writer.session() as db:
+                db.execute("INSERT INTO items VALUES (?)", (value,))
+        threads = [threading.Thread(target=write, args=(value,)) for value in range(10)]
+        # When
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Then
+        self.assertEqual(10, self.count_items())
+        self.assertLess(CountingConnection.commits - commits_before, 10)
+
+    def test_rollback_undoes_only_the_session_writes(self):
+        # Given
+        first, second = self.writer.session(), self.writer.session()
+        # When
+        first.execute("INSERT INTO items VALUES (1)")
+        first.commit()
+        second.execute("INSERT INTO items VALUES (2)")
+        second.rollback()
+        # Then
+        self.assertEqual(1, self.count_items())
+
+    def test_rollback_of_the_only_writes_releases_the_lock(self):
+        # Given
+        session = self.writer.session()
+        other = connect(self.database)
+        # When
+        session.execute("INSERT INTO items VALUES (1)")
+        session.rollback()
+        other.execute("BEGIN IMMEDIATE")
+        other.execute("INSERT INTO items VALUES (2)")
+        other.commit()
+        other.close()
+        # Then
+        self.assertFalse(self.writer.connection.in_transaction)
+        self.assertEqual(1, self.count_items())
+
+    def test_reads_are_not_blocked_by_an_open_write(self):
+        # Given
+        session = self.writer.session()
+        # When
+        session.execute("INSERT INTO items VALUES (1)")
+        count_during_write = self.count_items()
+        session.commit()
+        # Then
+        self.assertEqual(0, count_during_write)
+        self.assertEqual(1, self.count_items())
+
+    def test_read_only_connection_cannot_write(self):
+        # Given
+        reader = self.readers.acquire()
+        # Then
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.execute("INSERT INTO items VALUES (1)")
+        self.readers.release(reader)
+
+
+if __name__ == '__main__':
+    unittest.main()
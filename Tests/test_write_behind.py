@@ -0,0 +1,73 @@
+import threading
+import unittest
+from utils.write_behind import WriteBehindQueue
+
+
+def merge(kind, payload, next_kind, next_payload):
+    return kind, {**payload, **next_payload}
+
+
+class WriteBehindQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+        self.queue = WriteBehindQueue(self.apply, merge, interval=0.05)
+
+    def tearDown(self):
+        self.release.set()
+        self.queue.close()
+
+    def apply(self, writes):
+        self.release.wait()
+        self.batches.append(writes)
+        return [({"message": kind}, 404 if payload.get('missing') else 200) for kind, payload in writes]
+
+    def test_writes_are_applied_in_one_batch(self):
+        # When
+        operations = [self.queue.submit('add', {'value': value}) for value in range(10)]
+        flushed = self.queue.flush(timeout=5)
+        # Then
+        self.assertTrue(flushed)
+        self.assertEqual(1, len(self.batches))
+        self.assertEqual(['done'] * 10, [operation.status for operation in operations])
+
+    def test_writes_with_the_same_key_are_coalesced(self):
+        # When
+        first = self.queue.submit('change', {'lectures': 3}, key=1)
+        second = self.queue.submit('change', {'title': 'course2'}, key=1)
+        other = self.queue.submit('change', {'missing': True}, key=2)
+        self.queue.flush(timeout=5)
+        # Then
+        self.assertEqual([[('change', {'lectures': 3, 'title': 'course2'}), ('change', {'missing': True})]],
+                         self.batches)
+        self.assertEqual(('done', 200), (first.status, first.code))
+        self.assertEqual(('done', 200), (second.status, second.code))
+        self.assertEqual(('failed', 404), (other.status, other.code))
+
+    def test_write_in_progress_is_not_coalesced(self):
+        # Given
+        self.release.clear()
+        self.queue.submit('change', {'lectures': 3}, key=1)
+        self.queue.flush(timeout=0.2)
+        # When
+        self.queue.submit('change', {'title': 'course2'}, key=1)
+        self.release.set()
+        self.queue.flush(timeout=5)
+        # Then
+        self.assertEqual([[('change', {'lectures': 3})], [('change', {'title': 'course2'})]], self.batches)
+
+    def test_get_and_close(self):
+        # Given
+        operation = self.queue.submit('add', {})
+        # When
+        self.queue.close()
+        # Then
+        self.assertIs(operation, self.queue.get(operation.id))
+        self.assertEqual('done', operation.status)
+        with self.assertRaises(RuntimeError):
+            self.queue.submit('add', {})
+
+
+if __name__ == '__main__':
+    unittest.main()
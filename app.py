@@ -1,38 +1,221 @@
 import sqlite3
-from datetime import datetime as date
 import os
-from flask import Flask, g, request
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import re
+import tempfile
+import threading
+import time
+import weakref
+import click
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from flask import Flask, Response, current_app, g, request
+from flask.cli import with_appcontext
 from flask_restful import Resource, Api
-from utils.db_utils import dict_factory
+from flask_restful.representations.json import output_json as restful_output_json
+from werkzeug.http import quote_etag
+from werkzeug.wsgi import make_line_iter
+from utils.cache import LRUCache, NullCache
+from utils.changes import (advance, compact_changes, format_cursor, is_compacted, parse_cursor, stream_changes,
+                           wait_for_changes)
+from utils.dates import parse_date
+from utils.db_utils import ROW_FACTORIES, dumps
+from utils.http_utils import compress, request_etag
+from utils.metrics import (InstrumentedConnection, Metrics, RequestProfiler, current_stats, finish_request, measured,
+                           start_request)
+from utils.ingest import (CourseValidationError, INSERT_COURSE_QUERY, import_courses, read_csv, read_ndjson,
+                          update_course, validate_course, validate_course_changes)
+from utils.pool import ConnectionPool, GroupCommitWriter, commit_sessions, connect
+from utils.shards import ShardRouter
+from utils.write_behind import WriteBehindQueue
 
 DATABASE = 'database.db'
+DATABASE_SHARDS = 1
+SHARD_KEY = 'title'
 DEBUG = True
+DB_POOL_SIZE = 8
+DB_COMMIT_INTERVAL = 0.002
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_CACHE_SIZE = -64000
+DB_ROW_FORMAT = 'dict'
+BULK_CHUNK_SIZE = 1000
+TITLES_PAGE_MAX_SIZE = 1000
+SEARCH_PAGE_SIZE = 20
+BATCH_MAX_IDS = 1000
+SQLITE_MAX_VARIABLES = 999
+STREAM_FETCH_SIZE = 500
+CACHE_BACKEND = 'memory'
+CACHE_MAXSIZE = 10000
+CACHE_TTL = 60
+CACHE_ADDRESS = '/tmp/course-catalog-cache.sock'
+METRICS_ENABLED = True
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'course-catalog-profiles')
+PROFILE_KEEP = 20
+ASGI_DB_THREADS = 32
+ASGI_MAX_CONCURRENCY = 64
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+WRITE_BEHIND = False
+WRITE_BEHIND_DURABILITY = 'accepted'
+WRITE_BEHIND_INTERVAL = 0.05
+WRITE_BEHIND_BATCH = 1000
+CHANGES_PAGE_SIZE = 100
+CHANGES_MAX_WAIT = 30
+CHANGES_POLL_INTERVAL = 0.05
+CHANGES_RETENTION = 7 * 24 * 60 * 60
 SECRET_KEY = b'\xa7\xf9\x85\xac \x85\xccL\xeb\xb8\xcd\xcb\xe7Ey\xeb\xc1\xa2~E'
 
-# Create the application instance
-flask_app = Flask(__name__)
-flask_app.config.from_object(__name__)
-api = Api(flask_app)
+# Applications created by create_app(), their per-process state is dropped in the forked workers
+_apps = weakref.WeakSet()
+_default_app_lock = threading.Lock()
+# Guards the creation of the per-process objects of the applications (writers, pools, ...), so concurrent
+# first requests share one of each. Reentrant: a pool creates the writer of its shard.
+_extensions_lock = threading.RLock()
 
-# Update configs (database path) of the current system
-flask_app.config.update(
-    DATABASE=os.path.join(flask_app.root_path, 'database.db')
-)
+
+def create_app(config=None):
+    """
+    Create and configure an instance of the application.
+    Nothing is opened or started here: the database connections, the cache and the profiler
+    are created on first use in every process, so a pre-forking server can create the application
+    once in its master process (preload) and fork the workers from it.
+    :param config: dictionary of configs overriding the defaults and the COURSE_CATALOG_SETTINGS file
+    :return: Flask - the application
+    """
+    app = Flask(__name__)
+    app.config.from_object(__name__)
+    # Update configs (database path) of the current system
+    app.config.update(
+        DATABASE=os.path.join(app.root_path, 'database.db')
+    )
+    # Deployment specific configs (python file with the configs in uppercase)
+    app.config.from_envvar('COURSE_CATALOG_SETTINGS', silent=True)
+    app.config.update(config or {})
+
+    app.before_request(start_instrumentation)
+    app.teardown_request(finish_instrumentation)
+    app.after_request(compress_response)
+    app.teardown_appcontext(close_db)
+    for command in COMMANDS:
+        app.cli.add_command(command)
+
+    api = Api(app)
+    api.representation('application/json')(output_json)
+    for resource, url, methods in RESOURCES:
+        api.add_resource(resource, url, methods=methods)
+    _apps.add(app)
+    return app
+
+
+def __getattr__(name):
+    """
+    The default application `flask_app` is created on first use, so importing the module
+    (e.g. by the flask command looking for create_app) does not build one.
+    """
+    if name == 'flask_app':
+        with _default_app_lock:
+            if 'flask_app' not in globals():
+                globals()['flask_app'] = create_app()
+        return globals()['flask_app']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def forget_process_state():
+    """
+    Drop the database connections, shard threads, write-behind queue, cache, metrics and profiler inherited
+    from the parent process, a forked worker must not share them: it creates its own on first use.
+    :return: None
+    """
+    global _extensions_lock
+    # A thread of the parent may have held the lock at the fork
+    _extensions_lock = threading.RLock()
+    for app in list(_apps):
+        for name in ('sqlite_pools', 'sqlite_writers', 'shard_executor', 'write_behind', 'course_cache', 'metrics',
+                     'profiler'):
+            app.extensions.pop(name, None)
+
+
+os.register_at_fork(after_in_child=forget_process_state)
+
+
+def output_json(data, code, headers=None):
+    """
+    Serialize the answer of a resource to JSON.
+    With DB_ROW_FORMAT = 'record' the rows are written straight from their Record templates,
+    otherwise the answer is serialized by flask_restful.
+    :return: Response
+    """
+    if current_app.config['DB_ROW_FORMAT'] != 'record':
+        return restful_output_json(data, code, headers)
+    response = current_app.response_class(dumps(data) + '\n', code, mimetype='application/json')
+    response.headers.extend(headers or {})
+    return response
+
+
+# Indexes derived from the courses and the queries filling them, run when a migration creates the index
+DERIVED_INDEXES = {
+    'courses_fts': "INSERT INTO courses_fts (courses_fts) VALUES ('rebuild')",
+    'courses_days': """
+        INSERT INTO courses_days (id, start_day, end_day)
+        SELECT id, julianday(start_date) - 2440587.5, julianday(end_date) - 2440587.5
+        FROM courses
+        """,
+    # The courses that existed before the change log are its first changes
+    'course_changes': """
+        INSERT INTO course_changes (course_id, operation, title, start_date, end_date, lectures)
+        SELECT id, 'insert', title, start_date, end_date, lectures
+        FROM courses
+        ORDER BY id
+        """,
+}
 
 
 def init_db():
     """
     Initializes a database from a script "scheme.sql".
+    The script is idempotent, so running it against an existing database
+    migrates it to the current schema (new tables and indexes) without touching the data.
+    Search and date indexes created by the migration are filled from the existing courses.
+    Every shard of the catalog is initialized, the ids of a new shard start in its range (see utils.shards).
+    Runs in the application context of the application whose database is initialized.
     :return: None
     """
-    with flask_app.app_context():
-        db = get_db()
-        with flask_app.open_resource('schema.sql', mode='r') as f:
-            db.cursor().executescript(f.read())
-        db.commit()
+    close_pool()
+    get_cache().clear()
+    with current_app.open_resource('schema.sql', mode='r') as f:
+        script = f.read()
+    for shard in range(len(get_router())):
+        db = connect_writer(shard)
+        try:
+            existing = {row['name'] for row in db.execute("SELECT name FROM sqlite_master")}
+            db.cursor().executescript(script)
+            for name, query in DERIVED_INDEXES.items():
+                if name not in existing:
+                    db.execute(query)
+            if 'courses_unique_idx' in existing:
+                # The unique index of `flask dedup_courses --unique` serves the same lookups
+                db.execute("DROP INDEX IF EXISTS courses_title_dates_idx")
+            db.execute(
+                """
+                INSERT INTO sqlite_sequence (name, seq)
+                SELECT 'courses', :_start
+                WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name == 'courses')
+                """,
+                {"_start": get_router().sequence_start(shard)}
+            )
+            db.commit()
+        finally:
+            db.close()
 
 
-@flask_app.cli.command('init_database')
+@click.command('init_database')
+@with_appcontext
 def command_init_db():
     """
     Initializes a database from a script "scheme.sql".
@@ -41,82 +224,958 @@ def command_init_db():
     init_db()
 
 
-def get_db():
+@click.command('import_courses')
+@click.argument('file', type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def command_import_courses(file):
+    """
+    Imports courses from a NDJSON file or a CSV file (with the ".csv" extension and a header row).
+    Uses the same validation and batched inserts as the /add-courses/bulk endpoint.
+    :return: None
+    """
+    reader = read_csv if file.endswith('.csv') else read_ndjson
+    with open(file, newline='', encoding='utf-8') as f:
+        inserted, errors = import_courses(get_writer_dbs(), reader(f), current_app.config['BULK_CHUNK_SIZE'],
+                                          on_chunk=invalidate_inserted_courses, route=get_router().shard_of)
+    for error in errors:
+        click.echo(f"Line {error['line']}: {error['message']}", err=True)
+    click.echo(f"Imported {inserted} courses")
+
+
+@click.command('export_courses')
+@click.argument('directory', type=click.Path(file_okay=False))
+@with_appcontext
+def command_export_courses(directory):
+    """
+    Exports the courses into a directory of columnar NumPy files (one .npy file per column,
+    titles dictionary-encoded and dates as int32 days since 1970-01-01) described by "catalog.json".
+    The courses of every shard are streamed from one read transaction, so the export of one shard
+    is a consistent snapshot, and the shards are merged by id.
+    :return: None
+    """
+    from utils.export import EXPORT_QUERY, export_columns
+
+    db_cursors = []
+    for db in get_dbs():
+        db_cursors.append(db.cursor())
+        db_cursors[-1].row_factory = None
+        db_cursors[-1].execute('BEGIN')
+    try:
+        for db_cursor in db_cursors:
+            db_cursor.execute(EXPORT_QUERY)
+        exported = export_columns(merge_by_id(db_cursors, key=itemgetter(0)), directory,
+                                  current_app.config['STREAM_FETCH_SIZE'])
+    finally:
+        for db_cursor in db_cursors:
+            db_cursor.execute('ROLLBACK')
+    click.echo(f"Exported {exported} courses to {directory}")
+
+
+@click.command('dedup_courses')
+@click.option('--unique', is_flag=True, help="then forbid duplicate courses with a unique index")
+@with_appcontext
+def command_dedup_courses(unique):
+    """
+    Deletes the duplicate courses (the same title and dates), keeping the first one of each,
+    drops the expired idempotency keys and compacts the database file.
+    With --unique a unique index on (title, start_date, end_date) replaces courses_title_dates_idx,
+    so /add-course and the imports skip the duplicates.
+    Every shard is deduplicated on its own: the duplicates of a course have the same key, so they are placed
+    on the same shard (run `flask rebalance_shards` first after a change of the sharding).
+    :return: None
+    """
+    close_pool()
+    deleted = 0
+    for shard in range(len(get_router())):
+        db = connect_writer(shard)
+        try:
+            deleted += db.execute(
+                """
+                DELETE
+                FROM courses
+                WHERE id NOT IN (SELECT min(id) FROM courses GROUP BY title, start_date, end_date)
+                """
+            ).rowcount
+            db.execute("DELETE FROM idempotency_keys WHERE created <= :_expired",
+                       {"_expired": int(time.time()) - current_app.config['IDEMPOTENCY_KEY_TTL']})
+            if unique:
+                db.execute("CREATE UNIQUE INDEX IF NOT EXISTS courses_unique_idx "
+                           "ON courses (title, start_date, end_date)")
+                db.execute("DROP INDEX IF EXISTS courses_title_dates_idx")
+            db.commit()
+            db.execute("INSERT INTO courses_fts (courses_fts) VALUES ('optimize')")
+            db.commit()
+            db.execute("VACUUM")
+        finally:
+            db.close()
+    get_cache().clear()
+    click.echo(f"Deleted {deleted} duplicate courses")
+
+
+@click.command('rebalance_shards')
+@with_appcontext
+def command_rebalance_shards():
+    """
+    Moves the courses that are not on the shard of their key to it: the courses whose title or start date changed,
+    or all of them after a change of DATABASE_SHARDS or SHARD_KEY (run `flask init_database` first
+    to create the new shards). A moved course keeps its id, a duplicate of a course of its new shard is dropped.
+    The courses are moved in transactions of BULK_CHUNK_SIZE courses holding the write locks of both shards.
+    :return: None
+    """
+    router = get_router()
+    chunk_size = min(current_app.config['BULK_CHUNK_SIZE'], current_app.config['SQLITE_MAX_VARIABLES'])
+    moved = 0
+    for source in range(len(router)):
+        db = connect_writer(source)
+        try:
+            targets = {}
+            for row in db.execute("SELECT id, title, start_date FROM courses"):
+                if (target := router.shard_of(row['title'], row['start_date'])) != source:
+                    targets.setdefault(target, []).append(row['id'])
+            for target, ids in targets.items():
+                db.execute("ATTACH DATABASE ? AS target", (router.databases[target],))
+                try:
+                    for chunk in chunked_parameters(ids, chunk_size):
+                        moved += move_courses(db, chunk)
+                finally:
+                    db.execute("DETACH DATABASE target")
+        finally:
+            db.close()
+    get_cache().clear()
+    click.echo(f"Moved {moved} courses")
+
+
+def move_courses(db, ids):
+    """
+    Move courses from the shard of a connection to the shard attached to it as "target", in one transaction.
+    The sequence of the target is kept, so its next course gets an id of its own range.
+    In the change logs a moved course is only inserted into the target: its changes on the source are dropped,
+    so the source does not keep a latest change of a course it does not have.
+    :param db: connection of the source shard with the target shard attached
+    :param ids: ids of the moved courses
+    :return: number of the moved courses
+    """
+    parameters = ', '.join('?' * len(ids))
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        sequence = db.execute("SELECT seq FROM target.sqlite_sequence WHERE name == 'courses'").fetchone()['seq']
+        db.execute(
+            f"""
+            INSERT INTO target.courses (id, title, start_date, end_date, lectures)
+            SELECT id, title, start_date, end_date, lectures
+            FROM main.courses
+            WHERE id IN ({parameters})
+            ON CONFLICT DO NOTHING
+            """,
+            ids
+        )
+        moved = db.execute(f"DELETE FROM main.courses WHERE id IN ({parameters})", ids).rowcount
+        db.execute(f"DELETE FROM main.course_changes WHERE course_id IN ({parameters})", ids)
+        db.execute("UPDATE target.sqlite_sequence SET seq = :_seq WHERE name == 'courses'", {"_seq": sequence})
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return moved
+
+
+@click.command('compact_changes')
+@with_appcontext
+def command_compact_changes():
+    """
+    Compacts the change log of the courses (see /changes): of the changes older than CHANGES_RETENTION seconds
+    only the latest change of every existing course is kept. Run it periodically (e.g. daily by cron)
+    to bound the size of the log.
+    :return: None
+    """
+    expired = int((time.time() - current_app.config['CHANGES_RETENTION']) * 1000)
+    deleted = 0
+    for shard in range(len(get_router())):
+        db = connect_writer(shard)
+        try:
+            deleted += compact_changes(db, expired)
+            db.commit()
+        finally:
+            db.close()
+    click.echo(f"Deleted {deleted} changes")
+
+
+@click.command('cache_server')
+@with_appcontext
+def command_cache_server():
+    """
+    Runs the cache shared by the worker processes configured with CACHE_BACKEND = 'socket'.
+    :return: None
+    """
+    from utils.socket_cache import make_cache_server
+
+    server = make_cache_server(current_app.config['CACHE_ADDRESS'], current_app.config['SECRET_KEY'],
+                               current_app.config['CACHE_MAXSIZE'], current_app.config['CACHE_TTL'])
+    click.echo(f"Serving the cache on {current_app.config['CACHE_ADDRESS']}")
+    server.serve_forever()
+
+
+def get_cache():
+    """
+    Return the cache of course lookups, creating it on first use.
+    CACHE_BACKEND selects it: 'memory' - LRU cache of this process,
+    'socket' - cache shared by the worker processes through the `flask cache_server` command, None - no caching.
+    :return: LRUCache, SocketCache or NullCache
+    """
+    if 'course_cache' not in current_app.extensions:
+        with _extensions_lock:
+            if 'course_cache' not in current_app.extensions:
+                backend = current_app.config['CACHE_BACKEND']
+                if backend == 'memory':
+                    cache = LRUCache(current_app.config['CACHE_MAXSIZE'], current_app.config['CACHE_TTL'])
+                elif backend == 'socket':
+                    from utils.socket_cache import SocketCache
+                    cache = SocketCache(current_app.config['CACHE_ADDRESS'], current_app.config['SECRET_KEY'])
+                else:
+                    cache = NullCache()
+                current_app.extensions['course_cache'] = cache
+    return current_app.extensions['course_cache']
+
+
+def get_metrics():
+    """
+    Return the per-endpoint metrics of this worker, creating them on first use.
+    :return: Metrics
+    """
+    if 'metrics' not in current_app.extensions:
+        with _extensions_lock:
+            if 'metrics' not in current_app.extensions:
+                current_app.extensions['metrics'] = Metrics()
+    return current_app.extensions['metrics']
+
+
+def get_profiler():
+    """
+    Return the sampling profiler configured by PROFILE_SAMPLE_RATE, PROFILE_DIR and PROFILE_KEEP.
+    :return: RequestProfiler
+    """
+    if 'profiler' not in current_app.extensions:
+        with _extensions_lock:
+            if 'profiler' not in current_app.extensions:
+                current_app.extensions['profiler'] = RequestProfiler(
+                    current_app.config['PROFILE_DIR'], current_app.config['PROFILE_SAMPLE_RATE'],
+                    current_app.config['PROFILE_KEEP'])
+    return current_app.extensions['profiler']
+
+
+def start_instrumentation():
+    """
+    Start measuring the request: its latency, its SQL statements and, if it is sampled, its profile.
+    :return: None
+    """
+    if current_app.config['METRICS_ENABLED']:
+        g.request_started = time.perf_counter()
+        start_request()
+        if current_app.config['PROFILE_SAMPLE_RATE']:
+            g.profile = get_profiler().start()
+
+
+def finish_instrumentation(exception):
+    """
+    Record the latency and the SQL statistics of the request by its endpoint.
+    :return: None
+    """
+    if 'request_started' not in g:
+        return
+    seconds = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unmatched'
+    get_metrics().observe(endpoint, seconds, finish_request())
+    if g.get('profile') is not None:
+        get_profiler().finish(g.profile, endpoint, seconds)
+
+
+def compress_response(response):
+    """
+    Compress (brotli or gzip) the answers bigger than COMPRESS_MIN_SIZE bytes if the client accepts it.
+    Streamed answers are sent as they are.
+    :return: Response
+    """
+    if (response.is_streamed or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.content_length is None or response.content_length < current_app.config['COMPRESS_MIN_SIZE']):
+        return response
+    response.vary.add('Accept-Encoding')
+    if compressed := compress(response.get_data(), request.accept_encodings, current_app.config['COMPRESS_LEVEL']):
+        data, encoding = compressed
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def get_catalog_version():
+    """
+    :return: int - version of the catalog, it changes with every write of the courses
+                   (the sum of the versions of the shards, which only grow)
+    """
+    return sum(row['version'] for row in itertools.chain.from_iterable(
+        gather("SELECT version FROM catalog_version")))
+
+
+def get_course_version():
+    """
+    :return: int - version of the course with the id of the request, 0 if it was not changed since the migration
+                   (the sum of its versions on the shards, it changes when the course is moved too)
+    """
+    rows = gather(
+        """
+        SELECT version
+        FROM course_versions
+        WHERE course_id == :_id
+        """,
+        {"_id": int(request.json["id"])}
+    )
+    return sum(row['version'] for row in itertools.chain.from_iterable(rows))
+
+
+def conditional(get_version):
+    """
+    Decorator of read resource methods: the answer gets an ETag built from the data version and the request,
+    and a request with a matching If-None-Match is answered with 304 without running the method.
+    The method caches its results under versioned_key(), so its answer is never older than its ETag.
+    :param get_version: function returning the version of the data the method reads
+    :return: decorator
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            g.data_version = get_version()
+            etag = request_etag(g.data_version, request.method, request.url, request.get_data())
+            if request.if_none_match.contains_weak(etag):
+                return Response(status=304, headers={'ETag': quote_etag(etag, weak=True)})
+
+            result = method(*args, **kwargs)
+            if isinstance(result, Response):
+                if result.status_code == 200:
+                    result.set_etag(etag, weak=True)
+                return result
+            data, code, *headers = result
+            if code != 200:
+                return result
+            return data, code, {**(headers[0] if headers else {}), 'ETag': quote_etag(etag, weak=True)}
+        return wrapper
+    return decorator
+
+
+def versioned_key(*key):
+    """
+    Cache key of a result read at the data version of the request (see conditional). The cache of a worker
+    is not invalidated by the writes of the other workers, a result cached at an older version is never used.
+    :param key: parts of the key
+    :return: tuple - cache key
+    """
+    return (*key, g.data_version)
+
+
+def db_pragmas():
+    """
+    :return: dictionary {pragma name: value} of the connections, tuned by the DB_* configs
+    """
+    return {
+        'synchronous': 'NORMAL',
+        'mmap_size': current_app.config['DB_MMAP_SIZE'],
+        'cache_size': current_app.config['DB_CACHE_SIZE'],
+    }
+
+
+def db_factory():
+    """
+    :return: sqlite3.Connection subclass of the connections
+    """
+    return InstrumentedConnection if current_app.config['METRICS_ENABLED'] else sqlite3.Connection
+
+
+def get_router():
+    """
+    Return the router of the courses on the shards configured by DATABASE, DATABASE_SHARDS and SHARD_KEY.
+    :return: ShardRouter
+    """
+    if 'shard_router' not in current_app.extensions:
+        current_app.extensions['shard_router'] = ShardRouter(
+            current_app.config['DATABASE'], current_app.config['DATABASE_SHARDS'], current_app.config['SHARD_KEY'])
+    return current_app.extensions['shard_router']
+
+
+def get_executor():
     """
-    Return the connection if it exists in the application context,
-    else - connects to the database, writes to application context and then return connection
+    Return the threads running the queries of the shards in parallel, creating them on first use.
+    Every request thread may use a connection of each shard at a time, so there are DB_POOL_SIZE threads per shard
+    (the query of the first shard runs on the request thread itself).
+    :return: ThreadPoolExecutor
+    """
+    if 'shard_executor' not in current_app.extensions:
+        with _extensions_lock:
+            if 'shard_executor' not in current_app.extensions:
+                current_app.extensions['shard_executor'] = ThreadPoolExecutor(
+                    current_app.config['DB_POOL_SIZE'] * len(get_router()), 'shard')
+    return current_app.extensions['shard_executor']
+
+
+def connect_writer(shard=0):
+    """
+    Open a new connection to a shard of the configured database that can write.
+    It switches the database to WAL, so the read-only connections are never blocked by the writes.
+    :param shard: index of the shard, 0 is the configured database
     :return: Connection - SQLite database connection object
     """
-    if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = sqlite3.connect(flask_app.config['DATABASE'])
-        g.sqlite_db.row_factory = dict_factory
-    return g.sqlite_db
+    return connect(get_router().databases[shard], pragmas={'journal_mode': 'WAL', **db_pragmas()},
+                   row_factory=ROW_FACTORIES[current_app.config['DB_ROW_FORMAT']], factory=db_factory())
+
+
+def get_writer(shard=0):
+    """
+    Return the single writer of a shard of the configured database, creating it on first use.
+    Its transactions are group-committed every DB_COMMIT_INTERVAL seconds.
+    :param shard: index of the shard, 0 is the configured database
+    :return: GroupCommitWriter - writer of the database file of the shard
+    """
+    writers = current_app.extensions.setdefault('sqlite_writers', {})
+    database = get_router().databases[shard]
+    if database not in writers:
+        with _extensions_lock:
+            if database not in writers:
+                writers[database] = GroupCommitWriter(connect_writer(shard),
+                                                      current_app.config['DB_COMMIT_INTERVAL'])
+    return writers[database]
+
+
+def get_pool(shard=0):
+    """
+    Return the pool of read-only connections of a shard of the configured database, creating it on first use.
+    The pool is sized by DB_POOL_SIZE and its connections are tuned by the DB_* configs.
+    :param shard: index of the shard, 0 is the configured database
+    :return: ConnectionPool - pool of connections to the database file of the shard
+    """
+    pools = current_app.extensions.setdefault('sqlite_pools', {})
+    database = get_router().databases[shard]
+    if database not in pools:
+        with _extensions_lock:
+            if database not in pools:
+                # The open writer keeps the database in WAL mode with its shared memory file, which the readers need
+                get_writer(shard)
+                pools[database] = ConnectionPool(
+                    database,
+                    size=current_app.config['DB_POOL_SIZE'],
+                    pragmas=db_pragmas(),
+                    row_factory=ROW_FACTORIES[current_app.config['DB_ROW_FORMAT']],
+                    factory=db_factory(),
+                    read_only=True
+                )
+    return pools[database]
+
+
+def close_pool():
+    """
+    Close all pooled connections and the writers of the shards of the configured database and forget them,
+    together with the router of the shards.
+    :return: None
+    """
+    pools = current_app.extensions.get('sqlite_pools', {})
+    writers = current_app.extensions.get('sqlite_writers', {})
+    for database in get_router().databases:
+        if pool := pools.pop(database, None):
+            pool.close()
+        if writer := writers.pop(database, None):
+            writer.close()
+    if executor := current_app.extensions.pop('shard_executor', None):
+        executor.shutdown()
+    # The router is built again from the config, which may name other databases by then
+    current_app.extensions.pop('shard_router', None)
+
+
+def get_db(shard=0):
+    """
+    Return the read-only connection of the shard if it exists in the application context,
+    else - checks a connection out of the pool, writes to application context and then return connection.
+    DB_ROW_FORMAT selects the rows it returns: 'dict' - dictionaries, 'record' - compact Records.
+    :param shard: index of the shard, 0 is the configured database
+    :return: Connection - SQLite database connection object
+    """
+    connections = g.setdefault('sqlite_dbs', {})
+    if shard not in connections:
+        pool = get_pool(shard)
+        connections[shard] = pool, pool.acquire()
+        connections[shard][1].row_factory = ROW_FACTORIES[current_app.config['DB_ROW_FORMAT']]
+    return connections[shard][1]
+
+
+def get_dbs():
+    """
+    :return: list of the read-only connections of all the shards (see get_db)
+    """
+    return [get_db(shard) for shard in range(len(get_router()))]
+
+
+def get_writer_db(shard=0):
+    """
+    Return the write session of the shard if it exists in the application context,
+    else - opens a session of the writer, writes to application context and then return session.
+    The session takes the writer on its first statement and gives it back on commit() or rollback().
+    :param shard: index of the shard, 0 is the configured database
+    :return: WriteSession - connection-like handle of the writer
+    """
+    sessions = g.setdefault('sqlite_sessions', {})
+    if shard not in sessions:
+        sessions[shard] = get_writer(shard).session(ROW_FACTORIES[current_app.config['DB_ROW_FORMAT']])
+    return sessions[shard]
+
+
+def get_writer_dbs():
+    """
+    :return: list of the write sessions of all the shards (see get_writer_db)
+    """
+    return [get_writer_db(shard) for shard in range(len(get_router()))]
 
 
-@flask_app.teardown_appcontext
 def close_db(self):
     """
-    When the application context dies - close the connection to the database if it exist.
+    When the application context dies - check the connections back in to the pools
+    and roll back the unfinished writes if they exist.
     (usually at the end of the request)
     :return: None
     """
-    if hasattr(g, 'sqlite_db'):
-        g.sqlite_db.close()
+    for pool, db in g.pop('sqlite_dbs', {}).values():
+        pool.release(db)
+    for session in g.pop('sqlite_sessions', {}).values():
+        session.close()
+
+
+def gather(query, parameters=None, shards=None):
+    """
+    Scatter a read query to the shards and gather their rows. With several shards the queries run in parallel
+    (sqlite3 releases the GIL while a statement runs), every one on the connection of its shard.
+    :param query: SQL query
+    :param parameters: parameters of the query
+    :param shards: indexes of the shards, all the shards by default
+    :return: list of the lists of rows of the shards, in the order of `shards`
+    """
+    connections = [get_db(shard) for shard in (range(len(get_router())) if shards is None else shards)]
+
+    def fetch(db):
+        return db.execute(query, parameters or ()).fetchall()
+
+    if len(connections) == 1:
+        return [fetch(connections[0])]
+    futures = [get_executor().submit(measured, fetch, db) for db in connections[1:]]
+    shard_rows = [fetch(connections[0])]
+    stats = current_stats()
+    for future in futures:
+        rows, shard_stats = future.result()
+        shard_rows.append(rows)
+        if stats is not None:
+            stats.add(shard_stats)
+    return shard_rows
+
+
+def merge_by_id(shard_rows, key=itemgetter('id')):
+    """
+    Merge the rows of the shards, every one ordered by id, into one sequence ordered by id.
+    :param shard_rows: list of iterables of rows, one per shard
+    :param key: function returning the id of a row
+    :return: iterable of rows
+    """
+    return shard_rows[0] if len(shard_rows) == 1 else heapq.merge(*shard_rows, key=key)
+
+
+def locate_course(course_id):
+    """
+    :param course_id: course unique id
+    :return: index of the shard of the course, None if it is not found.
+             With one shard it is not looked up: the write of the course finds out that it does not exist.
+    """
+    if len(get_router()) == 1:
+        return 0
+    rows = gather("SELECT id FROM courses WHERE id == :_id", {"_id": course_id})
+    return next((shard for shard, found in enumerate(rows) if found), None)
+
+
+def add_course(db, course):
+    """
+    Insert a validated course, without committing it.
+    :param db: writer session
+    :param course: tuple (title, start_date, end_date, lectures) from validate_course()
+    :return: tuple (answer, HTTP code, cache tags of the change)
+    """
+    inserted = db.execute(INSERT_COURSE_QUERY, course).rowcount
+    tags = [('title', course[0]), ('titles',), ('dates',)] if inserted else []
+    return {"message": "Course added successfully"}, 200, tags
+
+
+def change_course(db, changes):
+    """
+    Apply a partial update validated by validate_course_changes(), without committing it.
+    :param db: writer session
+    :param changes: dictionary of the UPDATE_COURSE_QUERY parameters
+    :return: tuple (answer, HTTP code, cache tags of the change)
+    """
+    try:
+        course = update_course(db, changes)
+    except CourseValidationError as error:
+        return {"message": str(error)}, 400, []
+    if course is None:
+        return {"message": "Course with this id was not found"}, 404, []
+    return {'message': "Course attributes changed successfully"}, 200, changed_course_tags(course, changes)
+
+
+def delete_course(db, course_id):
+    """
+    Delete a course, without committing it.
+    :param db: writer session
+    :param course_id: course unique id
+    :return: tuple (answer, HTTP code, cache tags of the change)
+    """
+    db_cursor = db.cursor()
+    db_cursor.execute(
+        """
+        DELETE
+        FROM courses
+        WHERE id == :_id 
+        """,
+        {'_id': course_id}
+    )
+    if not db_cursor.rowcount:
+        return {"message": "Course with this id was not found"}, 404, []
+    return {'message': "Course deleted successfully"}, 200, [('course', course_id), ('titles',)]
+
+
+# Writes of the resources by kind
+WRITES = {'add': add_course, 'change': change_course, 'delete': delete_course}
+
+
+def write_shard(kind, payload):
+    """
+    :param kind: key of WRITES
+    :param payload: parameter of the write function
+    :return: index of the shard of the written course, None if the changed or deleted course is not found
+    """
+    if kind == 'add':
+        return get_router().shard_of(payload[0], payload[1])
+    return locate_course(payload['id'] if kind == 'change' else payload)
+
+
+def write(kind, payload, key=None):
+    """
+    Apply a validated write and commit it, or with WRITE_BEHIND queue it for the write-behind thread.
+    In the write-behind mode the answer is 202 with the id of the operation (see /get-operation),
+    or with WRITE_BEHIND_DURABILITY = 'committed' the answer of the write once its batch is committed.
+    :param kind: key of WRITES
+    :param payload: parameter of the write function
+    :param key: coalescing key of the write-behind queue, writes of the same course are merged
+    :return: answer of the resource
+    """
+    if current_app.config['WRITE_BEHIND']:
+        operation = get_write_queue().submit(kind, payload, key)
+        if current_app.config['WRITE_BEHIND_DURABILITY'] == 'committed':
+            operation.wait()
+            return operation.answer, operation.code
+        return operation.to_json(), 202
+
+    if (shard := write_shard(kind, payload)) is None:
+        return {"message": "Course with this id was not found"}, 404
+    db = get_writer_db(shard)
+    answer, code, tags = WRITES[kind](db, payload)
+    if code != 200:
+        db.rollback()
+        return answer, code
+    db.commit()
+    get_cache().invalidate(*tags)
+    return answer, code
+
+
+def apply_writes(app, writes):
+    """
+    Apply a batch of the write-behind queue in one transaction per shard, every write in its own savepoint,
+    so a failed write does not undo the others.
+    :param app: the application of the queue
+    :param writes: list of (kind, payload)
+    :return: list of (answer, HTTP code)
+    """
+    with app.app_context():
+        results, tags, by_shard = [None] * len(writes), [], {}
+        # The shards are located first and their writers taken in order, so concurrent writers can not deadlock
+        for index, (kind, payload) in enumerate(writes):
+            if (shard := write_shard(kind, payload)) is None:
+                results[index] = {"message": "Course with this id was not found"}, 404
+            else:
+                by_shard.setdefault(shard, []).append(index)
+        for shard in sorted(by_shard):
+            db = get_writer_db(shard)
+            for index in by_shard[shard]:
+                kind, payload = writes[index]
+                db.execute('SAVEPOINT operation')
+                answer, code, changed_tags = WRITES[kind](db, payload)
+                if code != 200:
+                    db.execute('ROLLBACK TO operation')
+                db.execute('RELEASE operation')
+                results[index] = answer, code
+                tags.extend(changed_tags)
+        commit_sessions([get_writer_db(shard) for shard in sorted(by_shard)])
+        get_cache().invalidate(*tags)
+        return results
+
+
+def coalesce_writes(kind, payload, next_kind, next_payload):
+    """
+    Merge the next write of a course into its write waiting in the write-behind queue:
+    updates are merged into one update and a delete replaces the updates.
+    The writes are merged only if the merged write fails exactly when one of them would fail applied in order:
+    a waiting update changing one date is checked against the stored date, so its result is known only
+    once it is applied, and so is the result of a next update changing one date after an update without dates.
+    :return: merged (kind, payload) or None if the writes can not be merged
+    """
+    if kind != 'change' or next_kind not in ('change', 'delete') or changed_dates(payload) == 1:
+        return None
+    if next_kind == 'delete':
+        return next_kind, next_payload
+    if changed_dates(payload) == 0 and changed_dates(next_payload) == 1:
+        return None
+    merged = {name: value if value is not None else payload[name] for name, value in next_payload.items()}
+    if merged['start_date'] and merged['end_date'] and merged['start_date'] >= merged['end_date']:
+        return None
+    return kind, merged
+
+
+def changed_dates(changes):
+    """
+    :param changes: dictionary of the UPDATE_COURSE_QUERY parameters
+    :return: number of the dates changed by a partial update
+    """
+    return (changes['start_date'] is not None) + (changes['end_date'] is not None)
+
+
+def get_write_queue():
+    """
+    Return the write-behind queue of the application, creating it on first use.
+    :return: WriteBehindQueue
+    """
+    if 'write_behind' not in current_app.extensions:
+        current_app.extensions['write_behind'] = WriteBehindQueue(
+            functools.partial(apply_writes, current_app._get_current_object()), coalesce_writes,
+            interval=current_app.config['WRITE_BEHIND_INTERVAL'], max_batch=current_app.config['WRITE_BEHIND_BATCH'])
+    return current_app.extensions['write_behind']
+
+
+def flush_writes(timeout=None):
+    """
+    Barrier: wait until the writes queued so far by the write-behind mode are committed.
+    :return: True if they are committed, False on timeout
+    """
+    if 'write_behind' not in current_app.extensions:
+        return True
+    return current_app.extensions['write_behind'].flush(timeout)
+
+
+def close_write_queue():
+    """
+    Commit the queued writes and stop the write-behind thread of the application.
+    :return: None
+    """
+    if queue := current_app.extensions.pop('write_behind', None):
+        queue.close()
 
 
 class AddCourse(Resource):
     def post(self):
         """
         Add a new course to the database.
+        A request with an Idempotency-Key header is applied once: a retry with the same key and course
+        in the next IDEMPOTENCY_KEY_TTL seconds gets the same answer (with the header Idempotent-Replayed)
+        without inserting the course again. These requests are written synchronously in the write-behind mode too.
         :parameter
         title (str) : course title
         start_date(str) : course start date in format YYYY-MM-DD
         end_date(str) : course end date in format YYYY-MM-DD
         lectures (int) : number of course lectures
-        :return: Successful result: Message and HTTP code 200.
-                    Otherwise: message about error and HTTP code 404.
+        :return: Successful result: Message and HTTP code 200 (or the operation and 202 in the write-behind mode).
+                    Otherwise: message about error and HTTP code 400,
+                    or 422 if the Idempotency-Key was used for another course.
         """
-        title = request.json['title']
-
         try:
-            start_date = date.strptime(request.json['start_date'], "%Y-%m-%d")
-            end_date = date.strptime(request.json['end_date'], "%Y-%m-%d")
-        except ValueError:
-            return {"message": "This is the incorrect date string format. It should be YYYY-MM-DD"}, 400
-        if start_date >= end_date:
-            return {"message": "The start_date is equal or greater than the end_date"}, 400
+            course = validate_course(request.json)
+        except CourseValidationError as error:
+            return {"message": str(error)}, 400
 
-        lectures = int(request.json['lectures'])
-        db_cursor = get_db().cursor()
-        db_cursor.execute(
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return write('add', course)
+
+        # The keys are kept by the shard 0, whatever the shard of the course: its writer serializes the requests
+        # with the same key. It is taken before the writer of the course, in the order of the shards.
+        keys_db = get_writer_db(0)
+        key = {"_key": hashlib.blake2b(key.encode(), digest_size=16).digest(),
+               "_request": hashlib.blake2b(json.dumps(course).encode(), digest_size=8).digest(),
+               "_now": int(time.time()), "_ttl": current_app.config['IDEMPOTENCY_KEY_TTL']}
+        used = keys_db.execute(
             """
-            INSERT INTO courses (title, start_date, end_date, lectures) 
-            VALUES (?, ?, ?, ?)
+            SELECT request
+            FROM idempotency_keys
+            WHERE key == :_key AND created > :_now - :_ttl
             """,
-            (title, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"), lectures)
+            key
+        ).fetchone()
+        if used is not None:
+            keys_db.rollback()
+            if used['request'] != key['_request']:
+                return {"message": "The Idempotency-Key was already used for another course"}, 422
+            return {"message": "Course added successfully"}, 200, {'Idempotent-Replayed': 'true'}
+
+        db = get_writer_db(get_router().shard_of(course[0], course[1]))
+        answer, code, tags = add_course(db, course)
+        keys_db.execute(
+            """
+            INSERT OR REPLACE INTO idempotency_keys (key, request, created)
+            VALUES (:_key, :_request, :_now)
+            """,
+            key
         )
-        get_db().commit()
+        keys_db.execute("DELETE FROM idempotency_keys WHERE created <= :_now - :_ttl", key)
+        commit_sessions([keys_db, db])
+        get_cache().invalidate(*tags)
+
+        return answer, code
+
+
+class AddCoursesBulk(Resource):
+    def post(self):
+        """
+        Add many courses to the database from a streamed request body.
+        The body is a NDJSON (application/x-ndjson) or CSV with a header row (text/csv),
+        every row has the same fields as /add-course. It is read line by line and inserted
+        in transactions of BULK_CHUNK_SIZE courses, invalid rows are skipped.
+        :return: Successful result: number of inserted courses, list of errors by line and HTTP code 200.
+                    Otherwise: message about error and HTTP code 415.
+        """
+        if request.mimetype == 'text/csv':
+            reader = read_csv
+        elif request.mimetype in ('application/x-ndjson', 'application/jsonlines'):
+            reader = read_ndjson
+        else:
+            return {"message": "The content type should be application/x-ndjson or text/csv"}, 415
+
+        lines = (line.decode('utf-8', errors='replace') for line in make_line_iter(request.stream))
+        inserted, errors = import_courses(get_writer_dbs(), reader(lines), current_app.config['BULK_CHUNK_SIZE'],
+                                          on_chunk=invalidate_inserted_courses, route=get_router().shard_of)
+        return {"inserted": inserted, "errors": errors}, 200
 
-        return {"message": "Course added successfully"}, 200
+
+def invalidate_inserted_courses(courses):
+    """
+    Invalidate the cached lookups that may include the inserted courses.
+    :param courses: list of inserted (title, start_date, end_date, lectures)
+    :return: None
+    """
+    get_cache().invalidate(('titles',), ('dates',), *{('title', course[0]) for course in courses})
 
 
 class CoursesList(Resource):
+    @conditional(get_catalog_version)
     def get(self):
         """
         Return list of all course titles
-        :return: 'titles': list of course titles and HTTP code 200.
+        :parameter (query string, all optional)
+        after_id (int) : return only courses with a greater id (keyset pagination)
+        limit (int) : maximal number of titles in the page (up to TITLES_PAGE_MAX_SIZE)
+        stream (str) : "json" or "ndjson" - stream all the titles after after_id without buffering them
+        :return: 'titles': list of course titles and HTTP code 200,
+                    with pagination also 'next_after_id': after_id of the next page or None on the last page.
+                    Otherwise: message about error and HTTP code 400.
         """
-        db_cursor = get_db().cursor()
-        db_cursor.execute(
+        try:
+            after_id = int(request.args.get('after_id', 0))
+            limit = int(request.args['limit']) if 'limit' in request.args else None
+        except ValueError:
+            return {"message": "The after_id and the limit should be integers"}, 400
+        stream = request.args.get('stream')
+
+        if stream in ('json', 'ndjson'):
+            pools = [get_pool(shard) for shard in range(len(get_router()))]
+            return Response(stream_titles(pools, after_id, stream, current_app.config['STREAM_FETCH_SIZE']),
+                            mimetype='application/x-ndjson' if stream == 'ndjson' else 'application/json')
+        if stream is not None:
+            return {"message": "The stream should be json or ndjson"}, 400
+
+        paginated = limit is not None or 'after_id' in request.args
+        if paginated:
+            if limit is not None and limit < 1:
+                return {"message": "The limit should be a positive integer"}, 400
+            limit = min(limit or current_app.config['TITLES_PAGE_MAX_SIZE'], current_app.config['TITLES_PAGE_MAX_SIZE'])
+
+        cache_key = versioned_key('titles', after_id, limit) if paginated else versioned_key('titles')
+        if result := get_cache().get(cache_key):
+            return result, 200
+
+        if not paginated:
+            rows = gather(
+                """
+                SELECT id, title
+                FROM courses
+                ORDER BY id
+                """)
+            result = {'titles': [item['title'] for item in merge_by_id(rows)]}
+            get_cache().set(cache_key, result, tags=[('titles',)])
+            return result, 200
+
+        rows = gather(
             """
-            SELECT title
+            SELECT id, title
             FROM courses
-            """)
-        result = [item['title'] for item in db_cursor.fetchall()]
-        return {'titles': result}, 200
+            WHERE id > :_after_id
+            ORDER BY id
+            LIMIT :_limit
+            """,
+            {"_after_id": after_id, "_limit": limit}
+        )
+        rows = list(itertools.islice(merge_by_id(rows), limit))
+        next_after_id = rows[-1]['id'] if len(rows) == limit else None
+        result = {'titles': [item['title'] for item in rows], 'next_after_id': next_after_id}
+        get_cache().set(cache_key, result, tags=[('titles',)])
+        return result, 200
+
+
+def stream_titles(pools, after_id, stream, fetch_size):
+    """
+    Generate the titles of courses with id greater than after_id, fetching `fetch_size` rows at a time.
+    The generator holds its own pooled connections, because it outlives the application context of the request.
+    :param pools: connection pools of the shards, their titles are merged by id
+    :param after_id: id after which the titles start
+    :param stream: "json" - chunks of a {"titles": [...]} document, "ndjson" - one JSON string per line
+    :param fetch_size: number of rows read from the database at a time
+    :return: generator of response chunks
+    """
+    connections = [pool.acquire() for pool in pools]
+    db_cursors = [db.cursor() for db in connections]
+    try:
+        for db_cursor in db_cursors:
+            db_cursor.execute(
+                """
+                SELECT id, title
+                FROM courses
+                WHERE id > :_after_id
+                ORDER BY id
+                """,
+                {"_after_id": after_id}
+            )
+        titles = merge_by_id(db_cursors)
+        separator = '' if stream == 'ndjson' else '{"titles": ['
+        for rows in iter(lambda: list(itertools.islice(titles, fetch_size)), []):
+            if stream == 'ndjson':
+                yield ''.join(json.dumps(item['title']) + '\n' for item in rows)
+            else:
+                yield separator + ', '.join(json.dumps(item['title']) for item in rows)
+                separator = ', '
+        if stream == 'json':
+            yield ']}' if separator == ', ' else '{"titles": []}'
+    finally:
+        for pool, db, db_cursor in zip(pools, connections, db_cursors):
+            db_cursor.close()
+            pool.release(db)
 
 
 class GetCourseById(Resource):
+    @conditional(get_course_version)
     def get(self):
         """
         Return a course with the specified id
@@ -125,66 +1184,286 @@ class GetCourseById(Resource):
         :return: Successful result: dict with an information about course and HTTP code 200.
                     Otherwise: message about error and HTTP code 404.
         """
-        db_cursor = get_db().cursor()
-        db_cursor.execute(
+        course_id = int(request.json["id"])
+        if result := get_cache().get(versioned_key('course', course_id)):
+            return result, 200
+
+        rows = gather(
             """
             SELECT * 
             FROM courses
             WHERE id == :_id
             """,
-            {"_id": int(request.json["id"])}
+            {"_id": course_id}
         )
 
-        if result := db_cursor.fetchone():
+        if result := next(itertools.chain.from_iterable(rows), None):
+            get_cache().set(versioned_key('course', course_id), result, tags=[('course', course_id)])
             return result, 200
 
         return {"message": "Course with this id was not found"}, 404
 
 
+class GetCoursesByIds(Resource):
+    @conditional(get_catalog_version)
+    def get(self):
+        """
+        Return the courses with the specified ids in one query
+        :parameter
+        ids (list of int) : optional, course unique ids
+        ranges (list of [int, int]) : optional, inclusive ranges of course ids
+        (up to BATCH_MAX_IDS ids in total)
+        :return: Successful result: 'courses': dict {id: course}, 'not_found': sorted list of the requested
+                    ids without a course and HTTP code 200.
+                    Otherwise: message about error and HTTP code 400.
+        """
+        message = {"message": "The ids should be a list of integers and the ranges a list of pairs of integers"}
+        body = request.json
+        if (not isinstance(body, dict) or not isinstance(body.get('ids', []), list)
+                or not isinstance(body.get('ranges', []), list)
+                or not all(isinstance(pair, list) for pair in body.get('ranges', []))):
+            return message, 400
+        try:
+            ids = {int(_id) for _id in body.get('ids', [])}
+            ranges = [(int(first), int(last)) for first, last in body.get('ranges', [])]
+        except (TypeError, ValueError):
+            return message, 400
+        if len(ids) + sum(max(last - first + 1, 0) for first, last in ranges) > current_app.config['BATCH_MAX_IDS']:
+            return {"message": f"No more than {current_app.config['BATCH_MAX_IDS']} ids can be requested"}, 400
+        for first, last in ranges:
+            ids.update(range(first, last + 1))
+
+        cache = get_cache()
+        courses, missing = {}, []
+        for _id in sorted(ids):
+            if (course := cache.get(versioned_key('courses', _id))) is not None:
+                courses[_id] = course
+            else:
+                missing.append(_id)
+
+        for chunk in chunked_parameters(missing, current_app.config['SQLITE_MAX_VARIABLES']):
+            rows = gather(
+                f"""
+                SELECT *
+                FROM courses
+                WHERE id IN ({', '.join('?' * len(chunk))})
+                """,
+                chunk
+            )
+            for course in itertools.chain.from_iterable(rows):
+                courses[course['id']] = course
+                cache.set(versioned_key('courses', course['id']), course, tags=[('course', course['id'])])
+
+        not_found = [_id for _id in missing if _id not in courses]
+        return {'courses': dict(sorted(courses.items())), 'not_found': not_found}, 200
+
+
+def chunked_parameters(values, max_variables, sizes=(16, 64, 256)):
+    """
+    Split the values of an "IN (?, ...)" query into chunks of at most `max_variables` values.
+    A short chunk is padded (with its last value) to the next size of `sizes`, so the queries
+    have only a few distinct texts and stay in the statement cache of the connection.
+    :return: generator of lists of values
+    """
+    for start in range(0, len(values), max_variables):
+        chunk = values[start:start + max_variables]
+        size = next((size for size in sizes if len(chunk) <= size <= max_variables), len(chunk))
+        yield chunk + chunk[-1:] * (size - len(chunk))
+
+
+# Conditions of the filter modes on the days of the courses_days R*Tree
+WINDOW_CONDITIONS = {
+    'inside': "courses_days.start_day >= :_start_day AND courses_days.end_day <= :_end_day",
+    'overlap': "courses_days.start_day <= :_end_day AND courses_days.end_day >= :_start_day",
+    'contains': "courses_days.start_day <= :_start_day AND courses_days.end_day >= :_end_day",
+}
+
+
 class GetFilteredCourses(Resource):
+    @conditional(get_catalog_version)
     def get(self):
         """
-        Return a course with the specified title and date range [start_date, end_date]
+        Return the courses with the specified title and a relation to the date range [start_date, end_date]
         :parameter
-        title (str) : course title
+        title (str) : optional, course title (without it the courses of all titles are returned)
         start_date(str) : start of date range in format YYYY-MM-DD
         end_date(str) : end of date range in format YYYY-MM-DD
+        mode (str) : optional, "inside" - courses inside the range (default),
+                     "overlap" - courses with at least one day in the range,
+                     "contains" - courses active during the whole range
         :return: Successful result: dictionaries with information about filtered courses and HTTP code 200.
-                    Otherwise: message about error and HTTP code 404.
+                    Otherwise: message about error and HTTP code 400.
         """
+        mode = request.json.get('mode', 'inside')
+        if mode not in WINDOW_CONDITIONS:
+            return {"message": "The mode should be inside, overlap or contains"}, 400
         try:
-            start_date = date.strptime(request.json['start_date'], "%Y-%m-%d")
-            end_date = date.strptime(request.json['end_date'], "%Y-%m-%d")
-        except ValueError:
+            start_date, start_day = parse_date(request.json['start_date'])
+            end_date, end_day = parse_date(request.json['end_date'])
+        except (TypeError, ValueError):
             return {"message": "This is the incorrect date string format. It should be YYYY-MM-DD"}, 400
 
-        if start_date >= end_date:
+        if mode == 'inside' and start_day >= end_day:
             return {"message": "The start_date is equal or greater than the end_date"}, 400
+        if start_day > end_day:
+            return {"message": "The start_date is greater than the end_date"}, 400
 
-        db_cursor = get_db().cursor()
-        db_cursor.execute(
-            """
-            SELECT id, start_date, end_date
-            FROM courses
-            WHERE title == :_title
-            """,
-            {"_title": request.json["title"]}
-        )
+        title = request.json.get("title")
+        cache_key = versioned_key('filter', mode, title, start_date, end_date)
+        if (result := get_cache().get(cache_key)) is not None:
+            return result, 200
 
-        courses_dates = {course['id']: (date.strptime(course['start_date'], "%Y-%m-%d"),
-                                        date.strptime(course['end_date'], "%Y-%m-%d"))
-                         for course in db_cursor.fetchall()}
+        if mode == 'inside' and title is not None:
+            # The courses of one title are found faster by courses_title_dates_idx
+            rows = gather(
+                """
+                SELECT *
+                FROM courses
+                WHERE title == :_title AND start_date >= :_start_date AND end_date <= :_end_date
+                """,
+                {"_title": title, "_start_date": start_date, "_end_date": end_date}
+            )
+        else:
+            rows = gather(
+                f"""
+                SELECT courses.*
+                FROM courses_days
+                JOIN courses ON courses.id == courses_days.id
+                WHERE {WINDOW_CONDITIONS[mode]} AND (:_title IS NULL OR courses.title == :_title)
+                """,
+                {"_title": title, "_start_day": start_day, "_end_day": end_day}
+            )
+        result = {item['id']: item for item in itertools.chain.from_iterable(rows)}
+        # A filter result depends on the courses it contains and on the courses of its title (or on all the dates)
+        tags = [('title', title) if title is not None else ('dates',), *(('course', _id) for _id in result)]
+        get_cache().set(cache_key, result, tags=tags)
+        return result, 200
 
-        accepted_courses_id = [str(_id) for _id, value in courses_dates.items()
-                               if value[0] >= start_date and value[1] <= end_date]
-        query = f"""
-            SELECT * 
+
+# Matches of /search-courses, the best ones first
+SEARCH_MATCHES = """
+    FROM courses_fts
+    JOIN courses ON courses.id == courses_fts.rowid
+    WHERE courses_fts MATCH :_match
+        AND (:_start_date IS NULL OR courses.start_date >= :_start_date)
+        AND (:_end_date IS NULL OR courses.end_date <= :_end_date)
+    ORDER BY courses_fts.rank
+    """
+
+
+class SearchCourses(Resource):
+    @conditional(get_catalog_version)
+    def get(self):
+        """
+        Full-text search of courses by title, the best matches first
+        :parameter
+        q (str) : words to search for in the title
+        prefix (bool) : optional, match the words as prefixes of title words (default true)
+        start_date(str) : optional, start of date range in format YYYY-MM-DD
+        end_date(str) : optional, end of date range in format YYYY-MM-DD
+        limit (int) : optional, page size (default SEARCH_PAGE_SIZE, up to TITLES_PAGE_MAX_SIZE)
+        offset (int) : optional, number of matches to skip
+        :return: Successful result: 'courses': list of matching courses, 'next_offset': offset of the next page
+                    or None on the last page and HTTP code 200.
+                    Otherwise: message about error and HTTP code 400.
+        """
+        words = re.findall(r'\w+', str(request.json.get('q', '')))
+        if not words:
+            return {"message": "The q should contain at least one word"}, 400
+        suffix = '*' if request.json.get('prefix', True) else ''
+        match = ' '.join(f'"{word}"{suffix}' for word in words)
+
+        try:
+            start_date, end_date = (parse_date(request.json[key])[0] if request.json.get(key) else None
+                                    for key in ('start_date', 'end_date'))
+        except (TypeError, ValueError):
+            return {"message": "This is the incorrect date string format. It should be YYYY-MM-DD"}, 400
+        try:
+            limit = min(int(request.json.get('limit', current_app.config['SEARCH_PAGE_SIZE'])),
+                        current_app.config['TITLES_PAGE_MAX_SIZE'])
+            offset = int(request.json.get('offset', 0))
+        except (TypeError, ValueError):
+            return {"message": "The limit and offset should be integers"}, 400
+        if limit < 1 or offset < 0:
+            return {"message": "The limit should be positive and the offset should not be negative"}, 400
+
+        parameters = {"_match": match, "_start_date": start_date, "_end_date": end_date,
+                      "_limit": limit, "_offset": offset}
+        if len(get_router()) == 1:
+            result = gather(f"SELECT courses.* {SEARCH_MATCHES} LIMIT :_limit OFFSET :_offset", parameters)[0]
+        else:
+            result = search_shards(parameters)
+        return {'courses': result, 'next_offset': offset + limit if len(result) == limit else None}, 200
+
+
+def search_shards(parameters):
+    """
+    Search all the shards: every shard ranks its first `offset + limit` matches, the page is cut from their merge
+    by rank and its courses are read by id. The ranks (bm25) of a shard are computed from its own courses only,
+    so the order across the shards is approximate.
+    :param parameters: parameters of the SEARCH_MATCHES query with _limit and _offset
+    :return: list of the courses of the page
+    """
+    ranked = gather(f"SELECT courses_fts.rank AS rank, courses.id AS id {SEARCH_MATCHES} LIMIT :_limit + :_offset",
+                    parameters)
+    page = [row['id'] for row in itertools.islice(heapq.merge(*ranked, key=itemgetter('rank')),
+                                                  parameters['_offset'], parameters['_offset'] + parameters['_limit'])]
+    courses = {}
+    for chunk in chunked_parameters(page, current_app.config['SQLITE_MAX_VARIABLES']):
+        rows = gather(f"SELECT * FROM courses WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+        courses.update((course['id'], course) for course in itertools.chain.from_iterable(rows))
+    # A course deleted since it was ranked is left out
+    return [courses[_id] for _id in page if _id in courses]
+
+
+class CourseStats(Resource):
+    @conditional(get_catalog_version)
+    def get(self):
+        """
+        Return aggregate statistics of the catalog, computed in SQL and cached per catalog version
+        :return: 'total': number of courses, lectures and average duration in days,
+                    'titles': the same statistics by title, 'months': number of courses starting in every month
+                    (YYYY-MM) and HTTP code 200.
+        """
+        if (result := get_cache().get(versioned_key('course-stats'))) is not None:
+            return result, 200
+
+        # The statistics of the shards are added up: sums, and the averages from the sums of days
+        titles = {}
+        rows = gather(
+            """
+            SELECT title, count(*) AS courses, coalesce(sum(lectures), 0) AS lectures,
+                sum(julianday(end_date) - julianday(start_date)) AS days
             FROM courses
-            WHERE id in ({', '.join(accepted_courses_id)})
+            GROUP BY title
+            """)
+        for item in itertools.chain.from_iterable(rows):
+            statistics = titles.setdefault(item['title'], {'courses': 0, 'lectures': 0, 'days': 0})
+            for name in statistics:
+                statistics[name] += item[name]
+        titles = {title: {'courses': item['courses'], 'lectures': item['lectures'],
+                          'average_days': item['days'] / item['courses']} for title, item in sorted(titles.items())}
+        months = {}
+        rows = gather(
             """
-        db_cursor.execute(query)
-        result = db_cursor.fetchall()
-        result = {item['id']: item for item in result}
+            SELECT substr(start_date, 1, 7) AS month, count(*) AS courses
+            FROM courses
+            GROUP BY month
+            """)
+        for item in itertools.chain.from_iterable(rows):
+            months[item['month']] = months.get(item['month'], 0) + item['courses']
+        months = dict(sorted(months.items()))
+
+        courses = sum(item['courses'] for item in titles.values())
+        total = {
+            'courses': courses,
+            'lectures': sum(item['lectures'] for item in titles.values()),
+            'average_days': sum(item['average_days'] * item['courses'] for item in titles.values()) / courses
+            if courses else None,
+        }
+        result = {'total': total, 'titles': titles, 'months': months}
+        # The key changes with every write, so the results of the old versions are never read again
+        get_cache().set(versioned_key('course-stats'), result)
         return result, 200
 
 
@@ -202,71 +1481,79 @@ class ChangeCourseAttributes(Resource):
         start_date(str) : course start date in format YYYY-MM-DD
         end_date(str) : course end date in format YYYY-MM-DD
         lectures (int) : number of course lectures
-        :return: Successful result: message and HTTP code 200.
-                    Otherwise: message about error and HTTP code 404.
+        :return: Successful result: message and HTTP code 200 (or the operation and 202 in the write-behind mode).
+                    Otherwise: message about error and HTTP code 400 or 404.
         """
-        db_cursor = get_db().cursor()
-        db_cursor.execute(
-            """
-            SELECT start_date, end_date
-            FROM courses
-            WHERE id == :_id
-            """,
-            {"_id": request.json["id"]}
-        )
-
-        dates = db_cursor.fetchone()
-        if not dates:
-            return {"message": "Course with this id was not found"}, 404
+        try:
+            changes = validate_course_changes(request.json)
+        except CourseValidationError as error:
+            return {"message": str(error)}, 400
+        return write('change', changes, key=('course', changes['id']))
 
-        if request.json.get('title'):
-            self.title = request.json.get('title')
 
-        if request.json.get('start_date'):
-            try:
-                self.start_date = date.strptime(request.json.get('start_date'), "%Y-%m-%d")
-            except ValueError:
-                return {"message": "This is the incorrect date string format. It should be YYYY-MM-DD"}, 400
+class ChangeCoursesAttributes(Resource):
+    def put(self):
+        """
+        Change attributes of many courses in one transaction: either all the changes are applied or none.
+        With several shards there is a transaction per shard, committed once all the changes are applied.
+        :parameter
+        courses (list) : partial updates with the parameters of /change-attributes (id is required)
+        :return: Successful result: number of changed courses and HTTP code 200.
+                    Otherwise: 'errors': list of {"index": position in courses, "message": reason}
+                    and HTTP code 400.
+        """
+        updates = request.json.get('courses') if isinstance(request.json, dict) else None
+        if not isinstance(updates, list):
+            return {"message": "The courses should be a list"}, 400
 
-        if request.json.get('end_date'):
+        changed, errors, by_shard = [], [], {}
+        for index, update in enumerate(updates):
             try:
-                self.end_date = date.strptime(request.json.get('end_date'), "%Y-%m-%d")
-            except ValueError:
-                return {"message": "This is the incorrect date string format. It should be YYYY-MM-DD"}, 400
-
-        if request.json.get('lectures'):
-            self.lectures = request.json.get('lectures')
-
-        if hasattr(self, 'start_date') and hasattr(self, 'end_date'):
-            if self.start_date > self.end_date:
-                return {"message": "The start_date is equal or greater than the end_date"}, 400
-
-            self.start_date = self.start_date.strftime("%Y-%m-%d")
-            self.end_date = self.end_date.strftime("%Y-%m-%d")
+                changes = validate_course_changes(update)
+                if (shard := locate_course(changes['id'])) is None:
+                    raise CourseValidationError("Course with this id was not found")
+            except CourseValidationError as error:
+                errors.append({"index": index, "message": str(error)})
+                continue
+            by_shard.setdefault(shard, []).append((index, changes))
 
-        elif hasattr(self, 'start_date'):
+        # The writers of the shards are taken in order, so concurrent bulk updates can not deadlock
+        for shard in sorted(by_shard):
+            for index, changes in by_shard[shard]:
+                try:
+                    if (course := update_course(get_writer_db(shard), changes)) is None:
+                        raise CourseValidationError("Course with this id was not found")
+                except CourseValidationError as error:
+                    errors.append({"index": index, "message": str(error)})
+                    continue
+                changed.append((course, changes))
+        errors.sort(key=itemgetter('index'))
 
-            if self.start_date >= date.strptime(dates['end_date'], "%Y-%m-%d"):
-                return {"message": "The start_date is equal or greater than the end_date"}, 400
+        sessions = [get_writer_db(shard) for shard in sorted(by_shard)]
+        if errors:
+            for session in sessions:
+                session.rollback()
+        else:
+            commit_sessions(sessions)
+        if errors:
+            return {"errors": errors}, 400
+        get_cache().invalidate(*(tag for course, changes in changed for tag in changed_course_tags(course, changes)))
+        return {"changed": len(changed)}, 200
 
-            self.start_date = self.start_date.strftime("%Y-%m-%d")
 
-        elif hasattr(self, 'end_date'):
-
-            if self.end_date <= date.strptime(dates['start_date'], "%Y-%m-%d"):
-                return {"message": "The end_date is equal or smaller than the start_date"}, 400
-
-            self.end_date = self.end_date.strftime("%Y-%m-%d")
-
-        query = f"""
-            UPDATE courses 
-            SET {' , '.join(f"{key} = '{str(val)}'" for (key, val) in self.__dict__.items())}
-            WHERE id == {request.json['id']}
-            """
-        db_cursor.execute(query)
-        get_db().commit()
-
-        return {'message': "Course attributes changed successfully"}, 200
+def changed_course_tags(course, changes):
+    """
+    Tags of the cached lookups that may include the changed course.
+    :param course: the course after the change
+    :param changes: dictionary of the changed attributes, None for the attributes that are not changed
+    :return: list of cache tags
+    """
+    changed_tags = [('course', course['id']), ('title', course['title'])]
+    if changes['title'] is not None:
+        changed_tags.append(('titles',))
+    if changes['start_date'] is not None or changes['end_date'] is not None:
+        changed_tags.append(('dates',))
+    return changed_tags
 
 
 class DeleteCourse(Resource):
@@ -275,43 +1562,99 @@ class DeleteCourse(Resource):
         Delete a course with the specified id
         :parameter
         id (int) : course unique id
-        :return: Successful result: message and HTTP code 200.
+        :return: Successful result: message and HTTP code 200 (or the operation and 202 in the write-behind mode).
                     Otherwise: message about error and HTTP code 404.
         """
-        course_id = request.json['id']
+        course_id = int(request.json['id'])
+        return write('delete', course_id, key=('course', course_id))
 
-        db_cursor = get_db().cursor()
-        db_cursor.execute(
-            """
-            SELECT * 
-            FROM courses
-            WHERE id == :_id 
-            """,
-            {'_id': course_id}
-        )
 
-        if not db_cursor.fetchone():
-            return {"message": "Course with this id was not found"}, 404
+class GetOperation(Resource):
+    def get(self):
+        """
+        Return the status of a write accepted by the write-behind mode.
+        The operations are known only by the worker process that accepted them.
+        :parameter
+        id (str) : operation id from the 202 answer
+        :return: Successful result: 'id', 'status' - pending, done or failed, with the 'code' and 'answer'
+                    of the write once it is applied and HTTP code 200.
+                    Otherwise: message about error and HTTP code 404.
+        """
+        queue = current_app.extensions.get('write_behind')
+        if queue is None or (operation := queue.get(str(request.json.get('id')))) is None:
+            return {"message": "Operation with this id was not found"}, 404
+        return operation.to_json(), 200
 
-        db_cursor.execute(
-            """
-            DELETE
-            FROM courses
-            WHERE id == :_id 
-            """,
-            {'_id': course_id}
-        )
-        get_db().commit()
 
-        return {'message': "Course deleted successfully"}, 200
+class CourseChanges(Resource):
+    def get(self):
+        """
+        Return the changes of the courses (inserts, updates and deletes) after a cursor, in order,
+        so the consumers can sync incrementally.
+        :parameter (query string, all optional)
+        since (str) : cursor of the last seen change, "0" - from the beginning of the log (default)
+        limit (int) : maximal number of changes (default CHANGES_PAGE_SIZE, up to TITLES_PAGE_MAX_SIZE)
+        wait (float) : long poll: seconds to wait for a change if there is none yet (up to CHANGES_MAX_WAIT)
+        With the header "Accept: text/event-stream" the changes are streamed as Server-Sent Events
+        for `wait` seconds (CHANGES_MAX_WAIT by default), a reconnecting client resumes after its Last-Event-ID.
+        :return: Successful result: 'changes': list of {'seq', 'operation', 'changed', 'course'},
+                    'next_since': cursor after them and HTTP code 200.
+                    Otherwise: message about error and HTTP code 400,
+                    or 410 if the changes after the cursor were compacted (sync again from "0").
+        """
+        streamed = request.accept_mimetypes.best == 'text/event-stream'
+        max_wait = current_app.config['CHANGES_MAX_WAIT']
+        try:
+            since = parse_cursor(request.headers.get('Last-Event-ID') or request.args.get('since', '0'),
+                                 len(get_router()))
+            limit = min(int(request.args.get('limit', current_app.config['CHANGES_PAGE_SIZE'])),
+                        current_app.config['TITLES_PAGE_MAX_SIZE'])
+            wait = min(float(request.args.get('wait', max_wait if streamed else 0)), max_wait)
+        except ValueError:
+            return {"message": "The since should be a cursor of the changes, the limit an integer "
+                               "and the wait a number"}, 400
+        if limit < 1 or not wait >= 0:
+            return {"message": "The limit should be positive and the wait should not be negative"}, 400
+        if is_compacted(get_dbs(), since):
+            return {"message": "The changes after this cursor were compacted, sync again from the cursor 0"}, 410
+
+        interval = current_app.config['CHANGES_POLL_INTERVAL']
+        if streamed:
+            pools = [get_pool(shard) for shard in range(len(get_router()))]
+            return Response(stream_changes(pools, since, limit, wait, interval), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache'})
+        changes = wait_for_changes(get_dbs(), since, limit, wait, interval)
+        return {'changes': [event for _, event in changes], 'next_since': format_cursor(advance(since, changes))}, 200
 
 
-api.add_resource(AddCourse, '/add-course', methods=['POST'])
-api.add_resource(CoursesList, '/get-titles-courses', methods=['GET'])
-api.add_resource(GetCourseById, '/get-course', methods=['GET'])
-api.add_resource(GetFilteredCourses, '/get-filtered-courses', methods=['GET'])
-api.add_resource(ChangeCourseAttributes, '/change-attributes', methods=['PUT'])
-api.add_resource(DeleteCourse, '/delete-course', methods=['DELETE'])
+class MetricsExport(Resource):
+    def get(self):
+        """
+        Return the request latencies, SQL statistics and cache counters of this worker
+        in the Prometheus text format.
+        :return: Response with the metrics and HTTP code 200.
+        """
+        return Response(get_metrics().render(get_cache().stats()), mimetype='text/plain; version=0.0.4')
+
+
+RESOURCES = (
+    (AddCourse, '/add-course', ['POST']),
+    (AddCoursesBulk, '/add-courses/bulk', ['POST']),
+    (CoursesList, '/get-titles-courses', ['GET']),
+    (GetCourseById, '/get-course', ['GET']),
+    (GetCoursesByIds, '/get-courses', ['GET']),
+    (GetFilteredCourses, '/get-filtered-courses', ['GET']),
+    (SearchCourses, '/search-courses', ['GET']),
+    (CourseStats, '/course-stats', ['GET']),
+    (ChangeCourseAttributes, '/change-attributes', ['PUT']),
+    (ChangeCoursesAttributes, '/change-attributes/bulk', ['PUT']),
+    (DeleteCourse, '/delete-course', ['DELETE']),
+    (GetOperation, '/get-operation', ['GET']),
+    (CourseChanges, '/changes', ['GET']),
+    (MetricsExport, '/metrics', ['GET']),
+)
+COMMANDS = (command_init_db, command_import_courses, command_export_courses, command_dedup_courses,
+            command_rebalance_shards, command_compact_changes, command_cache_server)
 
 if __name__ == '__main__':
-    flask_app.run(debug=True)
+    create_app().run(debug=True)
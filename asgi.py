@@ -0,0 +1,11 @@
+"""
+ASGI entry point: serves the routes of app.py from an event loop,
+running the handlers and their database calls in a dedicated thread pool.
+    uvicorn asgi:asgi_app
+"""
+from app import flask_app
+from utils.asgi import AsgiApp
+
+asgi_app = AsgiApp(flask_app.wsgi_app,
+                   threads=flask_app.config['ASGI_DB_THREADS'],
+                   max_concurrency=flask_app.config['ASGI_MAX_CONCURRENCY'])
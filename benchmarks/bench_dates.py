@@ -0,0 +1,64 @@
+"""
+Date validation of a bulk import: the strptime + strftime round trip the handlers used before
+against utils.dates.parse_date, with an empty cache (cold) and with the dates already cached (warm).
+Every repetition validates the start and end dates of all the generated courses.
+
+Usage:
+    python -m benchmarks.bench_dates [--rows 100000] [--repeat 10] [--output results.json]
+"""
+import argparse
+import time
+from datetime import datetime as date
+
+from benchmarks.catalog import generate_courses
+from benchmarks.report import summarize, write_report
+from utils.dates import parse_date
+
+
+def strptime_dates(dates):
+    for text in dates:
+        date.strptime(text, "%Y-%m-%d").strftime("%Y-%m-%d")
+
+
+def cold_dates(dates):
+    parse_date.cache_clear()
+    for text in dates:
+        parse_date(text)
+
+
+def warm_dates(dates):
+    for text in dates:
+        parse_date(text)
+
+
+SCENARIOS = {'strptime': strptime_dates, 'parse_date_cold': cold_dates, 'parse_date_warm': warm_dates}
+
+
+def run(scenario, dates, repeat):
+    """
+    Validate all the dates `repeat` times.
+    :return: dict of results, see benchmarks.report.summarize (a "request" is one pass over the dates)
+    """
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        pass_started = time.perf_counter()
+        scenario(dates)
+        latencies.append(time.perf_counter() - pass_started)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--output', help="path of the JSON results, stdout by default")
+    args = parser.parse_args()
+
+    dates = [text for _, start_date, end_date, _ in generate_courses(args.rows) for text in (start_date, end_date)]
+    results = {name: run(scenario, dates, args.repeat) for name, scenario in SCENARIOS.items()}
+    write_report('dates', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Micro-benchmarks of the REST handlers through the test client of create_app() on a synthetic catalog.
+The cache is disabled unless --cache is given, so that the handlers and their queries are measured.
+
+Usage:
+    python -m benchmarks.bench_endpoints [--rows 100000] [--titles 50] [--iterations 200] [--cache]
+                                         [--output results.json]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.catalog import create_catalog
+from benchmarks.report import summarize, write_report
+
+
+def scenarios(rows, titles):
+    """
+    :return: dict {scenario name: function(random generator) -> (method, path, json body)}
+    """
+    def course(rnd):
+        start = f"{rnd.randrange(2010, 2020)}-{rnd.randrange(1, 13):02}-{rnd.randrange(1, 29):02}"
+        return {"title": f"course{rnd.randrange(titles)}", "start_date": start,
+                "end_date": f"{int(start[:4]) + 1}{start[4:]}", "lectures": rnd.randrange(1, 50)}
+
+    return {
+        'add_course': lambda rnd: ('POST', '/add-course', course(rnd)),
+        'titles_page': lambda rnd: ('GET', f'/get-titles-courses?limit=100&after_id={rnd.randrange(rows)}', None),
+        'course_by_id': lambda rnd: ('GET', '/get-course', {"id": rnd.randrange(1, rows + 1)}),
+        'filtered_courses': lambda rnd: ('GET', '/get-filtered-courses', {
+            "title": f"course{rnd.randrange(titles)}", "start_date": "2014-01-01", "end_date": "2016-01-01"}),
+        'search_courses': lambda rnd: ('GET', '/search-courses', {"q": f"course{rnd.randrange(titles)}"}),
+        'change_attributes': lambda rnd: ('PUT', '/change-attributes', {
+            "id": rnd.randrange(1, rows + 1), "lectures": rnd.randrange(1, 50)}),
+    }
+
+
+def run(client, scenario, iterations, seed=0):
+    """
+    Call a scenario `iterations` times (after a short warm-up).
+    :return: dict of results, see benchmarks.report.summarize
+    """
+    rnd = random.Random(seed)
+    for _ in range(min(10, iterations)):
+        method, path, body = scenario(rnd)
+        client.open(path, method=method, json=body)
+
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for _ in range(iterations):
+        method, path, body = scenario(rnd)
+        request_started = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        latencies.append(time.perf_counter() - request_started)
+        errors += response.status_code not in (200, 404)
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--titles', type=int, default=50)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--cache', action='store_true', help="keep the application cache enabled")
+    parser.add_argument('--only', nargs='*', help="names of the scenarios to run")
+    parser.add_argument('--output', help="path of the JSON results, stdout by default")
+    args = parser.parse_args()
+
+    from app import create_app, close_pool
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'catalog.db')
+        create_catalog(database, args.rows, args.titles)
+        app = create_app({'DATABASE': database, 'CACHE_BACKEND': 'memory' if args.cache else None})
+        client = app.test_client()
+        for name, scenario in scenarios(args.rows, args.titles).items():
+            if not args.only or name in args.only:
+                results[name] = run(client, scenario, args.iterations)
+        with app.app_context():
+            close_pool()
+    write_report('endpoints', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
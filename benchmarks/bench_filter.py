@@ -0,0 +1,145 @@
+"""
+Benchmark of the GetFilteredCourses query: the old two-query + strptime path
+against the single indexed range query, and the overlap query of all titles:
+a scan comparing the date strings against the courses_days R*Tree.
+
+Usage:
+    python -m benchmarks.bench_filter [rows ...]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import timeit
+from datetime import datetime as date
+
+from benchmarks.catalog import SCHEMA_PATH, create_catalog
+from utils.db_utils import dict_factory
+
+DEFAULT_ROWS = (10_000, 100_000, 1_000_000)
+TITLES = 50
+REPEAT = 5
+
+
+def fill_database(path, rows, with_index):
+    """
+    Create a database with `rows` random courses spread over `TITLES` titles.
+    :return: Connection - SQLite database connection object
+    """
+    with open(SCHEMA_PATH) as f:
+        script = f.read()
+    if not with_index:
+        script = script[:script.index('CREATE INDEX')]
+    create_catalog(path, rows, TITLES, seed=rows, schema=script)
+    db = sqlite3.connect(path)
+    db.row_factory = dict_factory
+    return db
+
+
+def legacy_filter(db, title, start_date, end_date):
+    """Filter as GetFilteredCourses did before: fetch by title, compare dates in Python, re-select by id."""
+    db_cursor = db.cursor()
+    db_cursor.execute("SELECT id, start_date, end_date FROM courses WHERE title == :_title", {"_title": title})
+    courses_dates = {course['id']: (date.strptime(course['start_date'], "%Y-%m-%d"),
+                                    date.strptime(course['end_date'], "%Y-%m-%d"))
+                     for course in db_cursor.fetchall()}
+    accepted_courses_id = [str(_id) for _id, value in courses_dates.items()
+                           if value[0] >= start_date and value[1] <= end_date]
+    db_cursor.execute(f"SELECT * FROM courses WHERE id in ({', '.join(accepted_courses_id)})")
+    return {item['id']: item for item in db_cursor.fetchall()}
+
+
+def indexed_filter(db, title, start_date, end_date):
+    """Filter as GetFilteredCourses does now: one range query served by courses_title_dates_idx."""
+    db_cursor = db.cursor()
+    db_cursor.execute(
+        """
+        SELECT *
+        FROM courses
+        WHERE title == :_title AND start_date >= :_start_date AND end_date <= :_end_date
+        """,
+        {"_title": title, "_start_date": start_date.strftime("%Y-%m-%d"), "_end_date": end_date.strftime("%Y-%m-%d")}
+    )
+    return {item['id']: item for item in db_cursor.fetchall()}
+
+
+# Conditions of the modes of GetFilteredCourses on the dates and on the days of the courses_days R*Tree
+SCAN_CONDITIONS = {
+    'overlap': "start_date <= :_end_date AND end_date >= :_start_date",
+    'contains': "start_date <= :_start_date AND end_date >= :_end_date",
+}
+RTREE_CONDITIONS = {
+    'overlap': "courses_days.start_day <= :_end_day AND courses_days.end_day >= :_start_day",
+    'contains': "courses_days.start_day <= :_start_day AND courses_days.end_day >= :_end_day",
+}
+WINDOWS = {
+    'overlap': (date(2015, 6, 1), date(2015, 6, 7)),
+    'contains': (date(2015, 1, 1), date(2016, 6, 1)),
+}
+
+
+def scan_window(db, mode, start_date, end_date):
+    """Courses of all titles in the relation `mode` to the window, found by comparing the dates of every course."""
+    db_cursor = db.cursor()
+    db_cursor.execute(
+        f"""
+        SELECT *
+        FROM courses
+        WHERE {SCAN_CONDITIONS[mode]}
+        """,
+        {"_start_date": start_date.strftime("%Y-%m-%d"), "_end_date": end_date.strftime("%Y-%m-%d")}
+    )
+    return {item['id']: item for item in db_cursor.fetchall()}
+
+
+def rtree_window(db, mode, start_date, end_date):
+    """Courses of all titles in the relation `mode` to the window, as GetFilteredCourses finds them."""
+    epoch = date(1970, 1, 1)
+    db_cursor = db.cursor()
+    db_cursor.execute(
+        f"""
+        SELECT courses.*
+        FROM courses_days
+        JOIN courses ON courses.id == courses_days.id
+        WHERE {RTREE_CONDITIONS[mode]}
+        """,
+        {"_start_day": (start_date - epoch).days, "_end_day": (end_date - epoch).days}
+    )
+    return {item['id']: item for item in db_cursor.fetchall()}
+
+
+def run(rows):
+    start_date, end_date = date(2014, 1, 1), date(2016, 1, 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_db = fill_database(os.path.join(tmp, 'legacy.db'), rows, with_index=False)
+        indexed_db = fill_database(os.path.join(tmp, 'indexed.db'), rows, with_index=True)
+
+        assert legacy_filter(legacy_db, "course1", start_date, end_date) == \
+            indexed_filter(indexed_db, "course1", start_date, end_date)
+
+        legacy = min(timeit.repeat(lambda: legacy_filter(legacy_db, "course1", start_date, end_date),
+                                   number=1, repeat=REPEAT))
+        indexed = min(timeit.repeat(lambda: indexed_filter(indexed_db, "course1", start_date, end_date),
+                                    number=1, repeat=REPEAT))
+
+        windows = {}
+        for mode, (window_start, window_end) in WINDOWS.items():
+            result = rtree_window(indexed_db, mode, window_start, window_end)
+            assert scan_window(indexed_db, mode, window_start, window_end) == result
+            scan = min(timeit.repeat(lambda: scan_window(indexed_db, mode, window_start, window_end),
+                                     number=1, repeat=REPEAT))
+            rtree = min(timeit.repeat(lambda: rtree_window(indexed_db, mode, window_start, window_end),
+                                      number=1, repeat=REPEAT))
+            windows[mode] = len(result), scan, rtree
+        legacy_db.close()
+        indexed_db.close()
+    print(f"{rows:>9} rows: legacy {legacy * 1000:8.2f} ms, indexed {indexed * 1000:8.2f} ms, "
+          f"speedup x{legacy / indexed:.1f}")
+    for mode, (found, scan, rtree) in windows.items():
+        print(f"{rows:>9} rows: {mode:>8} ({found} courses) scan {scan * 1000:8.2f} ms, "
+              f"R*Tree {rtree * 1000:8.2f} ms, speedup x{scan / rtree:.1f}")
+
+
+if __name__ == '__main__':
+    for count in [int(arg) for arg in sys.argv[1:]] or DEFAULT_ROWS:
+        run(count)
@@ -0,0 +1,83 @@
+"""
+Cold start of a worker on a synthetic catalog, measured in fresh processes:
+    import    - python -c "import app"
+    create    - import and create_app()
+    first     - import, create_app() and the first request (connections opened on first use)
+    preforked - a worker forked from a master process that preloaded the application, until its first answer
+
+Usage:
+    python -m benchmarks.bench_startup [--rows 10000] [--repeat 20] [--output results.json]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.catalog import ROOT, create_catalog
+from benchmarks.report import summarize, write_report
+
+STEPS = {
+    'import': "import app",
+    'create': "import app; app.create_app({'DATABASE': sys.argv[1]})",
+    'first': "import app; app.create_app({'DATABASE': sys.argv[1]}).test_client().get('/get-course', json={'id': 1})",
+}
+
+
+def run_fresh(step, database, repeat):
+    """
+    Start `repeat` interpreters running a step.
+    :return: dict of results, see benchmarks.report.summarize
+    """
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        process_started = time.perf_counter()
+        errors += subprocess.run([sys.executable, '-c', f"import sys; {STEPS[step]}", database],
+                                 cwd=ROOT).returncode != 0
+        latencies.append(time.perf_counter() - process_started)
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+
+def run_preforked(database, repeat):
+    """
+    Fork `repeat` workers from this process after creating the application once,
+    every worker answers one request and exits.
+    :return: dict of results, see benchmarks.report.summarize
+    """
+    sys.path.insert(0, ROOT)
+    from app import create_app
+
+    app = create_app({'DATABASE': database})
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        process_started = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            status = app.test_client().get('/get-course', json={'id': 1}).status_code
+            os._exit(0 if status == 200 else 1)
+        errors += os.waitpid(pid, 0)[1] != 0
+        latencies.append(time.perf_counter() - process_started)
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10_000)
+    parser.add_argument('--titles', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', help="path of the JSON results, stdout by default")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'catalog.db')
+        create_catalog(database, args.rows, args.titles)
+        results = {step: run_fresh(step, database, args.repeat) for step in STEPS}
+        results['preforked'] = run_preforked(database, args.repeat)
+    write_report('startup', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Synthetic course catalog generator.
+
+Usage:
+    python -m benchmarks.catalog <database path> [--rows 100000] [--titles 50] [--seed 0]
+"""
+import argparse
+import os
+import random
+import sqlite3
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHEMA_PATH = os.path.join(ROOT, 'schema.sql')
+FIRST_DAY = date(2010, 1, 1)
+
+
+def generate_courses(rows, titles=50, seed=0):
+    """
+    Generate random courses: titles "course<n>" with n < `titles`, start dates over ten years
+    and durations up to two years.
+    :return: generator of (title, start_date, end_date, lectures)
+    """
+    rnd = random.Random(seed)
+    for _ in range(rows):
+        start = FIRST_DAY + timedelta(days=rnd.randrange(3650))
+        end = start + timedelta(days=rnd.randrange(1, 700))
+        yield f"course{rnd.randrange(titles)}", start.isoformat(), end.isoformat(), rnd.randrange(1, 50)
+
+
+def create_catalog(path, rows, titles=50, seed=0, schema=None):
+    """
+    Create a database with the application schema filled with generated courses.
+    :param path: path of the database file
+    :param schema: SQL script creating the schema, schema.sql by default
+    :return: None
+    """
+    if schema is None:
+        with open(SCHEMA_PATH) as f:
+            schema = f.read()
+    db = sqlite3.connect(path)
+    db.executescript(schema)
+    db.executemany("INSERT INTO courses (title, start_date, end_date, lectures) VALUES (?, ?, ?, ?)",
+                   generate_courses(rows, titles, seed))
+    db.commit()
+    db.close()
+
+
+def write_settings(path, database):
+    """
+    Write an application settings file (see COURSE_CATALOG_SETTINGS) pointing to the database.
+    :return: None
+    """
+    with open(path, 'w') as f:
+        f.write(f"DATABASE = {database!r}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--titles', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    create_catalog(args.path, args.rows, args.titles, args.seed)
+
+
+if __name__ == '__main__':
+    main()
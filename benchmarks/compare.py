@@ -0,0 +1,29 @@
+"""
+Compare two JSON reports of the same benchmark.
+
+Usage:
+    python -m benchmarks.compare <baseline.json> <candidate.json>
+"""
+import json
+import sys
+
+METRICS = ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms')
+
+
+def compare(baseline, candidate):
+    """
+    :return: list of lines "<scenario> <metric>: <baseline> -> <candidate> (<change in %>)"
+    """
+    lines = []
+    for scenario, result in candidate['results'].items():
+        base = baseline['results'].get(scenario, {})
+        for metric in METRICS:
+            if base.get(metric) and result.get(metric) is not None:
+                change = (result[metric] - base[metric]) / base[metric] * 100
+                lines.append(f"{scenario} {metric}: {base[metric]} -> {result[metric]} ({change:+.1f}%)")
+    return lines
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as f1, open(sys.argv[2]) as f2:
+        print('\n'.join(compare(json.load(f1), json.load(f2))))
@@ -0,0 +1,163 @@
+"""
+Multi-process HTTP load driver against a locally started server.
+Every process runs `--clients` concurrent keep-alive clients, the latencies of all processes are merged.
+
+Usage:
+    python -m benchmarks.load [--mode wsgi|asgi] [--processes 4] [--clients 100] [--requests 50]
+                              [--rows 100000] [--request 'GET /get-course {"id": 1}' ...] [--output results.json]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.catalog import ROOT, create_catalog, write_settings
+from benchmarks.report import summarize, write_report
+
+SERVERS = {
+    'wsgi': lambda port: [sys.executable, '-m', 'flask', 'run', '--port', str(port), '--with-threads'],
+    'asgi': lambda port: [sys.executable, '-m', 'uvicorn', 'asgi:asgi_app', '--port', str(port),
+                          '--log-level', 'warning', '--backlog', '4096'],
+}
+DEFAULT_REQUESTS = ('GET /get-titles-courses?limit=50',)
+
+
+def build_request(host, spec):
+    """
+    :param spec: "METHOD PATH [JSON BODY]"
+    :return: bytes of the HTTP/1.1 request
+    """
+    method, path, *body = spec.split(' ', 2)
+    body = body[0].encode() if body else b''
+    headers = f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nConnection: keep-alive\r\n"
+    if body:
+        headers += f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+    return headers.encode() + b'\r\n' + body
+
+
+async def client(host, port, requests, count, latencies, errors):
+    """
+    One client sending `count` requests (cycling over `requests`) one after another,
+    on a keep-alive connection if the server supports it (reconnecting otherwise).
+    """
+    writer = None
+    try:
+        for index in range(count):
+            started = time.perf_counter()
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(requests[index % len(requests)])
+            await writer.drain()
+            headers = (await reader.readuntil(b'\r\n\r\n')).lower()
+            length = next(int(line.split(b':')[1]) for line in headers.split(b'\r\n')
+                          if line.startswith(b'content-length'))
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+            if headers[9:12] not in (b'200', b'404'):
+                errors.append(1)
+            if headers.startswith(b'http/1.0') or b'connection: close' in headers:
+                writer.close()
+                writer = None
+    except (OSError, asyncio.IncompleteReadError, StopIteration):
+        errors.append(1)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def drive(host, port, specs, clients, count):
+    """
+    Run `clients` concurrent clients in the current process.
+    :return: tuple (latencies, number of errors, start time, end time)
+    """
+    requests = [build_request(host, spec) for spec in specs]
+    latencies, errors = [], []
+    started = time.time()
+    await asyncio.gather(*(client(host, port, requests, count, latencies, errors) for _ in range(clients)))
+    return latencies, len(errors), started, time.time()
+
+
+def _drive_process(arguments):
+    return asyncio.run(drive(*arguments))
+
+
+def run_load(host, port, specs, processes, clients, count):
+    """
+    Run `processes` driver processes with `clients` clients each and merge their results.
+    :return: dict of results, see benchmarks.report.summarize
+    """
+    with multiprocessing.Pool(processes) as pool:
+        runs = pool.map(_drive_process, [(host, port, specs, clients, count)] * processes)
+    latencies = [latency for run in runs for latency in run[0]]
+    elapsed = max(run[3] for run in runs) - min(run[2] for run in runs)
+    return summarize(latencies, elapsed, sum(run[1] for run in runs))
+
+
+def wait_for_port(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"The server did not start on port {port}")
+
+
+@contextlib.contextmanager
+def server(mode, port, settings):
+    """
+    Start the application in the given serving mode with a settings file (see COURSE_CATALOG_SETTINGS).
+    """
+    env = dict(os.environ, FLASK_APP='app.py', COURSE_CATALOG_SETTINGS=settings)
+    process = subprocess.Popen(SERVERS[mode](port), cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port('127.0.0.1', port)
+        yield
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@contextlib.contextmanager
+def catalog_settings(rows, titles):
+    """
+    Create a temporary generated catalog.
+    :return: path of the settings file pointing to it
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        create_catalog(os.path.join(tmp, 'catalog.db'), rows, titles)
+        write_settings(os.path.join(tmp, 'settings.py'), os.path.join(tmp, 'catalog.db'))
+        yield os.path.join(tmp, 'settings.py')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=SERVERS, default='wsgi')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=100, help="concurrent clients per process")
+    parser.add_argument('--requests', type=int, default=50, help="requests per client")
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--titles', type=int, default=50)
+    parser.add_argument('--request', action='append', dest='specs',
+                        help="request as 'METHOD PATH [JSON BODY]', can be repeated")
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--output', help="path of the JSON results, stdout by default")
+    args = parser.parse_args()
+    args.specs = args.specs or list(DEFAULT_REQUESTS)
+
+    with catalog_settings(args.rows, args.titles) as settings, server(args.mode, args.port, settings):
+        result = run_load('127.0.0.1', args.port, args.specs, args.processes, args.clients, args.requests)
+    write_report('load', vars(args), {args.mode: result}, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Load test of the WSGI (flask run --with-threads) and ASGI (uvicorn asgi:asgi_app) serving modes.
+Both servers are started on the same temporary catalog and hit by the same concurrent keep-alive clients.
+The ASGI mode needs uvicorn to be installed, it is skipped otherwise.
+
+Usage:
+    python -m benchmarks.load_compare [--clients 1000] [--processes 4] [--requests 20] [--rows 10000]
+                                      [--output results.json]
+"""
+import argparse
+import importlib.util
+
+from benchmarks.load import DEFAULT_REQUESTS, SERVERS, catalog_settings, run_load, server
+from benchmarks.report import write_report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000, help="concurrent clients in total")
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=20, help="requests per client")
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--titles', type=int, default=50)
+    parser.add_argument('--request', action='append', dest='specs',
+                        help="request as 'METHOD PATH [JSON BODY]', can be repeated")
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--output', help="path of the JSON results, stdout by default")
+    args = parser.parse_args()
+    args.specs = args.specs or list(DEFAULT_REQUESTS)
+
+    results = {}
+    with catalog_settings(args.rows, args.titles) as settings:
+        for offset, mode in enumerate(SERVERS):
+            if mode == 'asgi' and importlib.util.find_spec('uvicorn') is None:
+                results[mode] = {'skipped': "uvicorn is not installed"}
+                continue
+            with server(mode, args.port + offset, settings):
+                results[mode] = run_load('127.0.0.1', args.port + offset, args.specs, args.processes,
+                                         args.clients // args.processes, args.requests)
+    write_report('serving modes', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import json
+import platform
+import sqlite3
+import subprocess
+import sys
+import time
+
+from benchmarks.catalog import ROOT
+
+
+def summarize(latencies, elapsed, errors=0):
+    """
+    :param latencies: list of request latencies in seconds
+    :param elapsed: duration of the whole run in seconds
+    :param errors: number of failed requests or connections
+    :return: dict with the number of requests, throughput, latency percentiles in ms and errors
+    """
+    latencies = sorted(latencies)
+
+    def percentile(q):
+        return round(latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000, 3) if latencies else None
+
+    return {'requests': len(latencies), 'seconds': round(elapsed, 3),
+            'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'p50_ms': percentile(0.5), 'p95_ms': percentile(0.95), 'p99_ms': percentile(0.99), 'errors': errors}
+
+
+def environment():
+    """
+    :return: dict describing the run: time, commit, python, sqlite and platform versions
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'commit': commit, 'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version, 'platform': platform.platform()}
+
+
+def write_report(name, parameters, results, output=None):
+    """
+    Write the results of a benchmark as a JSON document.
+    :param name: name of the benchmark
+    :param parameters: dict of the benchmark parameters
+    :param results: dict of results by scenario
+    :param output: path of the JSON file, stdout if None
+    :return: None
+    """
+    report = {'benchmark': name, 'environment': environment(), 'parameters': parameters, 'results': results}
+    if output is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
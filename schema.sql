@@ -1,7 +1,141 @@
-CREATE TABLE courses (
+CREATE TABLE IF NOT EXISTS courses (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     title TEXT not null,
     start_date TEXT not null,
     end_date TEXT not null,
-    lectures INTEGER not null
-);
\ No newline at end of file
+    lectures INTEGER not null,
+    CHECK (start_date < end_date)
+);
+
+-- The same rule for databases created before the CHECK constraint (SQLite can not add it to an existing table)
+CREATE TRIGGER IF NOT EXISTS courses_dates_order_insert BEFORE INSERT ON courses
+WHEN NEW.start_date >= NEW.end_date BEGIN
+    SELECT RAISE(ABORT, 'The start_date is equal or greater than the end_date');
+END;
+
+-- The update triggers fire only when their columns really change: UPDATE_COURSE_QUERY sets every column.
+-- They are recreated, so the databases created with the older triggers get the conditions too
+DROP TRIGGER IF EXISTS courses_dates_order_update;
+CREATE TRIGGER courses_dates_order_update BEFORE UPDATE OF start_date, end_date ON courses
+WHEN (OLD.start_date IS NOT NEW.start_date OR OLD.end_date IS NOT NEW.end_date)
+    AND NEW.start_date >= NEW.end_date BEGIN
+    SELECT RAISE(ABORT, 'The start_date is equal or greater than the end_date');
+END;
+
+CREATE INDEX IF NOT EXISTS courses_title_dates_idx ON courses (title, start_date, end_date);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS courses_fts USING fts5(
+    title,
+    content = 'courses',
+    content_rowid = 'id',
+    prefix = '2 3'
+);
+
+CREATE TRIGGER IF NOT EXISTS courses_fts_insert AFTER INSERT ON courses BEGIN
+    INSERT INTO courses_fts (rowid, title) VALUES (NEW.id, NEW.title);
+END;
+
+CREATE TRIGGER IF NOT EXISTS courses_fts_delete AFTER DELETE ON courses BEGIN
+    INSERT INTO courses_fts (courses_fts, rowid, title) VALUES ('delete', OLD.id, OLD.title);
+END;
+
+DROP TRIGGER IF EXISTS courses_fts_update;
+CREATE TRIGGER courses_fts_update AFTER UPDATE OF title ON courses
+WHEN OLD.title IS NOT NEW.title BEGIN
+    INSERT INTO courses_fts (courses_fts, rowid, title) VALUES ('delete', OLD.id, OLD.title);
+    INSERT INTO courses_fts (rowid, title) VALUES (NEW.id, NEW.title);
+END;
+
+-- Days of the courses (days since 1970-01-01) in an R*Tree, for the overlap and containment queries of date windows
+CREATE VIRTUAL TABLE IF NOT EXISTS courses_days USING rtree_i32(id, start_day, end_day);
+
+CREATE TRIGGER IF NOT EXISTS courses_days_insert AFTER INSERT ON courses BEGIN
+    INSERT INTO courses_days (id, start_day, end_day)
+    VALUES (NEW.id, julianday(NEW.start_date) - 2440587.5, julianday(NEW.end_date) - 2440587.5);
+END;
+
+CREATE TRIGGER IF NOT EXISTS courses_days_delete AFTER DELETE ON courses BEGIN
+    DELETE FROM courses_days WHERE id = OLD.id;
+END;
+
+DROP TRIGGER IF EXISTS courses_days_update;
+CREATE TRIGGER courses_days_update AFTER UPDATE OF start_date, end_date ON courses
+WHEN OLD.start_date IS NOT NEW.start_date OR OLD.end_date IS NOT NEW.end_date BEGIN
+    UPDATE courses_days
+    SET start_day = julianday(NEW.start_date) - 2440587.5, end_day = julianday(NEW.end_date) - 2440587.5
+    WHERE id = NEW.id;
+END;
+
+-- Versions of the catalog and of every course, they change with every write of the courses
+CREATE TABLE IF NOT EXISTS catalog_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
+);
+
+INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0);
+
+CREATE TABLE IF NOT EXISTS course_versions (
+    course_id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS catalog_version_insert AFTER INSERT ON courses BEGIN
+    UPDATE catalog_version SET version = version + 1;
+    INSERT OR REPLACE INTO course_versions (course_id, version) SELECT NEW.id, version FROM catalog_version;
+END;
+
+CREATE TRIGGER IF NOT EXISTS catalog_version_update AFTER UPDATE ON courses BEGIN
+    UPDATE catalog_version SET version = version + 1;
+    INSERT OR REPLACE INTO course_versions (course_id, version) SELECT NEW.id, version FROM catalog_version;
+END;
+
+CREATE TRIGGER IF NOT EXISTS catalog_version_delete AFTER DELETE ON courses BEGIN
+    UPDATE catalog_version SET version = version + 1;
+    INSERT OR REPLACE INTO course_versions (course_id, version) SELECT OLD.id, version FROM catalog_version;
+END;
+
+-- Idempotency-Key of the inserted courses: blake2b digests of the key and of the course, time of the insert
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key BLOB PRIMARY KEY,
+    request BLOB NOT NULL,
+    created INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idempotency_keys_created_idx ON idempotency_keys (created);
+
+-- Change log of the courses for the consumers of /changes: the course after every insert and update,
+-- its id after a delete, in the order of the seq (never reused) and the time in milliseconds of the change
+CREATE TABLE IF NOT EXISTS course_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    course_id INTEGER NOT NULL,
+    operation TEXT NOT NULL,
+    title TEXT,
+    start_date TEXT,
+    end_date TEXT,
+    lectures INTEGER,
+    changed INTEGER NOT NULL DEFAULT (CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER))
+);
+
+CREATE TRIGGER IF NOT EXISTS course_changes_insert AFTER INSERT ON courses BEGIN
+    INSERT INTO course_changes (course_id, operation, title, start_date, end_date, lectures)
+    VALUES (NEW.id, 'insert', NEW.title, NEW.start_date, NEW.end_date, NEW.lectures);
+END;
+
+CREATE TRIGGER IF NOT EXISTS course_changes_update AFTER UPDATE ON courses
+WHEN OLD.title IS NOT NEW.title OR OLD.start_date IS NOT NEW.start_date OR OLD.end_date IS NOT NEW.end_date
+    OR OLD.lectures IS NOT NEW.lectures BEGIN
+    INSERT INTO course_changes (course_id, operation, title, start_date, end_date, lectures)
+    VALUES (NEW.id, 'update', NEW.title, NEW.start_date, NEW.end_date, NEW.lectures);
+END;
+
+CREATE TRIGGER IF NOT EXISTS course_changes_delete AFTER DELETE ON courses BEGIN
+    INSERT INTO course_changes (course_id, operation) VALUES (OLD.id, 'delete');
+END;
+
+-- The changes up to this seq are compacted by `flask compact_changes`
+CREATE TABLE IF NOT EXISTS course_changes_compacted (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    seq INTEGER NOT NULL
+);
+
+INSERT OR IGNORE INTO course_changes_compacted (id, seq) VALUES (1, 0);
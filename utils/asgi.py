@@ -0,0 +1,164 @@
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsgiInput:
+    """
+    Blocking WSGI input stream over the ASGI receive channel, read from a worker thread.
+    The request body is pulled from the event loop chunk by chunk, so it is never buffered whole.
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        self._more_body = True
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message['type'] == 'http.disconnect':
+            self._more_body = False
+            return
+        self._buffer += message.get('body', b'')
+        self._more_body = message.get('more_body', False)
+
+    def read(self, size=-1):
+        while self._more_body and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self, size=-1):
+        while self._more_body and b'\n' not in self._buffer and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        data = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+class AsgiApp:
+    """
+    ASGI application serving a WSGI application (the Flask application).
+    The blocking handlers, with their SQLite calls, run in a dedicated thread pool of `threads` threads,
+    so the event loop only shuffles bytes. At most `max_concurrency` requests are handled at once,
+    the others wait on the event loop without holding a thread.
+    """
+
+    def __init__(self, wsgi_app, threads=32, max_concurrency=64):
+        self.wsgi_app = wsgi_app
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='db')
+        self._limiter = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']}")
+
+        if self._limiter is None:
+            self._limiter = asyncio.Semaphore(self.max_concurrency)
+        loop = asyncio.get_running_loop()
+        async with self._limiter:
+            environ = build_environ(scope, AsgiInput(receive, loop))
+            status, headers, body = await loop.run_in_executor(self.executor, self._start, environ)
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            try:
+                while (chunk := await loop.run_in_executor(self.executor, next, body, None)) is not None:
+                    if chunk:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            finally:
+                if hasattr(body, 'close'):
+                    await loop.run_in_executor(self.executor, body.close)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    def _start(self, environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+            return response.setdefault('written', []).append
+
+        body = self.wsgi_app(environ, start_response)
+        iterator = iter(body)
+        # start_response may be deferred until the first chunk of a generator
+        first = next(iterator, None) if 'status' not in response else None
+        chunks = [*response.get('written', ()), *([first] if first is not None else [])]
+        return response['status'], response['headers'], _ClosingIterator(chunks, iterator, body)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+class _ClosingIterator:
+    """Iterator over the already produced chunks and then the rest of a WSGI body, closing the body at the end."""
+
+    def __init__(self, chunks, iterator, body):
+        self._chunks = iter(chunks)
+        self._iterator = iterator
+        self._body = body
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks, None) or next(self._iterator)
+
+    def close(self):
+        if hasattr(self._body, 'close'):
+            self._body.close()
+
+
+def build_environ(scope, wsgi_input):
+    """
+    Build the WSGI environ of an ASGI HTTP request (PEP 3333).
+    :param scope: ASGI HTTP connection scope
+    :param wsgi_input: stream of the request body
+    :return: dict - WSGI environ
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': wsgi_input,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope.get('headers', ()):
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
@@ -0,0 +1,117 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    In-process cache with size-bounded LRU eviction and a time to live for every entry.
+    Entries are tagged, so writes can invalidate exactly the entries that depend on a changed course.
+    None is not a valid value: get() returns None on a miss.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        """
+        :param maxsize: maximum number of entries, the least recently used entry is evicted first
+        :param ttl: number of seconds an entry stays valid
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: hashable key of the entry
+        :return: the cached value or None if there is no valid entry
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, tags=()):
+        """
+        :param key: hashable key of the entry
+        :param value: value to cache
+        :param tags: tags of the entry, see invalidate()
+        :return: None
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, tuple(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        """
+        Remove all the entries marked with any of the tags.
+        :return: None
+        """
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        """
+        Remove all the entries.
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        """
+        :return: dictionary with the counters hits, misses, evictions and the current size
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "size": len(self._entries)}
+
+    def _remove(self, key):
+        for tag in self._entries.pop(key)[2]:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+
+class NullCache:
+    """Cache backend that stores nothing, used when caching is disabled."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, tags=()):
+        pass
+
+    def invalidate(self, *tags):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {"hits": 0, "misses": 0, "evictions": 0, "size": 0}
+
+
+def __getattr__(name):
+    # The socket cache needs multiprocessing.managers, so it is imported only by the processes using it
+    if name in ('SocketCache', 'make_cache_server'):
+        from utils import socket_cache
+        return getattr(socket_cache, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
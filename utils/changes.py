@@ -0,0 +1,180 @@
+import heapq
+import itertools
+import json
+import sqlite3
+import time
+
+# Next changes of a shard after a seq, the course columns are NULL for a delete
+CHANGES_QUERY = """
+    SELECT seq, operation, changed, course_id AS id, title, start_date, end_date, lectures
+    FROM course_changes
+    WHERE seq > :_since
+    ORDER BY seq
+    LIMIT :_limit
+    """
+EVENT_COURSE_FIELDS = ('id', 'title', 'start_date', 'end_date', 'lectures')
+# Seconds between the comments keeping an idle Server-Sent Events stream open
+HEARTBEAT_INTERVAL = 15
+
+
+def parse_cursor(text, shards):
+    """
+    :param text: cursor of the changes: the last seen seq, with several shards the seqs of the shards joined by '.',
+                 "0" - from the beginning of the log of every shard
+    :param shards: number of shards
+    :return: list of the last seen seq of every shard
+    :raise ValueError: the cursor is not valid
+    """
+    seqs = [int(seq) for seq in str(text).split('.')]
+    if seqs == [0]:
+        return [0] * shards
+    if len(seqs) != shards or min(seqs) < 0:
+        raise ValueError(f"The cursor should have {shards} non-negative seqs")
+    return seqs
+
+
+def format_cursor(seqs):
+    """
+    :param seqs: list of the last seen seq of every shard
+    :return: str - cursor of the changes (see parse_cursor)
+    """
+    return '.'.join(map(str, seqs))
+
+
+def change_event(row):
+    """
+    :param row: row of CHANGES_QUERY
+    :return: dict - 'seq', 'operation': insert, update or delete, 'changed': unix time in milliseconds
+             and 'course': the whole course after an insert or an update, only its id after a delete
+    """
+    if row['operation'] == 'delete':
+        course = {'id': row['id']}
+    else:
+        course = {name: row[name] for name in EVENT_COURSE_FIELDS}
+    return {'seq': row['seq'], 'operation': row['operation'], 'changed': row['changed'], 'course': course}
+
+
+def is_compacted(connections, since):
+    """
+    :param connections: read-only connections of the shards
+    :param since: list of the last seen seq of every shard
+    :return: True if the log was compacted after a seq of the cursor (the consumer may have missed deletes),
+             a cursor from the beginning of a shard is never compacted: it gets the latest change of every course
+    """
+    for db, seq in zip(connections, since):
+        if seq and seq < db.execute("SELECT seq FROM course_changes_compacted").fetchone()['seq']:
+            return True
+    return False
+
+
+def read_changes(connections, since, limit):
+    """
+    Read the next changes of the shards.
+    :param connections: read-only connections of the shards
+    :param since: list of the last seen seq of every shard
+    :param limit: maximum number of changes
+    :return: list of (shard index, event), the changes of several shards are merged by time
+    """
+    shard_events = []
+    for shard, (db, seq) in enumerate(zip(connections, since)):
+        rows = db.execute(CHANGES_QUERY, {"_since": seq, "_limit": limit}).fetchall()
+        shard_events.append([(shard, change_event(row)) for row in rows])
+    if len(shard_events) == 1:
+        return shard_events[0]
+    return list(itertools.islice(heapq.merge(*shard_events, key=lambda item: item[1]['changed']), limit))
+
+
+def advance(since, changes):
+    """
+    :param since: list of the last seen seq of every shard
+    :param changes: list of (shard index, event) read after `since`
+    :return: list of the last seq of every shard after the changes
+    """
+    since = list(since)
+    for shard, event in changes:
+        since[shard] = event['seq']
+    return since
+
+
+def wait_for_changes(connections, since, limit, timeout, interval=0.05):
+    """
+    Long poll: read the next changes, or wait for them up to `timeout` seconds.
+    A shard is read again when another connection commits to it (its PRAGMA data_version changes),
+    which is checked every `interval` seconds.
+    :return: list of (shard index, event), empty on timeout
+    """
+    deadline = time.monotonic() + timeout
+    # Plain cursors, so the checks are not counted as statements of the request
+    version_cursors = [db.cursor(sqlite3.Cursor) for db in connections]
+    for db_cursor in version_cursors:
+        db_cursor.row_factory = None
+
+    def data_versions():
+        return [db_cursor.execute("PRAGMA data_version").fetchone()[0] for db_cursor in version_cursors]
+
+    try:
+        while True:
+            versions = data_versions()
+            changes = read_changes(connections, since, limit)
+            if changes or time.monotonic() >= deadline:
+                return changes
+            while data_versions() == versions and time.monotonic() < deadline:
+                time.sleep(interval)
+    finally:
+        for db_cursor in version_cursors:
+            db_cursor.close()
+
+
+def stream_changes(pools, since, limit, timeout, interval=0.05):
+    """
+    Generate the changes as Server-Sent Events for `timeout` seconds, the client (EventSource) reconnects
+    with the id of the last event in the Last-Event-ID header. The events are named by their operation
+    and their id is the cursor after them. A comment is sent after HEARTBEAT_INTERVAL seconds without changes.
+    The generator holds its own pooled connections, because it outlives the application context of the request.
+    :param pools: connection pools of the shards
+    :param since: list of the last seen seq of every shard
+    :param limit: maximum number of changes read at a time
+    :param timeout: seconds before the stream ends
+    :param interval: seconds between the checks for new changes
+    :return: generator of response chunks
+    """
+    connections = [pool.acquire() for pool in pools]
+    deadline = time.monotonic() + timeout
+    try:
+        while (remaining := deadline - time.monotonic()) > 0:
+            changes = wait_for_changes(connections, since, limit, min(remaining, HEARTBEAT_INTERVAL), interval)
+            if not changes:
+                yield ': waiting\n\n'
+            for shard, event in changes:
+                since = advance(since, [(shard, event)])
+                yield f"id: {format_cursor(since)}\nevent: {event['operation']}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        for pool, db in zip(pools, connections):
+            pool.release(db)
+
+
+def compact_changes(db, expired):
+    """
+    Compact the changes of a shard made before a time: only the latest change of every course that still exists
+    is kept, so the log is bounded by the number of courses and the recent changes, and a new consumer reading
+    it from the beginning still gets every course. The consumers with a cursor before the compacted changes
+    get 410 Gone from /changes. The changes are not committed.
+    :param db: SQLite database connection of the shard that can write
+    :param expired: unix time in milliseconds, the changes made at or before it are compacted
+    :return: number of deleted changes
+    """
+    horizon = db.execute("SELECT max(seq) AS seq FROM course_changes WHERE changed <= :_expired",
+                         {"_expired": expired}).fetchone()['seq']
+    if horizon is None:
+        return 0
+    deleted = db.execute(
+        """
+        DELETE
+        FROM course_changes
+        WHERE seq <= :_horizon
+            AND (operation == 'delete' OR seq NOT IN (SELECT max(seq) FROM course_changes GROUP BY course_id))
+        """,
+        {"_horizon": horizon}
+    ).rowcount
+    db.execute("UPDATE course_changes_compacted SET seq = max(seq, :_horizon)", {"_horizon": horizon})
+    return deleted
@@ -0,0 +1,29 @@
+import functools
+from datetime import date, datetime
+
+DATE_FORMAT = "%Y-%m-%d"
+# Ordinal of the first day of the day numbers (the same epoch as the courses_days R*Tree)
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+# Number of distinct date strings remembered by parse_date()
+DATE_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(text):
+    """
+    Validate and parse a date in format YYYY-MM-DD.
+    A zero-padded date is sliced and checked by date.fromisoformat(), other strings accepted by
+    datetime.strptime(text, DATE_FORMAT) (e.g. "2018-9-1") go through strptime.
+    The dates of a catalog repeat a lot, so the results are cached.
+    :param text: date string
+    :return: tuple (date string in format YYYY-MM-DD, number of days since 1970-01-01)
+    :raise ValueError: the string is not a date in format YYYY-MM-DD
+    :raise TypeError: the value is not a string
+    """
+    if (len(text) == 10 and text[4] == text[7] == '-' and text.isascii()
+            and (text[:4] + text[5:7] + text[8:]).isdigit()):
+        day = date.fromisoformat(text)
+    else:
+        day = datetime.strptime(text, DATE_FORMAT).date()
+    return day.isoformat(), day.toordinal() - EPOCH_ORDINAL
+
@@ -1,3 +1,33 @@
+import json
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+from operator import itemgetter
+
+COURSE_FIELDS = ('id', 'title', 'start_date', 'end_date', 'lectures')
+_encode = json.JSONEncoder().encode
+_SCALAR_ENCODERS = {str: encode_basestring_ascii, int: int.__repr__, type(None): lambda value: 'null'}
+# Last seen cursor.description with its column names and Record class. sqlite3 keeps the same
+# description object for all rows of a statement, so they are looked up once per query, not once per row.
+_last_shape = (None, (), None)
+
+
+def _shape(description):
+    global _last_shape
+    shape = _last_shape
+    if shape[0] is not description:
+        names = tuple(column[0] for column in description)
+        shape = _last_shape = (description, names, Course if names == COURSE_FIELDS else record_class(names))
+    return shape
+
+
+def column_names(description):
+    """
+    Column names of a cursor shape, cached for the description of the current statement.
+    :param description: cursor.description
+    :return: tuple of column names
+    """
+    return _shape(description)[1]
+
 
 def dict_factory(cursor, row):
     """
@@ -6,7 +36,101 @@ def dict_factory(cursor, row):
     :param row: sqlite row
     :return: Dictionary representation of a row
     """
-    items = {}
-    for idx, col in enumerate(cursor.description):
-        items[col[0]] = row[idx]
-    return items
+    shape = _last_shape
+    if shape[0] is not cursor.description:
+        shape = _shape(cursor.description)
+    return dict(zip(shape[1], row))
+
+
+class Record(tuple):
+    """
+    Compact immutable row: a tuple whose fields are also readable by name (row.title or row['title'])
+    and which serializes itself to a JSON object without building an intermediate dictionary.
+    Subclasses are created by record_class() for every set of columns.
+    """
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+    _json_template = '{}'
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self._index[key]
+        return tuple.__getitem__(self, key)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{name}={value!r}' for name, value in zip(self._fields, self))})"
+
+    def to_json(self):
+        """
+        :return: str - JSON object with the column names as keys
+        """
+        return self._json_template % tuple([_SCALAR_ENCODERS.get(type(value), _encode)(value) for value in self])
+
+
+@lru_cache(maxsize=256)
+def record_class(fields):
+    """
+    Create (once per set of columns) a Record subclass with the given fields.
+    :param fields: tuple of column names
+    :return: Record subclass
+    """
+    namespace = {
+        '__slots__': (),
+        '__module__': __name__,
+        '_fields': fields,
+        '_index': {name: index for index, name in enumerate(fields)},
+        '_json_template': '{' + ', '.join(_encode(name).replace('%', '%%') + ': %s' for name in fields) + '}',
+    }
+    namespace.update({name: property(itemgetter(index)) for index, name in enumerate(fields)})
+    return type('Record', (Record,), namespace)
+
+
+class Course(record_class(COURSE_FIELDS)):
+    """Row of "SELECT * FROM courses", defined at module level so that it can be pickled."""
+    __slots__ = ()
+
+    def to_json(self):
+        """
+        :return: str - JSON object of the course, encoded without a per-value type dispatch
+        """
+        _id, title, start_date, end_date, lectures = self
+        try:
+            return self._json_template % (int.__repr__(_id), encode_basestring_ascii(title),
+                                          encode_basestring_ascii(start_date), encode_basestring_ascii(end_date),
+                                          int.__repr__(lectures))
+        except TypeError:
+            # A value of an unexpected type (SQLite columns are not strictly typed)
+            return super().to_json()
+
+
+def record_factory(cursor, row):
+    """
+    Format sqlite row to a Record
+    :param cursor: cursor for the connection to sqlite database
+    :param row: sqlite row
+    :return: Record with the columns of the cursor as fields
+    """
+    shape = _last_shape
+    if shape[0] is not cursor.description:
+        shape = _shape(cursor.description)
+    return shape[2](row)
+
+
+ROW_FACTORIES = {'dict': dict_factory, 'record': record_factory}
+
+
+def dumps(obj):
+    """
+    Serialize to JSON like json.dumps, writing Records straight from their templates.
+    :param obj: JSON serializable object which can contain Records
+    :return: str - JSON document
+    """
+    if isinstance(obj, Record):
+        return obj.to_json()
+    if isinstance(obj, dict):
+        return '{' + ', '.join(f'{encode_basestring_ascii(key if isinstance(key, str) else str(key))}: {dumps(value)}'
+                               for key, value in obj.items()) + '}'
+    if isinstance(obj, (list, tuple)):
+        return '[' + ', '.join(map(dumps, obj)) + ']'
+    return _encode(obj)
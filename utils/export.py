@@ -0,0 +1,93 @@
+import array
+import itertools
+import json
+import os
+import sys
+
+# NumPy .npy format 1.0: magic string, version, little-endian header length and a padded header
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+NPY_HEADER_SIZE = 128
+# array typecodes of the exported NumPy types
+NPY_TYPECODES = {'<i4': 'i', '<i8': 'q'}
+
+# Columns of the export: name, NumPy type and SQL expression (the dates are days since 1970-01-01)
+EXPORT_COLUMNS = (
+    ('id', '<i8', "id"),
+    ('title', '<i4', "title"),
+    ('start_day', '<i4', "CAST(julianday(start_date) - 2440587.5 AS INTEGER)"),
+    ('end_day', '<i4', "CAST(julianday(end_date) - 2440587.5 AS INTEGER)"),
+    ('lectures', '<i4', "lectures"),
+)
+EXPORT_QUERY = f"SELECT {', '.join(expression for _, _, expression in EXPORT_COLUMNS)} FROM courses ORDER BY id"
+
+
+class NpyWriter:
+    """
+    Stream integers into a one-dimensional .npy file, which numpy.load(path, mmap_mode='r') memory-maps.
+    The number of values is not known in advance, so the header is written again by close().
+    """
+
+    def __init__(self, path, dtype):
+        """
+        :param path: path of the .npy file
+        :param dtype: NumPy type of the values, '<i4' or '<i8'
+        """
+        self.dtype = dtype
+        self.count = 0
+        self._file = open(path, 'wb')
+        self._file.write(self._header())
+
+    def _header(self):
+        header = f"{{'descr': '{self.dtype}', 'fortran_order': False, 'shape': ({self.count},), }}"
+        header = header.ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 3) + '\n'
+        return NPY_MAGIC + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+    def write(self, values):
+        """
+        :param values: list of integers
+        :return: None
+        """
+        column = array.array(NPY_TYPECODES[self.dtype], values)
+        if sys.byteorder != 'little':
+            column.byteswap()
+        self._file.write(column.tobytes())
+        self.count += len(values)
+
+    def close(self):
+        self._file.seek(0)
+        self._file.write(self._header())
+        self._file.close()
+
+
+def export_columns(rows, directory, fetch_size=500):
+    """
+    Write the courses selected by EXPORT_QUERY column by column into `directory`:
+    one .npy file per column of EXPORT_COLUMNS and "catalog.json" with the number of rows,
+    the types of the columns and the titles (the title column holds indexes into this list).
+    :param rows: cursor of the executed EXPORT_QUERY or an iterator of its rows, the rows are tuples
+    :param directory: directory of the export, created if it does not exist
+    :param fetch_size: number of rows read from the database at a time
+    :return: number of exported courses
+    """
+    os.makedirs(directory, exist_ok=True)
+    writers = [NpyWriter(os.path.join(directory, f'{name}.npy'), dtype) for name, dtype, _ in EXPORT_COLUMNS]
+    title_codes = {}
+    rows = iter(rows)
+    try:
+        for chunk in iter(lambda: list(itertools.islice(rows, fetch_size)), []):
+            columns = [list(column) for column in zip(*chunk)]
+            columns[1] = [title_codes.setdefault(title, len(title_codes)) for title in columns[1]]
+            for writer, values in zip(writers, columns):
+                writer.write(values)
+    finally:
+        for writer in writers:
+            writer.close()
+    with open(os.path.join(directory, 'catalog.json'), 'w', encoding='utf-8') as f:
+        json.dump({
+            'rows': writers[0].count,
+            'columns': {name: dtype for name, dtype, _ in EXPORT_COLUMNS},
+            'epoch': '1970-01-01',
+            'titles': list(title_codes),
+        }, f, ensure_ascii=False)
+    return writers[0].count
+
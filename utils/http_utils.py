@@ -0,0 +1,36 @@
+import gzip
+import hashlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def request_etag(version, method, url, body):
+    """
+    Weak entity tag of a read request: it changes when the version of the data or the request changes.
+    :param version: version of the data the answer is built from
+    :param method: HTTP method of the request
+    :param url: full URL of the request, with the query string
+    :param body: bytes of the request body (the read endpoints take their parameters from JSON bodies)
+    :return: str - unquoted entity tag
+    """
+    digest = hashlib.blake2b(f'{method} {url}'.encode() + b'\n' + body, digest_size=8).hexdigest()
+    return f'{version}-{digest}'
+
+
+def compress(data, accept_encodings, level=6):
+    """
+    Compress a response body with the best encoding accepted by the client:
+    brotli (if the brotli package is installed), then gzip.
+    :param data: bytes of the response body
+    :param accept_encodings: werkzeug Accept object of the Accept-Encoding header
+    :param level: gzip compression level
+    :return: tuple (compressed bytes, content encoding) or None if the client accepts no supported encoding
+    """
+    if brotli is not None and accept_encodings['br']:
+        return brotli.compress(data), 'br'
+    if accept_encodings['gzip']:
+        return gzip.compress(data, compresslevel=level), 'gzip'
+    return None
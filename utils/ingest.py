@@ -0,0 +1,175 @@
+import csv
+import json
+import sqlite3
+from utils.dates import parse_date
+
+WRONG_DATE_FORMAT_MESSAGE = "This is the incorrect date string format. It should be YYYY-MM-DD"
+WRONG_DATE_RANGE_MESSAGE = "The start_date is equal or greater than the end_date"
+WRONG_END_DATE_MESSAGE = "The end_date is equal or smaller than the start_date"
+DUPLICATE_COURSE_MESSAGE = "A course with the same title and dates already exists"
+COURSE_FIELDS = ('title', 'start_date', 'end_date', 'lectures')
+# With the unique index of `flask dedup_courses --unique` a duplicate course is not inserted again.
+# The id is the next one of the sequence of the database (see utils.shards), not after the greatest id:
+# the courses moved from the other shards keep their ids, which may be greater.
+INSERT_COURSE_QUERY = """
+    INSERT INTO courses (id, title, start_date, end_date, lectures)
+    VALUES ((SELECT seq + 1 FROM sqlite_sequence WHERE name == 'courses'), ?, ?, ?, ?)
+    ON CONFLICT DO NOTHING
+    """
+# One statement text for every partial update: the missing attributes keep their values.
+# The date order is checked by the database (see schema.sql).
+UPDATE_COURSE_QUERY = """
+    UPDATE courses
+    SET title = coalesce(:title, title),
+        start_date = coalesce(:start_date, start_date),
+        end_date = coalesce(:end_date, end_date),
+        lectures = coalesce(:lectures, lectures)
+    WHERE id == :id
+    RETURNING *
+    """
+
+
+class CourseValidationError(ValueError):
+    """The course description can not be inserted into the database."""
+
+
+def validate_course(record):
+    """
+    Check a course description with the rules of the /add-course endpoint.
+    :param record: dictionary with the keys title, start_date, end_date, lectures
+    :return: tuple (title, start_date, end_date, lectures) ready to be inserted
+    """
+    if not isinstance(record, dict):
+        raise CourseValidationError("The course must be a JSON object")
+    for field in COURSE_FIELDS:
+        if record.get(field) in (None, ''):
+            raise CourseValidationError(f"The {field} is missing")
+
+    try:
+        start_date, start_day = parse_date(record['start_date'])
+        end_date, end_day = parse_date(record['end_date'])
+    except (TypeError, ValueError):
+        raise CourseValidationError(WRONG_DATE_FORMAT_MESSAGE)
+    if start_day >= end_day:
+        raise CourseValidationError(WRONG_DATE_RANGE_MESSAGE)
+
+    try:
+        lectures = int(record['lectures'])
+    except (TypeError, ValueError):
+        raise CourseValidationError("The lectures must be an integer")
+
+    return str(record['title']), start_date, end_date, lectures
+
+
+def validate_course_changes(record):
+    """
+    Check a partial update of a course with the rules of the /change-attributes endpoint.
+    Empty attributes are not changed.
+    :param record: dictionary with the key id and any of the keys title, start_date, end_date, lectures
+    :return: dictionary of the UPDATE_COURSE_QUERY parameters, None for the attributes that are not changed
+    """
+    if not isinstance(record, dict):
+        raise CourseValidationError("The course must be a JSON object")
+    try:
+        changes = {'id': int(record['id'])}
+    except KeyError:
+        raise CourseValidationError("The id is missing")
+    except (TypeError, ValueError):
+        raise CourseValidationError("The id should be an integer")
+
+    changes['title'] = str(record['title']) if record.get('title') else None
+    try:
+        for key in ('start_date', 'end_date'):
+            changes[key] = parse_date(record[key])[0] if record.get(key) else None
+    except (TypeError, ValueError):
+        raise CourseValidationError(WRONG_DATE_FORMAT_MESSAGE)
+    if changes['start_date'] and changes['end_date'] and changes['start_date'] >= changes['end_date']:
+        raise CourseValidationError(WRONG_DATE_RANGE_MESSAGE)
+    try:
+        changes['lectures'] = int(record['lectures']) if record.get('lectures') else None
+    except (TypeError, ValueError):
+        raise CourseValidationError("The lectures must be an integer")
+    return changes
+
+
+def update_course(db, changes):
+    """
+    Apply a partial update validated by validate_course_changes(), without committing it.
+    :param db: SQLite database connection
+    :param changes: dictionary of the UPDATE_COURSE_QUERY parameters
+    :return: the changed course or None if there is no course with this id
+    :raise CourseValidationError: the changed dates are out of order, or with the unique index
+                                  of `flask dedup_courses --unique` the changed course is a duplicate
+    """
+    try:
+        rows = db.execute(UPDATE_COURSE_QUERY, changes).fetchall()
+    except sqlite3.IntegrityError as error:
+        if str(error).startswith('UNIQUE constraint failed'):
+            raise CourseValidationError(DUPLICATE_COURSE_MESSAGE)
+        # Only one of the dates is changed and it is on the wrong side of the other one
+        raise CourseValidationError(WRONG_END_DATE_MESSAGE if changes['end_date'] else WRONG_DATE_RANGE_MESSAGE)
+    return rows[0] if rows else None
+
+
+def read_ndjson(lines):
+    """
+    Parse newline delimited JSON lazily, line by line.
+    :param lines: iterable of text lines
+    :return: generator of (line number, course dictionary or None if the line is not valid JSON)
+    """
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            yield line_number, None
+
+
+def read_csv(lines):
+    """
+    Parse CSV with a header row lazily, row by row.
+    :param lines: iterable of text lines
+    :return: generator of (line number, course dictionary)
+    """
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def import_courses(db, rows, chunk_size=1000, on_chunk=None, route=None):
+    """
+    Validate courses and insert the valid ones with executemany,
+    committing one transaction per chunk of `chunk_size` courses.
+    :param db: SQLite database connection, or with `route` the list of the connections of the shards
+    :param rows: iterable of (line number, course dictionary)
+    :param chunk_size: number of courses inserted per transaction
+    :param on_chunk: function called with the list of inserted courses after every committed chunk
+    :param route: function(title, start_date) returning the index of the shard connection of a course
+    :return: tuple (number of inserted courses, list of errors {"line": line number, "message": reason})
+    """
+    connections = db if route else [db]
+    inserted, errors, chunks = 0, [], [[] for _ in connections]
+    for line_number, record in rows:
+        try:
+            course = validate_course(record)
+        except CourseValidationError as error:
+            errors.append({"line": line_number, "message": str(error)})
+            continue
+        shard = route(course[0], course[1]) if route else 0
+        chunks[shard].append(course)
+        if len(chunks[shard]) >= chunk_size:
+            inserted += _insert_chunk(connections[shard], chunks[shard], on_chunk)
+            chunks[shard] = []
+    for connection, chunk in zip(connections, chunks):
+        if chunk:
+            inserted += _insert_chunk(connection, chunk, on_chunk)
+    return inserted, errors
+
+
+def _insert_chunk(db, chunk, on_chunk):
+    with db:
+        inserted = db.executemany(INSERT_COURSE_QUERY, chunk).rowcount
+    if on_chunk:
+        on_chunk(chunk)
+    return inserted
@@ -0,0 +1,287 @@
+import heapq
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Statistics of the request handled by the current thread, filled by InstrumentedCursor
+_local = threading.local()
+
+
+class RequestStats:
+    """SQL statistics of one request."""
+    __slots__ = ('statements', 'sql_seconds', 'rows')
+
+    def __init__(self):
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+
+    def add(self, other):
+        """
+        Add the statistics of the statements run for the request on another thread.
+        :param other: RequestStats
+        :return: None
+        """
+        self.statements += other.statements
+        self.sql_seconds += other.sql_seconds
+        self.rows += other.rows
+
+
+def start_request():
+    """
+    Start collecting SQL statistics for the request handled by the current thread.
+    :return: RequestStats
+    """
+    _local.stats = RequestStats()
+    return _local.stats
+
+
+def finish_request():
+    """
+    Stop collecting SQL statistics for the current thread.
+    :return: RequestStats or None if start_request() was not called
+    """
+    return _local.__dict__.pop('stats', None)
+
+
+def current_stats():
+    """
+    :return: RequestStats of the request handled by the current thread, None if it is not measured
+    """
+    return getattr(_local, 'stats', None)
+
+
+def measured(function, *args):
+    """
+    Run a function for a request on a thread of a pool, collecting the SQL statistics of its statements apart,
+    so they can be added to the statistics of the request (see RequestStats.add).
+    :return: tuple (result of the function, RequestStats)
+    """
+    _local.stats = RequestStats()
+    try:
+        return function(*args), _local.stats
+    finally:
+        del _local.stats
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that counts and times the statements and counts the fetched rows of the current request."""
+
+    def execute(self, *args):
+        return self._timed(super().execute, args)
+
+    def executemany(self, *args):
+        return self._timed(super().executemany, args)
+
+    def executescript(self, *args):
+        return self._timed(super().executescript, args)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._count_rows(1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        self._count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._count_rows(len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        self._count_rows(1)
+        return row
+
+    def _timed(self, method, args):
+        stats = getattr(_local, 'stats', None)
+        if stats is None:
+            return method(*args)
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            stats.statements += 1
+            stats.sql_seconds += time.perf_counter() - started
+
+    @staticmethod
+    def _count_rows(count):
+        stats = getattr(_local, 'stats', None)
+        if stats is not None:
+            stats.rows += count
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors (including the ones of the execute shortcuts) are InstrumentedCursors."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def executescript(self, *args):
+        return self.cursor().executescript(*args)
+
+
+class LatencyHistogram:
+    """Cumulative latency histogram with quantiles estimated over the last `window` samples."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS, window=1024):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=window)
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+
+    def quantile(self, q):
+        """
+        :param q: quantile between 0 and 1
+        :return: value of the quantile over the recent samples, 0.0 without samples
+        """
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Metrics:
+    """Per-endpoint request latencies, SQL statement counts and timings and fetched rows."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = defaultdict(LatencyHistogram)
+        self.statements = defaultdict(int)
+        self.sql_seconds = defaultdict(float)
+        self.rows = defaultdict(int)
+
+    def observe(self, endpoint, seconds, stats=None):
+        """
+        Record a finished request.
+        :param endpoint: name of the endpoint
+        :param seconds: duration of the request
+        :param stats: RequestStats of the request
+        :return: None
+        """
+        with self._lock:
+            self.latency[endpoint].observe(seconds)
+            if stats is not None:
+                self.statements[endpoint] += stats.statements
+                self.sql_seconds[endpoint] += stats.sql_seconds
+                self.rows[endpoint] += stats.rows
+
+    def render(self, cache_stats=None):
+        """
+        Render the metrics in the Prometheus text exposition format.
+        :param cache_stats: dictionary of cache counters (see LRUCache.stats) to include
+        :return: str
+        """
+        lines = []
+        with self._lock:
+            lines += ['# HELP course_catalog_request_duration_seconds Request latency by endpoint.',
+                      '# TYPE course_catalog_request_duration_seconds histogram']
+            for endpoint, histogram in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'course_catalog_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} '
+                                 f'{cumulative}')
+                lines += [f'course_catalog_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} '
+                          f'{histogram.count}',
+                          f'course_catalog_request_duration_seconds_sum{{endpoint="{endpoint}"}} {histogram.sum}',
+                          f'course_catalog_request_duration_seconds_count{{endpoint="{endpoint}"}} {histogram.count}']
+
+            lines += ['# HELP course_catalog_request_latency_seconds Recent request latency quantiles by endpoint.',
+                      '# TYPE course_catalog_request_latency_seconds summary']
+            for endpoint, histogram in sorted(self.latency.items()):
+                for q in QUANTILES:
+                    lines.append(f'course_catalog_request_latency_seconds{{endpoint="{endpoint}",quantile="{q}"}} '
+                                 f'{histogram.quantile(q)}')
+                lines += [f'course_catalog_request_latency_seconds_sum{{endpoint="{endpoint}"}} {histogram.sum}',
+                          f'course_catalog_request_latency_seconds_count{{endpoint="{endpoint}"}} {histogram.count}']
+
+            for name, description, values in (
+                    ('sql_statements_total', 'Executed SQL statements by endpoint.', self.statements),
+                    ('sql_duration_seconds_total', 'Time spent executing SQL statements by endpoint.',
+                     self.sql_seconds),
+                    ('rows_fetched_total', 'Rows fetched from the database by endpoint.', self.rows)):
+                lines += [f'# HELP course_catalog_{name} {description}', f'# TYPE course_catalog_{name} counter']
+                lines += [f'course_catalog_{name}{{endpoint="{endpoint}"}} {value}'
+                          for endpoint, value in sorted(values.items())]
+
+        if cache_stats is not None:
+            for name in ('hits', 'misses', 'evictions'):
+                lines += [f'# HELP course_catalog_cache_{name}_total Cache {name}.',
+                          f'# TYPE course_catalog_cache_{name}_total counter',
+                          f'course_catalog_cache_{name}_total {cache_stats[name]}']
+            lines += ['# HELP course_catalog_cache_entries Entries in the cache.',
+                      '# TYPE course_catalog_cache_entries gauge',
+                      f'course_catalog_cache_entries {cache_stats["size"]}']
+        return '\n'.join(lines) + '\n'
+
+
+class RequestProfiler:
+    """
+    Profiles a random sample of requests with cProfile and keeps on disk
+    the profiles of the `keep` slowest of them (as <endpoint>-<milliseconds>ms-<n>.prof files).
+    """
+
+    def __init__(self, directory, sample_rate, keep=20):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self._slowest = []
+        self._lock = threading.Lock()
+        self._dumped = 0
+
+    def start(self):
+        """
+        :return: enabled cProfile.Profile if the request is sampled, else None
+        """
+        if random.random() >= self.sample_rate:
+            return None
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile, endpoint, seconds):
+        """
+        Stop the profile and write it to disk if the request is one of the slowest.
+        :return: path of the written profile or None
+        """
+        profile.disable()
+        with self._lock:
+            if len(self._slowest) >= self.keep and seconds <= self._slowest[0][0]:
+                return None
+            self._dumped += 1
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{endpoint}-{seconds * 1000:.0f}ms-{self._dumped}.prof")
+            profile.dump_stats(path)
+            heapq.heappush(self._slowest, (seconds, path))
+            if len(self._slowest) > self.keep:
+                os.remove(heapq.heappop(self._slowest)[1])
+            return path
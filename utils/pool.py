@@ -0,0 +1,326 @@
+import pathlib
+import sqlite3
+import threading
+import time
+from collections import deque
+
+
+def connect(database, pragmas=None, row_factory=None, factory=sqlite3.Connection, read_only=False):
+    """
+    Open a new connection to the database tuned with PRAGMAs.
+    :param database: path to the SQLite database file
+    :param pragmas: dictionary {pragma name: value} applied to the connection
+    :param row_factory: row factory installed on the connection
+    :param factory: sqlite3.Connection subclass of the connection
+    :param read_only: open the database with a "mode=ro" URI, the connection can never take the write lock
+    :return: Connection - SQLite database connection object
+    """
+    if read_only:
+        uri = pathlib.Path(database).absolute().as_uri() + '?mode=ro'
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False, factory=factory)
+    else:
+        connection = sqlite3.connect(database, check_same_thread=False, factory=factory)
+    # A plain cursor, so the setup of the connection is not counted as statements of a request
+    setup = connection.cursor(sqlite3.Cursor)
+    for name, value in (pragmas or {}).items():
+        setup.execute(f"PRAGMA {name} = {value}")
+    setup.close()
+    connection.row_factory = row_factory
+    return connection
+
+
+class ConnectionPool:
+    """
+    Bounded pool of warm SQLite connections to one database file.
+    Connections are opened lazily, tuned with PRAGMAs once when they are created
+    and then reused across requests, so they keep their page and statement caches.
+    At most `size` idle connections are kept, extra connections are closed on release.
+    """
+
+    def __init__(self, database, size=8, pragmas=None, row_factory=None, factory=sqlite3.Connection,
+                 read_only=False):
+        """
+        :param database: path to the SQLite database file
+        :param size: maximum number of idle connections kept in the pool
+        :param pragmas: dictionary {pragma name: value} applied to every new connection
+        :param row_factory: row factory installed on every new connection
+        :param factory: sqlite3.Connection subclass of the connections
+        :param read_only: open read-only connections ("mode=ro" URIs)
+        """
+        self.database = database
+        self.size = size
+        self.pragmas = pragmas or {}
+        self.row_factory = row_factory
+        self.factory = factory
+        self.read_only = read_only
+        self._idle = deque()
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """
+        Open a new tuned connection to the database.
+        :return: Connection - SQLite database connection object
+        """
+        return connect(self.database, self.pragmas, self.row_factory, self.factory, self.read_only)
+
+    def acquire(self):
+        """
+        Check out the most recently used idle connection (its caches are the warmest)
+        or open a new one if the pool is empty.
+        :return: Connection - SQLite database connection object
+        """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self.connect()
+
+    def release(self, connection):
+        """
+        Check a connection back in. An unfinished transaction is rolled back,
+        so the next user always gets a clean connection.
+        :param connection: connection returned by acquire()
+        :return: None
+        """
+        if connection.in_transaction:
+            connection.rollback()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """
+        Close all idle connections.
+        :return: None
+        """
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for connection in idle:
+            connection.close()
+
+
+class GroupCommitWriter:
+    """
+    The single writer connection of a database, shared by the threads of the process.
+    Writers take turns: each one runs its statements in a savepoint of a long transaction,
+    and the transaction is committed by the first writer that joined it `interval` seconds later,
+    so the writes of concurrent requests share one commit (and one fsync).
+    A writer returns from commit() only when the transaction with its writes is committed.
+    """
+
+    def __init__(self, connection, interval=0.002):
+        """
+        :param connection: connection to the database that can write
+        :param interval: seconds the open transaction waits for more writes before it is committed
+        """
+        self.connection = connection
+        self.interval = interval
+        self._turn = threading.Lock()
+        self._committed = threading.Condition()
+        self._batch = 0
+        self._committed_batch = -1
+        self._leader = False
+        self._joined = 0
+        self._failures = {}
+
+    def session(self, row_factory=None):
+        """
+        :param row_factory: row factory of the statements of the session
+        :return: WriteSession - connection-like handle of the writer for one request
+        """
+        return WriteSession(self, row_factory)
+
+    def begin(self):
+        """
+        Wait for the turn of the caller and open its savepoint.
+        :return: Connection - the writer connection, usable until commit() or rollback()
+        """
+        self._turn.acquire()
+        try:
+            if not self.connection.in_transaction:
+                self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('SAVEPOINT request')
+        except BaseException:
+            self._turn.release()
+            raise
+        return self.connection
+
+    def rollback(self):
+        """
+        Undo the writes of the savepoint and give the turn back.
+        If no committed writes wait in the transaction, it is rolled back too, so the database is not left locked.
+        Otherwise the leader of the transaction commits them.
+        :return: None
+        """
+        try:
+            self.connection.execute('ROLLBACK TO request')
+            self.connection.execute('RELEASE request')
+            with self._committed:
+                pending = self._joined
+            if not pending:
+                self.connection.rollback()
+        finally:
+            self._turn.release()
+
+    def commit(self):
+        """
+        Keep the writes of the savepoint, give the turn back and wait until their transaction is committed.
+        The first writer of a transaction commits it after `interval` seconds.
+        :return: None
+        """
+        self.wait_committed(self.release())
+
+    def release(self):
+        """
+        Keep the writes of the savepoint and give the turn back, without waiting for their commit.
+        :return: ticket for wait_committed()
+        """
+        try:
+            self.connection.execute('RELEASE request')
+            with self._committed:
+                batch = self._batch
+                leader, self._leader = not self._leader, True
+                self._joined += 1
+        finally:
+            self._turn.release()
+        return batch, leader
+
+    def wait_committed(self, ticket):
+        """
+        Wait until the transaction of released writes is committed, the first writer of a transaction commits it
+        after `interval` seconds.
+        :param ticket: ticket returned by release()
+        :return: None
+        """
+        batch, leader = ticket
+        if leader:
+            time.sleep(self.interval)
+            self.flush()
+        with self._committed:
+            self._committed.wait_for(lambda: self._committed_batch >= batch)
+            failure = self._failures.get(batch)
+            if failure is not None:
+                # The failure is kept until every writer of the transaction has seen it
+                failure[1] -= 1
+                if not failure[1]:
+                    del self._failures[batch]
+        if failure is not None:
+            raise failure[0]
+
+    def flush(self):
+        """
+        Commit the open transaction now and wake up its writers.
+        :return: None
+        """
+        with self._turn:
+            self._flush()
+
+    def _flush(self):
+        with self._committed:
+            batch, self._batch, self._leader = self._batch, self._batch + 1, False
+            joined, self._joined = self._joined, 0
+        error = None
+        if self.connection is not None and self.connection.in_transaction:
+            try:
+                self.connection.commit()
+            except sqlite3.Error as commit_error:
+                error = commit_error
+                self.connection.rollback()
+        with self._committed:
+            self._committed_batch = batch
+            if error is not None and joined:
+                self._failures[batch] = [error, joined]
+            self._committed.notify_all()
+
+    def close(self):
+        """
+        Commit the open transaction and close the connection.
+        :return: None
+        """
+        with self._turn:
+            self._flush()
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+class WriteSession:
+    """
+    Connection-like handle of a GroupCommitWriter for one request.
+    The turn of the writer is taken by the first statement and given back by commit() or rollback(),
+    so a request holds the writer only while it writes. Used as a context manager,
+    it commits on success and rolls back on an exception, like sqlite3.Connection.
+    """
+
+    def __init__(self, writer, row_factory=None):
+        """
+        :param writer: GroupCommitWriter of the database
+        :param row_factory: row factory of the statements of the session
+        """
+        self.writer = writer
+        self.row_factory = row_factory
+        self._connection = None
+
+    @property
+    def in_transaction(self):
+        return self._connection is not None
+
+    def _begin(self):
+        if self._connection is None:
+            self._connection = self.writer.begin()
+            self._connection.row_factory = self.row_factory
+        return self._connection
+
+    def cursor(self):
+        return self._begin().cursor()
+
+    def execute(self, *args):
+        return self._begin().execute(*args)
+
+    def executemany(self, *args):
+        return self._begin().executemany(*args)
+
+    def commit(self):
+        commit_sessions([self])
+
+    def rollback(self):
+        if self._connection is not None:
+            self._connection = None
+            self.writer.rollback()
+
+    close = rollback
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+
+def commit_sessions(sessions):
+    """
+    Commit the sessions of several writers (e.g. of the shards of a database). The turns of all the writers
+    are given back before waiting for the commits, so a session never holds a turn while it waits
+    for the commit of another writer, which needs the turn of that writer.
+    :param sessions: list of WriteSession
+    :return: None
+    """
+    tickets, error = [], None
+    try:
+        for session in sessions:
+            if session._connection is not None:
+                session._connection = None
+                tickets.append((session.writer, session.writer.release()))
+    finally:
+        # Every ticket is waited for: the session leading a transaction has to commit it
+        for writer, ticket in tickets:
+            try:
+                writer.wait_committed(ticket)
+            except sqlite3.Error as commit_error:
+                error = error or commit_error
+    if error is not None:
+        raise error
@@ -0,0 +1,56 @@
+import os
+import zlib
+
+# Every shard allocates the ids of its new courses in its own range: shard n gives the ids from n << SHARD_ID_BITS + 1,
+# so the ids are unique across the shards and a course keeps its id when it is moved to another shard
+SHARD_ID_BITS = 40
+SHARD_KEYS = ('title', 'start_year')
+
+
+class ShardRouter:
+    """
+    Placement of the courses on the shard files of a catalog.
+    Shard 0 is the configured database itself, so a catalog of one database is a catalog of one shard,
+    and the other shards are files next to it ("database.1.db", "database.2.db", ...).
+    A new course is placed by its key: the hash of its title or its start year.
+    The placement of a course whose key changed is fixed by the `flask rebalance_shards` command,
+    until then it is read from its old shard: reads of courses go to all the shards.
+    """
+
+    def __init__(self, database, count=1, key='title'):
+        """
+        :param database: path of the configured database, the file of shard 0
+        :param count: number of shards
+        :param key: 'title' - crc32 of the title, 'start_year' - year of the start date
+        """
+        if count < 1 or count > 1 << (63 - SHARD_ID_BITS):
+            raise ValueError(f"The number of shards should be between 1 and {1 << (63 - SHARD_ID_BITS)}")
+        if key not in SHARD_KEYS:
+            raise ValueError(f"The shard key should be one of {', '.join(SHARD_KEYS)}")
+        root, extension = os.path.splitext(database)
+        self.databases = [database] + [f'{root}.{shard}{extension}' for shard in range(1, count)]
+        self.key = key
+
+    def __len__(self):
+        return len(self.databases)
+
+    def shard_of(self, title, start_date):
+        """
+        :param title: course title
+        :param start_date: course start date in format YYYY-MM-DD
+        :return: index of the shard of a new course
+        """
+        if len(self.databases) == 1:
+            return 0
+        if self.key == 'title':
+            # crc32 and not hash(): the placement must be the same in every process
+            return zlib.crc32(title.encode('utf-8')) % len(self.databases)
+        return int(start_date[:4]) % len(self.databases)
+
+    @staticmethod
+    def sequence_start(shard):
+        """
+        :param shard: index of the shard
+        :return: the start of the courses sequence of the shard, its first course gets the next id
+        """
+        return shard << SHARD_ID_BITS
@@ -0,0 +1,49 @@
+from multiprocessing.managers import BaseManager
+from utils.cache import LRUCache
+
+
+class _CacheServerManager(BaseManager):
+    pass
+
+
+class _CacheClientManager(BaseManager):
+    pass
+
+
+_CacheClientManager.register('get_cache')
+
+
+def make_cache_server(address, authkey, maxsize=10000, ttl=60):
+    """
+    Create a server that shares one LRUCache between worker processes over a local socket.
+    :param address: path of the unix socket (or a (host, port) tuple)
+    :param authkey: secret key clients have to know
+    :return: Server - call serve_forever() to run it
+    """
+    cache = LRUCache(maxsize, ttl)
+    _CacheServerManager.register('get_cache', callable=lambda: cache)
+    return _CacheServerManager(address=address, authkey=authkey).get_server()
+
+
+class SocketCache:
+    """Client of a cache served by make_cache_server(), it has the same interface as LRUCache."""
+
+    def __init__(self, address, authkey):
+        manager = _CacheClientManager(address=address, authkey=authkey)
+        manager.connect()
+        self._cache = manager.get_cache()
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, tags=()):
+        self._cache.set(key, value, tuple(tags))
+
+    def invalidate(self, *tags):
+        self._cache.invalidate(*tags)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
@@ -0,0 +1,158 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+
+class Operation:
+    """A write accepted by WriteBehindQueue.submit(), it is 'pending' until the transaction applying it ends."""
+
+    __slots__ = ('id', 'status', 'answer', 'code', '_done')
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = 'pending'
+        self.answer = None
+        self.code = None
+        self._done = threading.Event()
+
+    def finish(self, answer, code):
+        self.answer, self.code = answer, code
+        self.status = 'done' if code < 400 else 'failed'
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        :return: True if the operation is applied, False on timeout
+        """
+        return self._done.wait(timeout)
+
+    def to_json(self):
+        result = {'id': self.id, 'status': self.status}
+        if self.code is not None:
+            result.update(code=self.code, answer=self.answer)
+        return result
+
+
+class WriteBehindQueue:
+    """
+    Writes applied in the background by a dedicated thread, in transactions of up to `max_batch` writes.
+    The thread waits `interval` seconds after the first write of a batch to gather more of them,
+    and a write with the coalescing key of a write still in the queue is merged into it.
+    The thread is started by the first write, so a queue can be created before the process forks.
+    """
+
+    def __init__(self, apply, coalesce=None, interval=0.05, max_batch=1000, keep=10000):
+        """
+        :param apply: function(list of (kind, payload)) applying the writes in one transaction,
+                      it returns the list of their (answer, HTTP code)
+        :param coalesce: function(kind, payload, next kind, next payload) returning the merged (kind, payload)
+                         of two writes with the same key, or None if they can not be merged
+        :param interval: seconds the first write of a batch waits for more writes
+        :param max_batch: maximum number of writes applied in one transaction
+        :param keep: number of the latest operations kept for get()
+        """
+        self.apply = apply
+        self.coalesce = coalesce
+        self.interval = interval
+        self.max_batch = max_batch
+        self.keep = keep
+        self._changed = threading.Condition()
+        self._queue = deque()
+        self._by_key = {}
+        self._operations = OrderedDict()
+        self._submitted = 0
+        self._applied = 0
+        self._flushing = 0
+        self._closed = False
+        self._thread = None
+
+    def submit(self, kind, payload, key=None):
+        """
+        Queue a validated write.
+        :param kind: kind of the write, passed to apply
+        :param payload: parameters of the write, passed to apply
+        :param key: coalescing key, e.g. the id of the changed row
+        :return: Operation
+        """
+        operation = Operation()
+        with self._changed:
+            if self._closed:
+                raise RuntimeError("The write-behind queue is closed")
+            entry = self._by_key.get(key) if key is not None else None
+            merged = self.coalesce(entry[0], entry[1], kind, payload) if entry and self.coalesce else None
+            if merged is not None:
+                entry[0], entry[1] = merged
+                entry[3].append(operation)
+            else:
+                entry = [kind, payload, key, [operation]]
+                self._queue.append(entry)
+                if key is not None:
+                    self._by_key[key] = entry
+            self._submitted += 1
+            self._operations[operation.id] = operation
+            if len(self._operations) > self.keep:
+                self._operations.popitem(last=False)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+            self._changed.notify_all()
+        return operation
+
+    def get(self, operation_id):
+        """
+        :return: Operation or None if it is unknown (or forgotten)
+        """
+        with self._changed:
+            return self._operations.get(operation_id)
+
+    def flush(self, timeout=None):
+        """
+        Barrier: wait until all the writes submitted before the call are applied.
+        :return: True if they are applied, False on timeout
+        """
+        with self._changed:
+            target = self._submitted
+            self._flushing += 1
+            self._changed.notify_all()
+            try:
+                return self._changed.wait_for(lambda: self._applied >= target, timeout)
+            finally:
+                self._flushing -= 1
+
+    def close(self):
+        """
+        Apply the queued writes and stop the thread.
+        :return: None
+        """
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._queue or self._closed)
+                if not self._queue:
+                    return
+                wait = not (self._flushing or self._closed)
+            if wait:
+                time.sleep(self.interval)
+            with self._changed:
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch))]
+                for entry in batch:
+                    if self._by_key.get(entry[2]) is entry:
+                        del self._by_key[entry[2]]
+            try:
+                results = self.apply([(kind, payload) for kind, payload, _, _ in batch])
+            except Exception as error:
+                results = [({"message": f"The write failed: {error}"}, 500)] * len(batch)
+            with self._changed:
+                for entry, (answer, code) in zip(batch, results):
+                    for operation in entry[3]:
+                        operation.finish(answer, code)
+                    self._applied += len(entry[3])
+                self._changed.notify_all()